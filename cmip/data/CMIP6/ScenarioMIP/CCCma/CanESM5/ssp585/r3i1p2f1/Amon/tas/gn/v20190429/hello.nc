@@ -0,0 +1 @@
+hello worldhello worldhello worldhello world
\ No newline at end of file
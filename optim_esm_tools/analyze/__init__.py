@@ -11,3 +11,7 @@ from . import time_statistics
 from . import tools
 from . import xarray_tools
 from . import region_calculation
+from . import regrid
+from . import grid_registry
+from . import pipeline
+from . import batch
@@ -0,0 +1,202 @@
+"""Pre-process many (synda) folders in parallel.
+
+read_ds_batch takes a list of folders (e.g. the output of find_matches) and runs read_ds for
+each of them in a process pool. Each job gets its own temporary directory, the estimated
+temporary disk usage of the running jobs is bounded, and the outcome of each job is written to a
+journal such that an interrupted batch can be resumed.
+"""
+
+import datetime
+import json
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+import typing as ty
+from concurrent.futures import FIRST_COMPLETED
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import wait
+
+from optim_esm_tools.config import config
+from optim_esm_tools.config import get_logger
+
+
+class BatchJournal:
+    """Append-only journal (one json document per line) of finished jobs.
+
+    If a path occurs more than once, the last entry is leading.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def record(
+        self,
+        path: str,
+        status: str,
+        message: str = '',
+        seconds: float = 0.0,
+        n_bytes: int = 0,
+    ) -> None:
+        if status not in ('done', 'failed'):
+            raise ValueError(f'Unknown status {status}')  # pragma: no cover
+        doc = dict(
+            path=path,
+            status=status,
+            message=message,
+            seconds=round(seconds, 2),
+            n_bytes=n_bytes,
+            time=str(datetime.datetime.now()),
+        )
+        with open(self.path, 'a') as f:
+            f.write(json.dumps(doc) + '\n')
+
+    def entries(self) -> ty.Dict[str, dict]:
+        if not os.path.exists(self.path):
+            return {}
+        res = {}
+        with open(self.path) as f:
+            for line in f:
+                if not line.strip():
+                    continue  # pragma: no cover
+                doc = json.loads(line)
+                res[doc['path']] = doc
+        return res
+
+    def with_status(self, status: str) -> ty.List[str]:
+        return [p for p, doc in self.entries().items() if doc['status'] == status]
+
+
+def _source_size(path: str, read_ds_kw: ty.Mapping) -> int:
+    file_name = read_ds_kw.get('_file_name') or config['CMIP_files']['base_name']
+    source = os.path.join(path, file_name)
+    return os.path.getsize(source) if os.path.exists(source) else 0
+
+
+def _read_ds_job(
+    path: str,
+    read_ds_kw: ty.Mapping,
+    temp_dir_location: ty.Optional[str],
+) -> ty.Tuple[str, str, str, float]:
+    """Run read_ds for a single folder in its own temporary directory.
+
+    Returns:
+        ty.Tuple[str, str, str, float]: path, status, message and run time
+    """
+    from optim_esm_tools.analyze.cmip_handler import read_ds
+
+    t0 = time.time()
+    temp_dir = tempfile.mkdtemp(prefix='oet_batch_', dir=temp_dir_location)
+    read_ds_kw = dict(read_ds_kw)
+    pre_proc_kw = dict(read_ds_kw.pop('pre_proc_kw', None) or {})
+    pre_proc_kw.setdefault('temp_dir_location', temp_dir)
+    try:
+        ds = read_ds(path, pre_proc_kw=pre_proc_kw, **read_ds_kw)
+        if ds is None:
+            return path, 'failed', 'No dataset', time.time() - t0
+        ds.close()
+    except Exception as e:
+        get_logger().error(f'{path} failed with {e}')
+        return path, 'failed', f'{type(e).__name__}: {e}', time.time() - t0
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+    return path, 'done', '', time.time() - t0
+
+
+def read_ds_batch(
+    paths: ty.Iterable[str],
+    n_workers: ty.Optional[int] = None,
+    journal: ty.Optional[str] = None,
+    temp_dir_location: ty.Optional[str] = None,
+    max_temp_gb: ty.Optional[float] = None,
+    read_ds_kw: ty.Optional[ty.Mapping] = None,
+    retry_failed: bool = False,
+) -> ty.Dict[str, ty.List[str]]:
+    """Run read_ds for each of the paths in a process pool.
+
+    Args:
+        paths (ty.Iterable[str]): folders to read, e.g. from find_matches
+        n_workers (int, optional): number of processes. Defaults to None and is taken from config
+            (0 = os.cpu_count()).
+        journal (str, optional): journal file with the status of each path. Paths that are done
+            according to the journal are skipped. Defaults to None and is taken from config.
+        temp_dir_location (str, optional): folder in which each job creates its own temporary
+            directory. Defaults to None (system default).
+        max_temp_gb (float, optional): do not start new jobs if the estimated temporary disk usage
+            of the running jobs would exceed this (one job is always allowed). Defaults to None and
+            is taken from config (0 = unbounded).
+        read_ds_kw (ty.Mapping, optional): kwargs passed to read_ds. Defaults to None.
+        retry_failed (bool, optional): also rerun paths that failed according to the journal.
+            Defaults to False.
+
+    Returns:
+        ty.Dict[str, ty.List[str]]: the paths per status (done, failed or skipped)
+    """
+    log = get_logger()
+    batch_config = config['batch']
+    n_workers = n_workers or int(batch_config['n_workers']) or os.cpu_count() or 1
+    journal = journal or batch_config['journal']
+    if max_temp_gb is None:
+        max_temp_gb = float(batch_config['max_temp_gb'])
+    max_temp_bytes = max_temp_gb * 1e9 if max_temp_gb else float('inf')
+    temp_size_factor = float(batch_config['temp_size_factor'])
+    read_ds_kw = read_ds_kw or {}
+
+    book = BatchJournal(journal)
+    previous = book.entries()
+    skip_status = ('done',) if retry_failed else ('done', 'failed')
+    todo = []
+    result: ty.Dict[str, ty.List[str]] = dict(done=[], failed=[], skipped=[])
+    for path in paths:
+        if previous.get(path, {}).get('status') in skip_status:
+            result['skipped'].append(path)
+        elif path not in todo:
+            todo.append(path)
+    log.warning(
+        f'Batch of {len(todo)} paths ({len(result["skipped"])} skipped) on {n_workers} workers',
+    )
+    sizes = {p: _source_size(p, read_ds_kw) for p in todo}
+
+    t0 = time.time()
+    done_bytes = 0
+    running: ty.Dict[ty.Any, str] = {}
+    # Forking a process that already opened netCDF files (or started dask threads) may deadlock
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=n_workers, mp_context=context) as executor:
+        while todo or running:
+            while todo and len(running) < n_workers:
+                in_use = sum(sizes[p] * temp_size_factor for p in running.values())
+                if (
+                    running
+                    and in_use + sizes[todo[0]] * temp_size_factor > max_temp_bytes
+                ):
+                    break
+                path = todo.pop(0)
+                future = executor.submit(
+                    _read_ds_job, path, read_ds_kw, temp_dir_location
+                )
+                running[future] = path
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                path = running.pop(future)
+                path, status, message, seconds = future.result()
+                book.record(path, status, message, seconds, sizes[path])
+                result[status].append(path)
+                done_bytes += sizes[path]
+            dt = time.time() - t0
+            log.info(
+                f'{len(result["done"])} done, {len(result["failed"])} failed, {len(todo)} '
+                f'todo. {(len(result["done"]) + len(result["failed"])) / dt * 3600:.1f} paths/h '
+                f'{done_bytes / 1e6 / dt:.1f} MB/s',
+            )
+    dt = time.time() - t0
+    n_processed = len(result['done']) + len(result['failed'])
+    message = (
+        f'Batch finished in {dt:.1f} s: {len(result["done"])} done, '
+        f'{len(result["failed"])} failed, {len(result["skipped"])} skipped. '
+        f'Throughput {n_processed / max(dt, 1e-9) * 3600:.1f} paths/h, '
+        f'{done_bytes / 1e6 / max(dt, 1e-9):.1f} MB/s. Journal at {journal}'
+    )
+    log.warning(message)
+    return result
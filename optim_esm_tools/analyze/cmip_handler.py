@@ -1,15 +1,33 @@
+import glob
+import json
 import os
 import typing as ty
 from warnings import warn
 
+import numpy as np
 import xarray as xr
 
 import optim_esm_tools as oet
+from .globals import _CACHE_MANIFEST
 from .globals import _DEFAULT_MAX_TIME
 from .globals import _FOLDER_FMT
+from .globals import _MEMBER_DIM
+from optim_esm_tools.analyze import grid_registry
 from optim_esm_tools.analyze import tipping_criteria
 
 
+_DEFAULT_CONDITIONS: ty.Tuple[ty.Type[tipping_criteria._Condition], ...] = (
+    tipping_criteria.StartEndDifference,
+    tipping_criteria.StdDetrended,
+    tipping_criteria.StdDetrendedYearly,
+    tipping_criteria.MaxJump,
+    tipping_criteria.MaxJumpYearly,
+    tipping_criteria.MaxDerivitive,
+    tipping_criteria.MaxJumpAndStd,
+    tipping_criteria.SNR,
+)
+
+
 def add_conditions_to_ds(
     ds: xr.Dataset,
     calculate_conditions: ty.Optional[
@@ -18,17 +36,21 @@ def add_conditions_to_ds(
     condition_kwargs: ty.Optional[ty.Mapping] = None,
     variable_of_interest: ty.Tuple[str] = ('tas',),
     _ma_window: ty.Optional[ty.Union[int, str]] = None,
+    lazy: ty.Optional[bool] = None,
 ) -> xr.Dataset:
     """Transform the dataset to get it ready for handling in optim_esm_tools.
 
     Args:
         ds (xr.Dataset): input dataset
         calculate_conditions (ty.Tuple[tipping_criteria._Condition], optional): Calculate the
-            results of these tipping conditions. Defaults to None.
+            results of these tipping conditions. Defaults to None. Optional conditions that are not
+            calculated by default (like tipping_criteria.MaxJumpSweep) can be added here.
         condition_kwargs (ty.Mapping, optional): kwargs for the tipping conditions. Defaults to
             None.
         variable_of_interest (ty.Tuple[str], optional): Variables to handle. Defaults to ('tas',).
         _ma_window (int, optional): Moving average window (assumed to be years). Defaults to 10.
+        lazy (bool, optional): Only calculate the tipping conditions once their values are
+            accessed (e.g. by a region finder). Defaults to None and is taken from config.
 
     Raises:
         ValueError: If there are multiple tipping conditions with the same short_description
@@ -38,16 +60,7 @@ def add_conditions_to_ds(
     """
     _ma_window = _ma_window or oet.config.config['analyze']['moving_average_years']
     if calculate_conditions is None:
-        calculate_conditions = (
-            tipping_criteria.StartEndDifference,
-            tipping_criteria.StdDetrended,
-            tipping_criteria.StdDetrendedYearly,
-            tipping_criteria.MaxJump,
-            tipping_criteria.MaxJumpYearly,
-            tipping_criteria.MaxDerivitive,
-            tipping_criteria.MaxJumpAndStd,
-            tipping_criteria.SNR,
-        )  # type: ignore
+        calculate_conditions = _DEFAULT_CONDITIONS  # type: ignore
     if len(set(desc := (c.short_description for c in calculate_conditions))) != len(  # type: ignore
         calculate_conditions,  # type: ignore
     ):
@@ -56,7 +69,12 @@ def add_conditions_to_ds(
         )  # pragma: no cover
     if condition_kwargs is None:
         condition_kwargs = {}
+    if lazy is None:
+        lazy = oet.config.config['analyze']['lazy_conditions'] == 'True'
 
+    # Conditions that share parents (e.g. MaxJump for MaxJumpAndStd and SNR) calculate them once
+    graph = tipping_criteria.ConditionGraph(ds)
+    fingerprints = _read_manifest(ds.attrs).get('conditions', {})
     for variable in oet.utils.to_str_tuple(variable_of_interest):
         assert calculate_conditions is not None
         for cls in calculate_conditions:
@@ -64,7 +82,9 @@ def add_conditions_to_ds(
             oet.get_logger().debug(
                 f'{condition} from {cls} set ma= {condition.running_mean} ma={_ma_window}',
             )
-            condition_array = condition.calculate(ds)
+            condition_array = (
+                graph.get_lazy(condition) if lazy else graph.get(condition)
+            )
             condition_array = condition_array.assign_attrs(
                 dict(
                     short_description=cls.short_description,
@@ -73,6 +93,10 @@ def add_conditions_to_ds(
                 ),
             )
             ds[condition.short_description] = condition_array
+            fingerprints[condition.short_description] = (
+                tipping_criteria.condition_fingerprint(condition)
+            )
+    _update_manifest(ds, conditions=fingerprints)
     return ds
 
 
@@ -88,12 +112,13 @@ def read_ds(
     strict: bool = True,
     load: ty.Optional[bool] = None,
     add_history: bool = False,
-    _ma_window: ty.Optional[ty.Union[int, str]] = None,
+    _ma_window: ty.Optional[ty.Union[int, str, ty.Sequence[int]]] = None,
     _cache: bool = True,
     _file_name: ty.Optional[str] = None,
     _skip_folder_info: bool = False,
     _historical_path: ty.Optional[str] = None,
     pre_proc_kw=None,
+    variables: ty.Optional[ty.Iterable[str]] = None,
     **kwargs,
 ) -> ty.Optional[xr.Dataset]:
     """Read a dataset from a folder called "base".
@@ -113,13 +138,19 @@ def read_ds(
         strict (bool, optional): raise errors on loading, if any. Defaults to True.
         load (bool, optional): apply dataset.load to dataset directly. Defaults to False.
         add_history (bool, optional): start by merging historical dataset to the dataset.
-        _ma_window (int, optional): Moving average window (assumed to be years). Defaults to 10.
+        _ma_window (int, optional): Moving average window (assumed to be years). Several windows
+            (like (10, 50)) are all pre-processed, the tipping conditions use the first. Defaults
+            to 10.
         _cache (bool, optional): cache the dataset with it's extra fields to allow faster
             (re)loading. Defaults to True.
         _file_name (str, optional): name to match. Defaults to configs settings.
         _skip_folder_info (bool, optional): if set to True, do not infer the properties from the
             (synda) path of the file
         _historical_path (str, optional): If add_history is True, load from this (full) path
+        variables (ty.Iterable[str], optional): only return these variables (and the coordinates).
+            If the dataset is cached, the other variables are never opened. See
+            required_variables to get the variables that conditions, region finders and region
+            metrics read. Defaults to None (all variables).
 
     kwargs:
         any kwargs are passed onto transform_ds.
@@ -129,7 +160,10 @@ def read_ds(
     """
     log = oet.config.get_logger()
     _file_name = _file_name or oet.config.config['CMIP_files']['base_name']
-    _ma_window = _ma_window or int(oet.config.config['analyze']['moving_average_years'])
+    ma_windows = oet.analyze.pre_process._ma_windows(
+        _ma_window or oet.config.config['analyze']['moving_average_years'],
+    )
+    _ma_window = ma_windows[0]
     data_path = os.path.join(base, _file_name)
     variable_of_interest = (
         variable_of_interest or oet.analyze.pre_process._read_variable_id(data_path)
@@ -137,7 +171,9 @@ def read_ds(
     _historical_path = _historical_file(add_history, base, _file_name, _historical_path)
 
     if not isinstance(variable_of_interest, str):
-        raise ValueError('Only single vars supported')  # pragma: no cover
+        raise ValueError(  # pragma: no cover
+            'Only single vars supported, use read_many',
+        )
     if kwargs:
         log.error(f'Not really advised yet to call with {kwargs}')
         _cache = False
@@ -151,65 +187,556 @@ def read_ds(
         variable_of_interest,
         min_time,
         max_time,
-        _ma_window,
+        _ma_window if len(ma_windows) == 1 else ma_windows,
         is_historical=_historical_path is not None,
     )
 
-    if os.path.exists(res_file) and _cache:
-        return oet.analyze.io.load_glob(res_file)
-
-    if not os.path.exists(data_path):  # pragma: no cover
-        message = f'No dataset at {data_path}'
-        if strict:
-            raise FileNotFoundError(message)
-        log.warning(message)
-        return None
-
-    if pre_process:
-        pre_proc_kw = pre_proc_kw or dict()
-        data_set = oet.analyze.pre_process.get_preprocessed_ds(
-            sources=data_path,
-            historical_path=_historical_path,
+    # Reading an up-to-date cache does not need the lock (nor write access to its folder)
+    if _cache and not _stale_cache(
+        res_file,
+        variable_of_interest,
+        _ma_window,
+        apply_transform,
+        pre_proc_kw,
+    ):
+        return _project(_load_cached(res_file, variables), variables, res_file)
+
+    # If several processes need the same res_file, only the first computes it while the others
+    # wait for it (single-flight)
+    with oet.utils.file_lock(res_file, enabled=_cache):
+        if os.path.exists(res_file) and _cache:
+            manifest = _read_manifest(oet.analyze.io.file_info(res_file).attrs)
+            if manifest.get('pre_process') == _pre_process_manifest(pre_proc_kw):
+                stale = (
+                    _stale_conditions(manifest, variable_of_interest, _ma_window)
+                    if apply_transform
+                    else ()
+                )
+                if not stale:
+                    # Another process wrote res_file while we were waiting for the lock
+                    return _project(
+                        _load_cached(res_file, variables),
+                        variables,
+                        res_file,
+                    )
+                # Only calculate the conditions that were added or changed since res_file was
+                # written, from the pre-processed fields in it
+                names = [c.short_description for c in stale]
+                log.warning(f'Adding {names} to {res_file}')
+                data_set = _load_cached(res_file).load()
+                data_set = add_conditions_to_ds(
+                    data_set,
+                    calculate_conditions=stale,
+                    variable_of_interest=variable_of_interest,
+                    _ma_window=_ma_window,
+                )
+                data_set = oet.analyze.xarray_tools.set_precision(data_set)
+                _update_manifest(
+                    data_set,
+                    version=oet.config.config['versions']['cmip_handler'],
+                )
+                _write_cache(data_set, res_file, pre_proc_kw, only=names)
+                return _project(data_set, variables, res_file)
+            log.warning(f'Pre-processing of {res_file} changed, recomputing')
+        elif _cache and (legacy := _legacy_cache_files(res_file)):
+            # Before the versions were stored in the cache files, they were part of the name
+            log.warning(
+                f'{legacy} were written by an older version and are not read any more, they '
+                f'are replaced by {res_file} and can be removed',
+            )
+
+        if not os.path.exists(data_path):  # pragma: no cover
+            message = f'No dataset at {data_path}'
+            if strict:
+                raise FileNotFoundError(message)
+            log.warning(message)
+            return None
+
+        if pre_process:
+            pre_proc_kw = pre_proc_kw or dict()
+            data_set = oet.analyze.pre_process.get_preprocessed_ds(
+                sources=data_path,
+                historical_path=_historical_path,
+                max_time=max_time,
+                min_time=min_time,
+                _ma_window=ma_windows,
+                variable_id=variable_of_interest,
+                **pre_proc_kw,
+            )
+        else:  # pragma: no cover
+            message = (
+                'Not preprocessing file is dangerous, dimensions may differ wildly!'
+            )
+            if strict:
+                raise ValueError(message)
+            log.warning(message)
+            data_set = oet.analyze.io.load_glob(data_path, load=load)
+        data_set = oet.analyze.xarray_tools.set_precision(data_set)
+
+        if apply_transform:
+            kwargs.update(
+                dict(
+                    variable_of_interest=variable_of_interest,
+                    _ma_window=_ma_window,
+                ),
+            )
+            data_set = add_conditions_to_ds(data_set, **kwargs)
+            # Keep the results of the conditions at the configured precision
+            data_set = oet.analyze.xarray_tools.set_precision(data_set)
+
+        # start with -1 (for i==0)
+        metadata = (
+            {} if _skip_folder_info else oet.analyze.find_matches.folder_to_dict(base)
+        )
+        metadata.update(dict(path=base, file=res_file, running_mean_period=_ma_window))  # type: ignore
+        if _historical_path:
+            metadata.update(dict(historical_file=_historical_path))
+
+        data_set.attrs.update(metadata)
+        _update_manifest(
+            data_set,
+            version=oet.config.config['versions']['cmip_handler'],
+            pre_process=_pre_process_manifest(pre_proc_kw),
+        )
+
+        if _cache:
+            _write_cache(data_set, res_file, pre_proc_kw)
+
+        return _project(data_set, variables, res_file)
+
+
+def read_many(
+    bases: ty.Iterable[str],
+    merge: bool = True,
+    add_history: bool = False,
+    max_time: ty.Optional[ty.Tuple[int, ...]] = _DEFAULT_MAX_TIME,
+    min_time: ty.Optional[ty.Tuple[int, ...]] = None,
+    _file_name: ty.Optional[str] = None,
+    _skip_folder_info: bool = False,
+    pre_proc_kw: ty.Optional[ty.Mapping] = None,
+    **kw,
+) -> ty.Union[xr.Dataset, ty.Dict[str, xr.Dataset]]:
+    """Read several variables of the same source_id, experiment and member.
+
+    The settings that are shared by the variables are resolved once: the historical simulation
+    is matched for the first variable, and the historical files of the other variables are taken
+    from the same simulation. All variables are pre-processed for the same time range and target
+    grid. Each variable is then pre-processed (and cached) by read_ds, such that the caches are
+    shared with read_ds. The caches of this process (like the regridding weights, grid constants
+    and file information) are shared too.
+
+    Args:
+        bases (ty.Iterable[str]): Folders to load the data from (one per variable_id)
+        merge (bool, optional): return one dataset, where the results of the tipping conditions
+            are prefixed with the variable_id (like "tas max jump"). Defaults to True.
+        add_history (bool, optional): start by merging the historical dataset to each dataset.
+        max_time (ty.Optional[ty.Tuple[int, int, int]], optional): Defines time range in which to
+            load data. Defaults to (2100, 12, 31).
+        min_time (ty.Optional[ty.Tuple[int, int, int]], optional): Defines time range in which to
+            load data. Defaults to None.
+        _file_name (str, optional): name to match. Defaults to configs settings.
+        _skip_folder_info (bool, optional): if set to True, do not infer the properties from the
+            (synda) path of the file, and do not check that they match. The historical files are
+            then matched by read_ds (for each variable).
+        pre_proc_kw (ty.Mapping, optional): kwargs for pre-processing. Defaults to None.
+
+    kwargs:
+        any kwargs are passed onto read_ds.
+
+    Raises:
+        ValueError: If the bases are not of the same source_id, experiment and member, or if a
+            variable_id occurs more than once.
+
+    Returns:
+        ty.Union[xr.Dataset, ty.Dict[str, xr.Dataset]]: one dataset on the time stamps shared by
+            all variables if merge, otherwise a mapping of variable_id to dataset.
+    """
+    bases = oet.utils.to_str_tuple(bases)
+    _file_name = _file_name or oet.config.config['CMIP_files']['base_name']
+    if '_historical_path' in kw:
+        raise ValueError('read_many matches the historical files, got _historical_path')
+    historical_paths: ty.Dict[str, ty.Optional[str]] = {}
+    if not _skip_folder_info:
+        shared_keys = ('source_id', 'experiment_id', 'variant_label')
+        folder_info = {
+            tuple(oet.analyze.find_matches.folder_to_dict(b)[k] for k in shared_keys)  # type: ignore
+            for b in bases
+        }
+        if len(folder_info) > 1:
+            raise ValueError(f'Got different {shared_keys} for {bases}: {folder_info}')
+        if add_history:
+            historical_paths.update(_shared_historical_paths(bases, _file_name))
+    pre_proc_kw = dict(pre_proc_kw or {}, target_grid=_cache_target_grid(pre_proc_kw))
+
+    data_sets: ty.Dict[str, xr.Dataset] = {}
+    for base in bases:
+        data_set = read_ds(
+            base,
+            add_history=add_history,
             max_time=max_time,
             min_time=min_time,
-            _ma_window=_ma_window,
-            variable_id=variable_of_interest,
-            **pre_proc_kw,
+            _file_name=_file_name,
+            _skip_folder_info=_skip_folder_info,
+            _historical_path=historical_paths.get(base),
+            pre_proc_kw=pre_proc_kw,
+            **kw,
+        )
+        if data_set is None:  # pragma: no cover
+            continue
+        variable_id = data_set.attrs.get('variable_id') or _read_variable_id(
+            base,
+            _file_name,
         )
-    else:  # pragma: no cover
-        message = 'Not preprocessing file is dangerous, dimensions may differ wildly!'
-        if strict:
-            raise ValueError(message)
-        log.warning(message)
-        data_set = oet.analyze.io.load_glob(data_path, load=load)
-
-    if apply_transform:
-        kwargs.update(
-            dict(
-                variable_of_interest=variable_of_interest,
-                _ma_window=_ma_window,
-            ),
+        if variable_id in data_sets:
+            raise ValueError(f'Got {variable_id} more than once in {bases}')
+        data_sets[variable_id] = data_set
+    if not merge:
+        return data_sets
+    return _merge_variables(data_sets)
+
+
+def _shared_historical_paths(
+    bases: ty.Sequence[str],
+    _file_name: str,
+) -> ty.Dict[str, str]:
+    """Match the historical simulation of the first base, and get the
+    historical files of the other bases (variables) from that simulation."""
+    first = _historical_file(True, bases[0], _file_name, None)
+    assert first is not None
+    parent = oet.analyze.find_matches.folder_to_dict(first)
+    assert parent is not None
+    historical_paths = {bases[0]: first}
+    for base in bases[1:]:
+        folder_info = oet.analyze.find_matches.folder_to_dict(base)
+        assert folder_info is not None
+        heads = oet.analyze.find_matches.find_matches(
+            oet.analyze.find_matches.base_from_path(base),
+            activity_id=parent['activity_id'],
+            institution_id=parent['institution_id'],
+            source_id=parent['source_id'],
+            experiment_id=parent['experiment_id'],
+            variant_label=parent['variant_label'],
+            domain=folder_info['domain'],
+            variable_id=folder_info['variable_id'],
+            required_file=_file_name,
         )
-        data_set = add_conditions_to_ds(data_set, **kwargs)
+        if not heads:
+            raise FileNotFoundError(f'No historical matches for {base} in {parent}')
+        historical_paths[base] = os.path.join(heads[0], _file_name)
+    return historical_paths
+
+
+def _read_variable_id(
+    base: str,
+    _file_name: ty.Optional[str],
+) -> str:
+    _file_name = _file_name or oet.config.config['CMIP_files']['base_name']
+    return oet.analyze.pre_process._read_variable_id(os.path.join(base, _file_name))
 
-    # start with -1 (for i==0)
-    metadata = (
-        {} if _skip_folder_info else oet.analyze.find_matches.folder_to_dict(base)
+
+def _merge_variables(data_sets: ty.Mapping[str, xr.Dataset]) -> xr.Dataset:
+    """Merge the datasets of read_many on their shared time stamps."""
+    renamed = []
+    for variable_id, data_set in data_sets.items():
+        conditions = {
+            k: f'{variable_id} {k}'
+            for k, v in data_set.data_vars.items()
+            if v.attrs.get('short_description') == k
+        }
+        renamed.append(data_set.rename(conditions))
+    # The grids should be identical after pre-processing, only the time range may differ
+    lon_lat = oet.config.config['analyze']['lon_lat_dim'].split(',')
+    for data_set in renamed[1:]:
+        for dim in lon_lat:
+            if not np.array_equal(data_set[dim].values, renamed[0][dim].values):
+                raise ValueError(f'{dim} differs between {list(data_sets)}')
+    aligned = xr.align(*renamed, join='inner', exclude=lon_lat)
+    if aligned and not len(aligned[0]['time']):
+        raise ValueError(  # pragma: no cover
+            f'No shared time stamps for {list(data_sets)}',
+        )
+    result = xr.merge(aligned, compat='override', combine_attrs='drop_conflicts')
+    result.attrs.update(
+        dict(
+            variables=list(data_sets),
+            source_files=[ds.attrs.get('file', '') for ds in data_sets.values()],
+        ),
     )
-    metadata.update(dict(path=base, file=res_file, running_mean_period=_ma_window))  # type: ignore
-    if _historical_path:
-        metadata.update(dict(historical_file=_historical_path))
+    return result
 
-    data_set.attrs.update(metadata)
 
-    if _cache:
-        log.info(f'Write {res_file}')
-        if oet.config.config['CMIP_files']['compress'] == 'True':
-            oet.analyze.pre_process.save_nc(data_set, res_file)
-        else:
-            data_set.to_netcdf(res_file)
+def read_ensemble(
+    bases: ty.Iterable[str],
+    summaries: bool = True,
+    _ma_window: ty.Optional[ty.Union[int, str, ty.Sequence[int]]] = None,
+    _file_name: ty.Optional[str] = None,
+    _skip_folder_info: bool = False,
+    condition_kw: ty.Optional[ty.Mapping] = None,
+    **kw,
+) -> xr.Dataset:
+    """Read several members of the same source_id, experiment and variable
+    into one dataset with a "member" dimension.
+
+    Each member is pre-processed (and cached) by read_ds, after which the tipping conditions are
+    calculated for all members at once.
+
+    Args:
+        bases (ty.Iterable[str]): Folders to load the data from (one per member, see
+            find_matches(..., max_members=None))
+        summaries (bool, optional): add the mean and std over the members of each tipping
+            condition (like "max jump member mean"). Defaults to True.
+        _ma_window (int, optional): Moving average window (assumed to be years). Defaults to 10.
+        _file_name (str, optional): name to match. Defaults to configs settings.
+        _skip_folder_info (bool, optional): if set to True, do not infer the properties from the
+            (synda) path of the file, and label the members by their index.
+        condition_kw (ty.Mapping, optional): kwargs for add_conditions_to_ds. Defaults to None.
+
+    kwargs:
+        any kwargs are passed onto read_ds.
+
+    Raises:
+        ValueError: If the bases are not of the same source_id, experiment and variable, or if a
+            member occurs more than once.
+
+    Returns:
+        xr.Dataset: members on the time stamps shared by all members
+    """
+    bases = oet.utils.to_str_tuple(bases)
+    ma_windows = oet.analyze.pre_process._ma_windows(
+        _ma_window or oet.config.config['analyze']['moving_average_years'],
+    )
+    if _skip_folder_info:
+        members = [str(i) for i in range(len(bases))]
+    else:
+        shared_keys = ('source_id', 'experiment_id', 'variable_id')
+        folder_info = [oet.analyze.find_matches.folder_to_dict(b) for b in bases]
+        if len({tuple(f[k] for k in shared_keys) for f in folder_info}) > 1:  # type: ignore
+            raise ValueError(f'Got different {shared_keys} for {bases}')
+        members = [f['variant_label'] for f in folder_info]  # type: ignore
+    if len(set(members)) != len(members) or len(set(bases)) != len(bases):
+        raise ValueError(f'Got duplicate members {members} for {bases}')
 
-    return data_set
+    variable_ids = {_read_variable_id(b, _file_name) for b in bases}
+    if len(variable_ids) > 1:
+        raise ValueError(f'Got different variables {variable_ids} for {bases}')
+    (variable_id,) = variable_ids
+    # Only the pre-processed fields, the conditions are calculated for all members below
+    fields = [variable_id, f'{variable_id}_detrend', 'cell_area']
+    for window in ma_windows:
+        fields += [
+            f'{variable_id}_run_mean_{window}',
+            f'{variable_id}_detrend_run_mean_{window}',
+        ]
+    data_sets = [
+        read_ds(
+            base,
+            variable_of_interest=variable_id,
+            _ma_window=_ma_window,
+            _file_name=_file_name,
+            _skip_folder_info=_skip_folder_info,
+            variables=fields,
+            **kw,
+        )
+        for base in bases
+    ]
+
+    lon_lat = oet.config.config['analyze']['lon_lat_dim'].split(',')
+    cell_area = data_sets[0]['cell_area']
+    aligned = xr.align(
+        *[ds.drop_vars('cell_area') for ds in data_sets],
+        join='inner',
+        exclude=lon_lat,
+    )
+    ensemble = xr.concat(
+        aligned,
+        dim=xr.DataArray(members, dims=_MEMBER_DIM, name=_MEMBER_DIM),
+        combine_attrs='drop_conflicts',
+    )
+    ensemble['cell_area'] = cell_area
+    ensemble.attrs.update(dict(paths=list(bases)))
+
+    ensemble = add_conditions_to_ds(
+        ensemble,
+        variable_of_interest=variable_id,
+        _ma_window=ma_windows[0],
+        **(condition_kw or {}),
+    )
+    if summaries:
+        for name in list(ensemble.data_vars):
+            data_array = ensemble[name]
+            if 'short_description' not in data_array.attrs:
+                continue
+            for summary in ['mean', 'std']:
+                result = getattr(data_array, summary)(_MEMBER_DIM)
+                result.attrs = {
+                    **data_array.attrs,
+                    'short_description': f'{name} member {summary}',
+                }
+                ensemble[f'{name} member {summary}'] = result
+    return ensemble
+
+
+def _write_cache(
+    data_set: xr.Dataset,
+    res_file: str,
+    pre_proc_kw: ty.Optional[ty.Mapping],
+    only: ty.Optional[ty.Sequence[str]] = None,
+) -> None:
+    """Write data_set to res_file. If only is given (and res_file exists),
+    only add those variables (and the attributes) to res_file, instead of
+    rewriting all pre-processed fields."""
+    if only is not None and os.path.exists(res_file):
+        cached_dims = oet.analyze.io.file_info(res_file).dims
+        store = data_set[list(only)]
+        # Dimensions (like the window of MaxJumpSweep) cannot be resized in place
+        if all(cached_dims.get(d, n) == n for d, n in store.sizes.items()):
+            oet.config.get_logger().info(f'Add {list(only)} to {res_file}')
+            oet.analyze.io.save_ds(
+                store,
+                res_file,
+                compress=oet.config.config['CMIP_files']['compress'] == 'True',
+                append=True,
+            )
+            return
+    oet.config.get_logger().info(f'Write {res_file}')
+    # Don't store the cell_area if it's in the grid registry
+    store = grid_registry.strip(data_set, _cache_target_grid(pre_proc_kw))
+    oet.analyze.io.save_ds(
+        store,
+        res_file,
+        compress=oet.config.config['CMIP_files']['compress'] == 'True',
+    )
+
+
+def _cache_target_grid(pre_proc_kw: ty.Optional[ty.Mapping]) -> ty.Union[str, bool]:
+    target_grid = (pre_proc_kw or {}).get('target_grid')
+    if target_grid is None:
+        return oet.config.config['analyze']['regrid_to']
+    return target_grid
+
+
+def _pre_process_manifest(
+    pre_proc_kw: ty.Optional[ty.Mapping] = None,
+) -> ty.Dict[str, ty.Any]:
+    """Versions and settings that the pre-processed fields of a cached
+    dataset depend on."""
+    return dict(
+        stages=dict(oet.analyze.pipeline.STAGE_VERSIONS),
+        precision=oet.config.config['analyze'].get('precision', 'float64'),
+        target_grid=_cache_target_grid(pre_proc_kw),
+    )
+
+
+def _read_manifest(attrs: ty.Mapping) -> ty.Dict[str, ty.Any]:
+    """Read which stages and conditions a dataset contains (and with which
+    versions) from its attributes."""
+    return json.loads(attrs.get(_CACHE_MANIFEST, '{}'))
+
+
+def _update_manifest(data_set: xr.Dataset, **update) -> None:
+    # netCDF attributes cannot be nested, so store the manifest as a json string
+    manifest = _read_manifest(data_set.attrs)
+    manifest.update(update)
+    data_set.attrs[_CACHE_MANIFEST] = json.dumps(manifest, sort_keys=True)
+
+
+def _stale_conditions(
+    manifest: ty.Mapping,
+    variable: str,
+    _ma_window: int,
+) -> ty.Tuple[ty.Type[tipping_criteria._Condition], ...]:
+    """Get the default conditions that are missing from, or changed since,
+    the dataset with this manifest. If the dataset was written by another
+    version of cmip_handler, all default conditions are stale."""
+    if manifest.get('version') != oet.config.config['versions']['cmip_handler']:
+        return tuple(_DEFAULT_CONDITIONS)
+    fingerprints = manifest.get('conditions', {})
+    return tuple(
+        cls
+        for cls in _DEFAULT_CONDITIONS
+        if fingerprints.get(cls.short_description)
+        != tipping_criteria.condition_fingerprint(
+            cls(variable=variable, running_mean=_ma_window),
+        )
+    )
+
+
+def _stale_cache(
+    res_file: str,
+    variable: str,
+    _ma_window: int,
+    apply_transform: bool = True,
+    pre_proc_kw: ty.Optional[ty.Mapping] = None,
+) -> bool:
+    """Does res_file not exist, or does it need to be recomputed or
+    augmented (see _stale_conditions)?"""
+    if not os.path.exists(res_file):
+        return True
+    manifest = _read_manifest(oet.analyze.io.file_info(res_file).attrs)
+    if manifest.get('pre_process') != _pre_process_manifest(pre_proc_kw):
+        return True
+    return bool(apply_transform and _stale_conditions(manifest, variable, _ma_window))
+
+
+def _load_cached(
+    res_file: str,
+    variables: ty.Optional[ty.Iterable[str]] = None,
+) -> xr.Dataset:
+    """Lazily open res_file, only opening the variables (if provided)."""
+    kw = {}
+    if variables is not None:
+        keep = set(oet.utils.to_str_tuple(variables))
+        kw['drop_variables'] = [
+            v for v in oet.analyze.io.file_info(res_file).data_vars if v not in keep
+        ]
+    return grid_registry.attach(oet.analyze.io.load_glob(res_file, **kw))
+
+
+def _project(
+    data_set: xr.Dataset,
+    variables: ty.Optional[ty.Iterable[str]],
+    res_file: str,
+) -> xr.Dataset:
+    if variables is None:
+        return data_set
+    variables = oet.utils.to_str_tuple(variables)
+    if missing := [v for v in variables if v not in data_set.variables]:
+        raise ValueError(f'{missing} not in {res_file}')
+    return data_set[[v for v in variables if v in data_set.data_vars]]
+
+
+def required_variables(
+    consumers: ty.Iterable[ty.Any],
+    variable: str,
+    running_mean: ty.Optional[ty.Union[int, str]] = None,
+) -> ty.Tuple[str, ...]:
+    """Get the variables of a dataset from read_ds that consumers read.
+
+    Args:
+        consumers (ty.Iterable): tipping conditions (their result, as added by
+            add_conditions_to_ds), region finders or region metrics (classes with a
+            required_variables(variable, running_mean) method)
+        variable (str): variable_id of the dataset
+        running_mean (int, optional): Moving average window (assumed to be years). Defaults to
+            config.
+
+    Returns:
+        ty.Tuple[str, ...]: union of the variables, in order of appearance
+    """
+    running_mean = int(
+        running_mean or oet.config.config['analyze']['moving_average_years'],
+    )
+    result: ty.Dict[str, None] = {}
+    for consumer in consumers:
+        if isinstance(consumer, tipping_criteria._Condition) or (
+            isinstance(consumer, type)
+            and issubclass(consumer, tipping_criteria._Condition)
+        ):
+            result[consumer.short_description] = None
+            continue
+        for v in consumer.required_variables(variable, running_mean):
+            result[v] = None
+    return tuple(result)
 
 
 def _historical_file(
@@ -245,12 +772,15 @@ def _name_cache_file(
     variable_of_interest: str,
     min_time: ty.Optional[ty.Tuple[int, ...]],
     max_time: ty.Optional[ty.Tuple[int, ...]],
-    _ma_window: int,
+    _ma_window: ty.Union[int, ty.Sequence[int]],
     is_historical: bool,
-    version: ty.Optional[str] = None,
 ) -> str:
-    """Get a file name that identifies the settings."""
-    version = version or oet.config.config['versions']['cmip_handler']
+    """Get a file name that identifies the settings.
+
+    The versions of the code are not part of the name, but are stored in the
+    file (see _update_manifest), such that read_ds can update the cached file
+    instead of starting over.
+    """
     _ma_window = _ma_window or int(oet.config.config['analyze']['moving_average_years'])
     path = os.path.join(
         base,
@@ -259,7 +789,7 @@ def _name_cache_file(
         f'_e{tuple(max_time) if max_time else ""}'
         f'_ma{_ma_window}'
         + ('_hist' if is_historical else '')
-        + f'_optimesm_v{version}.nc',
+        + f'_optimesm{oet.analyze.io.storage_suffix()}',
     )
     normalized_path = (
         path.replace('(', '')
@@ -272,3 +802,10 @@ def _name_cache_file(
     )
     oet.config.get_logger().debug(f'got {normalized_path}')
     return normalized_path
+
+
+def _legacy_cache_files(res_file: str) -> ty.List[str]:
+    """Cache files of the same settings as res_file that were named after the
+    version of the code that wrote them (like "..._optimesm_v1.2.3.nc")."""
+    stem = res_file[: -len(oet.analyze.io.storage_suffix())]
+    return sorted(glob.glob(f'{glob.escape(stem)}_v*.nc'))
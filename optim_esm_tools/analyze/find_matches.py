@@ -59,7 +59,8 @@ def find_matches(
         grid_label (str, optional): As synda convention. Defaults to '*'.
         version (str, optional): As synda convention. Defaults to '*'.
         max_versions (int, optional): Max number of different versions that match. Defaults to 1.
-        max_members (int, optional): Max number of different members that match. Defaults to 1.
+        max_members (int, optional): Max number of different members that match (None for all,
+            see cmip_handler.read_ensemble to combine them). Defaults to 1.
         required_file (str, optional): Filename to match. Defaults to 'merged.nc'.
 
     Returns:
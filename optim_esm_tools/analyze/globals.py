@@ -7,3 +7,7 @@ _CMIP_HANDLER_VERSION: str = config['versions']['cmip_handler']
 _DEFAULT_MAX_TIME: ty.Tuple[int, ...] = tuple(
     int(s) for s in config['analyze']['max_time'].split()
 )
+# Dimension of the members in ensemble datasets (see cmip_handler.read_ensemble)
+_MEMBER_DIM: str = 'member'
+# Attribute of the datasets cached by read_ds that records how they were made
+_CACHE_MANIFEST: str = 'optimesm_manifest'
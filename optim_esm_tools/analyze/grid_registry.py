@@ -0,0 +1,159 @@
+"""Registry of grid constants (cell area, lat/lon and latitude-zone masks) of the
+target grids that data is regridded to.
+
+Since every pre-processed dataset on e.g. the n90 grid has the same cell areas, these are
+computed once per target grid (and process) and are not stored in each cache file of read_ds.
+Datasets that reference the registry carry the attribute "grid_registry" with the name of the
+target grid, and get their cell_area re-attached when loaded.
+"""
+
+import typing as ty
+
+import numpy as np
+import xarray as xr
+
+from optim_esm_tools.analyze import regrid
+from optim_esm_tools.config import config
+from optim_esm_tools.config import get_logger
+
+_GRIDS: ty.Dict[str, 'GridConstants'] = {}
+
+_AREA_ATTRS = dict(standard_name='area', long_name='area of grid cell', units='m2')
+
+
+class GridConstants:
+    """Constants of a target grid, with lazily computed (and cached) derived
+    masks."""
+
+    def __init__(
+        self,
+        name: ty.Optional[str],
+        lat: np.ndarray,
+        lon: np.ndarray,
+        cell_area: np.ndarray,
+    ):
+        self.name = name
+        self.lat = lat
+        self.lon = lon
+        self.cell_area = cell_area
+        self._lat_2d: ty.Optional[np.ndarray] = None
+        self._zone_masks: ty.Dict[ty.Tuple[float, float], np.ndarray] = {}
+
+    @property
+    def lat_2d(self) -> np.ndarray:
+        """Latitude of each cell, shape (lat, lon)."""
+        if self._lat_2d is None:
+            self._lat_2d = np.repeat(self.lat[:, None], len(self.lon), axis=1)
+            self._lat_2d.setflags(write=False)
+        return self._lat_2d
+
+    def zone_mask(self, lat_min: float, lat_max: float) -> np.ndarray:
+        """Cells with lat_min < lat < lat_max, shape (lat, lon)."""
+        key = (float(lat_min), float(lat_max))
+        if key not in self._zone_masks:
+            mask = (self.lat_2d > lat_min) & (self.lat_2d < lat_max)
+            mask.setflags(write=False)
+            self._zone_masks[key] = mask
+        return self._zone_masks[key]
+
+    def tropics_mask(self, tropic_lat: float) -> np.ndarray:
+        return self.zone_mask(-tropic_lat, tropic_lat)
+
+    def area_data_array(self) -> xr.DataArray:
+        return xr.DataArray(
+            self.cell_area,
+            dims=('lat', 'lon'),
+            coords=dict(lat=self.lat, lon=self.lon),
+            attrs=_AREA_ATTRS,
+            name='cell_area',
+        )
+
+    def matches(self, ds: ty.Union[xr.Dataset, xr.DataArray]) -> bool:
+        """Is ds on this grid (same lat/lon coordinates)?"""
+        if 'lat' not in ds.coords or 'lon' not in ds.coords:
+            return False
+        lat, lon = ds['lat'].values, ds['lon'].values
+        return (
+            lat.shape == self.lat.shape
+            and lon.shape == self.lon.shape
+            and np.allclose(lat, self.lat, atol=1e-6)
+            and np.allclose(lon, self.lon, atol=1e-6)
+        )
+
+
+def is_supported(target_grid: ty.Union[str, bool, None]) -> bool:
+    """Can the constants of target_grid be computed (without cdo)?"""
+    if not isinstance(target_grid, str):
+        return False
+    try:
+        regrid.target_grid_coords(target_grid)
+    except (NotImplementedError, ValueError):
+        return False
+    return True
+
+
+def get_grid(target_grid: str) -> GridConstants:
+    """Get the constants of target_grid (like n90), computed once per
+    process."""
+    if target_grid not in _GRIDS:
+        get_logger().debug(f'Registering grid {target_grid}')
+        lat, lon = regrid.target_grid_coords(target_grid)
+        area = regrid.grid_area(target_grid)
+        for a in (lat, lon, area):
+            a.setflags(write=False)
+        _GRIDS[target_grid] = GridConstants(target_grid, lat, lon, area)
+    return _GRIDS[target_grid]
+
+
+def for_dataset(ds: xr.Dataset) -> GridConstants:
+    """Get the grid constants of ds, either from the registry or from the
+    fields of ds itself (for grids that are not registered)."""
+    name = ds.attrs.get('grid_registry')
+    if name:
+        return get_grid(name)
+    default_grid = config['analyze']['regrid_to']
+    if is_supported(default_grid) and (grid := get_grid(default_grid)).matches(ds):
+        return grid
+    return GridConstants(
+        name=None,
+        lat=ds['lat'].values,
+        lon=ds['lon'].values,
+        cell_area=ds['cell_area'].values,
+    )
+
+
+def cell_area(ds: xr.Dataset) -> np.ndarray:
+    """Get the cell areas of ds, from the dataset or the registry."""
+    if 'cell_area' in ds:
+        return ds['cell_area'].values
+    return for_dataset(ds).cell_area
+
+
+def attach(ds: xr.Dataset) -> xr.Dataset:
+    """Add cell_area from the registry if ds references it."""
+    name = ds.attrs.get('grid_registry')
+    if name is None or 'cell_area' in ds:
+        return ds
+    grid = get_grid(name)
+    if not grid.matches(ds):
+        raise ValueError(f'Dataset is not on grid {name}')  # pragma: no cover
+    ds['cell_area'] = grid.area_data_array().assign_coords(lat=ds['lat'], lon=ds['lon'])
+    return ds
+
+
+def strip(ds: xr.Dataset, target_grid: ty.Optional[str]) -> xr.Dataset:
+    """If the cell_area of ds is that of target_grid in the registry, return
+    a copy without cell_area that references the registry instead."""
+    if 'cell_area' not in ds or not is_supported(target_grid):
+        return ds
+    assert isinstance(target_grid, str)
+    grid = get_grid(target_grid)
+    if not grid.matches(ds) or not np.allclose(
+        ds['cell_area'].values,
+        grid.cell_area,
+        rtol=1e-6,
+    ):
+        return ds
+    ds = ds.drop_vars('cell_area')
+    ds.attrs = {**ds.attrs, 'grid_registry': target_grid}
+    return ds
@@ -1,9 +1,19 @@
 import os
+import tempfile
+import time
+import typing as ty
 
+import numpy as np
+import pandas as pd
 import xarray as xr
+from immutabledict import immutabledict
 
+from optim_esm_tools.config import config
+from optim_esm_tools.config import get_logger
 from optim_esm_tools.utils import add_load_kw
 
+_FILE_INFO_CACHE: ty.Dict[tuple, 'FileInfo'] = {}
+
 
 @add_load_kw
 def load_glob(
@@ -20,6 +30,9 @@ def load_glob(
     """
     if not os.path.exists(pattern):
         raise FileNotFoundError(f'{pattern} does not exists')  # pragma: no cover
+    if pattern.endswith('.zarr'):
+        kw.setdefault('use_cftime', True)
+        return xr.open_zarr(pattern, **kw)
     for k, v in dict(
         use_cftime=True,
         concat_dim='time',
@@ -34,3 +47,236 @@ def load_glob(
         return xr.open_mfdataset(pattern, **kw)
     except ValueError as e:  # pragma: no cover
         raise ValueError(f'Fatal error while reading {pattern}') from e
+
+
+def storage_suffix(storage: ty.Optional[str] = None) -> str:
+    """Get the extension of stored datasets for storage (netcdf or zarr).
+
+    Args:
+        storage (str, optional): storage format. Defaults to None and is taken from config.
+
+    Raises:
+        ValueError: if storage is not netcdf or zarr
+
+    Returns:
+        str: ".nc" or ".zarr"
+    """
+    storage = storage or config['CMIP_files'].get('storage', 'netcdf')
+    suffixes = dict(netcdf='.nc', zarr='.zarr')
+    if storage not in suffixes:
+        raise ValueError(f'storage should be one of {list(suffixes)}, got {storage}')
+    return suffixes[storage]
+
+
+def save_ds(
+    data_set: xr.Dataset,
+    path: str,
+    compress: bool = True,
+    cell_chunk: ty.Optional[int] = None,
+    append: bool = False,
+) -> None:
+    """Write data_set to path, as a zarr store if path ends with ".zarr" and
+    as netCDF otherwise. Other processes may read path as soon as it exists,
+    so it is only moved there once complete.
+
+    The zarr store is chunked for reading the time series of (a few) cells: each chunk holds the
+    full time axis of cell_chunk x cell_chunk cells, such that parallel readers of small (masked)
+    regions only read the chunks they need.
+
+    Args:
+        data_set (xr.Dataset): dataset to store
+        path (str): destination
+        compress (bool, optional): compress the netCDF variables (zarr stores are always
+            compressed). Defaults to True.
+        cell_chunk (int, optional): number of cells along each of the lon/lat dimensions per zarr
+            chunk. Defaults to None and is taken from config.
+        append (bool, optional): add (or overwrite) the variables and attributes of data_set in
+            the existing dataset at path, without re-encoding its other variables. The existing
+            dataset is copied and the copy is moved to path once complete. Its dimensions
+            should have the same sizes as those of data_set. Defaults to False.
+    """
+    import shutil
+
+    from optim_esm_tools.analyze.pre_process import save_nc
+    from optim_esm_tools.utils import atomic_publish
+
+    mode = 'a' if append else 'w'
+    if not path.endswith('.zarr'):
+
+        def write_nc(tmp_path: str) -> None:
+            if append:
+                shutil.copyfile(path, tmp_path)
+            if compress:
+                save_nc(data_set, tmp_path, mode=mode)
+            else:
+                data_set.to_netcdf(tmp_path, mode=mode)
+
+        atomic_publish(write_nc, path, suffix='.nc')
+        return
+    cell_chunk = int(cell_chunk or config['CMIP_files'].get('zarr_cell_chunk', '16'))
+    lon_lat = config['analyze']['lon_lat_dim'].split(',')
+    store = data_set.copy()
+    for variable in store.variables.values():
+        # The chunking and compression of the source (e.g. a netCDF file) do not apply to zarr
+        variable.encoding = {
+            k: v
+            for k, v in variable.encoding.items()
+            if k in ('units', 'calendar', 'dtype', '_FillValue')
+        }
+    store = store.chunk(
+        {d: (cell_chunk if d in lon_lat else -1) for d in store.dims},
+    )
+
+    def write_zarr(tmp_path: str) -> None:
+        if append:
+            shutil.copytree(path, tmp_path, dirs_exist_ok=True)
+        store.to_zarr(tmp_path, mode=mode, consolidated=True)
+
+    atomic_publish(write_zarr, path, suffix='.zarr', directory=True)
+
+
+def benchmark_storage_profiles(
+    data_set: xr.Dataset,
+    profiles: ty.Optional[ty.Iterable[str]] = None,
+    region_size: int = 5,
+    repeat: int = 3,
+    directory: ty.Optional[str] = None,
+) -> pd.DataFrame:
+    """Store data_set with each of the storage profiles (see
+    pre_process.STORAGE_PROFILES) and time the typical reads.
+
+    The reads are:
+        region_series: time series of a region_size x region_size region of a running mean (like
+            region_calculation.RegionPropertyCalculator)
+        region_field: the same for the field itself
+        time_slice: a map of the field at the last time step (like plotting)
+        criteria_map: a tipping criterion (or other map without time)
+
+    Args:
+        data_set (xr.Dataset): dataset to store, e.g. from read_ds
+        profiles (ty.Iterable[str], optional): profiles to compare. Defaults to all.
+        region_size (int, optional): number of cells along lon and lat of the regions. Defaults
+            to 5.
+        repeat (int, optional): number of times to repeat each read. Defaults to 3.
+        directory (str, optional): where to store the temporary files. Defaults to the system
+            default.
+
+    Returns:
+        pd.DataFrame: median time (seconds) per profile and read, and the file size (bytes)
+    """
+    from optim_esm_tools.analyze.pre_process import STORAGE_PROFILES
+    from optim_esm_tools.analyze.pre_process import _variable_role
+    from optim_esm_tools.analyze.pre_process import save_nc
+
+    by_role: ty.Dict[ty.Optional[str], str] = {}
+    for name, data_array in data_set.data_vars.items():
+        by_role.setdefault(_variable_role(data_array), str(name))
+    region = {
+        d: slice(data_set.sizes[d] // 2, data_set.sizes[d] // 2 + region_size)
+        for d in config['analyze']['lon_lat_dim'].split(',')
+    }
+    reads = dict(
+        region_series=(by_role.get('series'), region),
+        region_field=(by_role.get('field'), region),
+        time_slice=(by_role.get('field'), dict(time=-1)),
+        criteria_map=(by_role.get('map'), {}),
+    )
+    rows = []
+    with tempfile.TemporaryDirectory(dir=directory) as temp_dir:
+        for profile in profiles or STORAGE_PROFILES:
+            path = os.path.join(temp_dir, f'{profile}.nc')
+            save_nc(data_set, path, profile=profile)
+            for read, (name, selection) in reads.items():
+                if name is None:
+                    continue
+                timings = []
+                for _ in range(repeat):
+                    t0 = time.perf_counter()
+                    stored = load_glob(path)
+                    stored[name].isel(selection).values
+                    stored.close()
+                    timings.append(time.perf_counter() - t0)
+                rows.append(
+                    dict(
+                        profile=profile,
+                        read=read,
+                        variable=name,
+                        seconds=float(np.median(timings)),
+                        file_size=os.path.getsize(path),
+                    ),
+                )
+    return pd.DataFrame(rows)
+
+
+class FileInfo(ty.NamedTuple):
+    """Summary of the metadata of a file, see file_info."""
+
+    path: str
+    size: int
+    mtime_ns: int
+    data_vars: ty.Tuple[str, ...]
+    dims: ty.Mapping[str, int]
+    attrs: ty.Mapping[str, ty.Any]
+    times: np.ndarray
+    calendar: ty.Optional[str]
+    grid_fingerprint: ty.Optional[str]
+    nbytes: int
+
+    @property
+    def n_time(self) -> int:
+        return len(self.times)
+
+    @property
+    def year_span(self) -> int:
+        """Number of years between the first and last time stamp."""
+        if not self.n_time:
+            return 0
+        return self.times[-1].year - self.times[0].year
+
+
+def file_info(path: str) -> FileInfo:
+    """Get the metadata of the file at path, only opening the file once for
+    each (path, size, modification time).
+
+    The checks in pre_process (variables to remove, variable_id, time range
+    and duplicate time stamps) all share this, such that a file is not
+    opened repeatedly (which may take seconds each on network file
+    systems). If the file is changed, the information is read again.
+
+    Args:
+        path (str): path of the file
+
+    Returns:
+        FileInfo: variables, dimensions, attributes, time axis, calendar,
+            grid fingerprint and sizes of the file
+    """
+    from optim_esm_tools.analyze import regrid
+
+    if not os.path.exists(path):
+        raise FileNotFoundError(f'{path} does not exists')  # pragma: no cover
+    stat = os.stat(path)
+    key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+    if key in _FILE_INFO_CACHE:
+        return _FILE_INFO_CACHE[key]
+    get_logger().debug(f'Reading file info of {path}')
+    ds = load_glob(path)
+    times = ds['time'].values if 'time' in ds else np.array([])
+    try:
+        fingerprint = regrid.grid_fingerprint(*regrid.grid_arrays(ds, name=path))
+    except ValueError:  # pragma: no cover
+        fingerprint = None
+    info = FileInfo(
+        path=key[0],
+        size=stat.st_size,
+        mtime_ns=stat.st_mtime_ns,
+        data_vars=tuple(ds.data_vars),
+        dims=immutabledict({k: int(v) for k, v in ds.sizes.items()}),
+        attrs=immutabledict(ds.attrs),
+        times=times,
+        calendar=getattr(times[0], 'calendar', None) if len(times) else None,
+        grid_fingerprint=fingerprint,
+        nbytes=int(ds.nbytes),
+    )
+    ds.close()
+    _FILE_INFO_CACHE[key] = info
+    return info
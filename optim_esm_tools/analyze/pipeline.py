@@ -0,0 +1,136 @@
+"""Content-addressed caching of pre-processing stages.
+
+pre_process(engine='numpy') is modelled as a chain of stages:
+    merge -> regrid (+ area) -> time slice -> detrend / running means
+Each stage is identified by a key derived from its name, version, parameters and the keys of its
+parent stages. If a stage is stored on disk under that key, it is reused, so changing for example
+the moving average window only recomputes the stages downstream of that parameter.
+"""
+
+import hashlib
+import json
+import os
+import typing as ty
+
+import xarray as xr
+from immutabledict import immutabledict
+
+from optim_esm_tools.analyze.io import load_glob
+from optim_esm_tools.config import config
+from optim_esm_tools.config import get_logger
+from optim_esm_tools.utils import atomic_publish
+
+# Bump the version of a stage if its output changes, this invalidates it and all downstream stages
+STAGE_VERSIONS = immutabledict(
+    merge='1',
+    regrid='1',
+    time_slice='1',
+    detrend='1',
+    running_mean='1',
+)
+
+
+class StageResult(ty.NamedTuple):
+    name: str
+    key: str
+    data_set: xr.Dataset
+
+
+def file_identity(path: ty.Optional[str]) -> ty.Optional[ty.Tuple[str, int, int]]:
+    """Identify a source file by its path, size and modification time.
+
+    Hashing the content of multi-GB files would defeat the purpose of
+    caching, so a file is considered unchanged if neither its size nor
+    mtime changed.
+    """
+    if path is None:
+        return None
+    stat = os.stat(path)
+    return os.path.abspath(path), stat.st_size, stat.st_mtime_ns
+
+
+def stage_cache_folder(
+    stage_cache: ty.Optional[str],
+    source: str,
+) -> ty.Optional[str]:
+    """Get the folder where to store stages.
+
+    Args:
+        stage_cache (str, optional): Either a folder, "source" (store next to the source file) or
+            "" (don't store stages). Defaults to None and is taken from the config.
+        source (str): path of the file that is pre-processed.
+    """
+    if stage_cache is None:
+        stage_cache = config['analyze'].get('pre_process_stage_cache', '').strip()
+    if not stage_cache:
+        return None
+    if stage_cache == 'source':
+        return os.path.join(
+            os.path.split(os.path.abspath(source))[0], 'pre_process_stages'
+        )
+    return os.path.expanduser(os.path.expandvars(stage_cache))
+
+
+class StageCache:
+    """Run stages of the pre-processing and store their output on disk.
+
+    If no folder is given, stages are just computed in memory.
+    """
+
+    def __init__(self, folder: ty.Optional[str] = None):
+        self.folder = folder
+        if folder is not None:
+            os.makedirs(folder, exist_ok=True)
+
+    @staticmethod
+    def key(
+        name: str,
+        params: ty.Mapping,
+        parents: ty.Sequence[StageResult] = (),
+    ) -> str:
+        doc = dict(
+            name=name,
+            version=STAGE_VERSIONS[name],
+            params=params,
+            parents=[p.key for p in parents],
+        )
+        as_str = json.dumps(doc, sort_keys=True, default=str)
+        return hashlib.sha1(as_str.encode()).hexdigest()[:16]
+
+    def path(self, name: str, key: str) -> ty.Optional[str]:
+        if self.folder is None:
+            return None
+        return os.path.join(self.folder, f'{name}_{key}.nc')
+
+    def run(
+        self,
+        name: str,
+        compute: ty.Callable[[], xr.Dataset],
+        params: ty.Mapping,
+        parents: ty.Sequence[StageResult] = (),
+        persist: bool = True,
+    ) -> StageResult:
+        """Get the output of a stage, from disk if available or otherwise
+        compute it.
+
+        Args:
+            name (str): name of the stage (see STAGE_VERSIONS)
+            compute (ty.Callable[[], xr.Dataset]): calculate the output of the stage
+            params (ty.Mapping): all parameters the output depends on (json serializable)
+            parents (ty.Sequence[StageResult], optional): stages this stage depends on.
+            persist (bool, optional): store the output on disk. Set to False for cheap (lazy)
+                stages, like selecting a time range. Defaults to True.
+
+        Returns:
+            StageResult: name, key and the output of the stage
+        """
+        key = self.key(name, params, parents)
+        path = self.path(name, key) if persist else None
+        if path is not None and os.path.exists(path):
+            get_logger().info(f'Reusing stage {name} from {path}')
+            return StageResult(name, key, load_glob(path))
+        data_set = compute()
+        if path is not None:
+            get_logger().info(f'Store stage {name} at {path}')
+            atomic_publish(data_set.to_netcdf, path, suffix='.nc')
+        return StageResult(name, key, data_set)
@@ -2,15 +2,24 @@ import os
 import shutil
 import tempfile
 import typing as ty
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
+import pandas as pd
+import xarray as xr
+from immutabledict import immutabledict
 
+from optim_esm_tools.analyze import grid_registry
+from optim_esm_tools.analyze import pipeline
+from optim_esm_tools.analyze import regrid
 from optim_esm_tools.analyze.globals import _DEFAULT_MAX_TIME
+from optim_esm_tools.analyze.io import file_info
 from optim_esm_tools.analyze.io import load_glob
+from optim_esm_tools.analyze.tools import rolling_mean
 from optim_esm_tools.analyze.xarray_tools import _native_date_fmt
 from optim_esm_tools.config import config
 from optim_esm_tools.config import get_logger
-from optim_esm_tools.utils import timed, check_accepts, to_str_tuple
+from optim_esm_tools.utils import timed, check_accepts, to_str_tuple, atomic_publish
 from pandas.util._decorators import deprecate_kwarg
 
 
@@ -70,7 +79,7 @@ def get_preprocessed_ds(
             **kw,
             _check_duplicate_years=_check_duplicate_years,
         )
-        ds = load_glob(intermediate_file)
+        ds = grid_registry.attach(load_glob(intermediate_file))
         if return_type == 'data_set':
             # After with close this "with", we lose the file, so load it just to be sure we have all we need
             ds = ds.load()  # type: ignore
@@ -101,13 +110,101 @@ def _year_mon_mean(input_file, output_file):
     cdo_int.yearmonmean(input=input_file, output=output_file)
 
 
-def save_nc(ds, path):
+# Chunking and compression for each role of a variable (see _variable_role). For the chunks, time is
+# the number of time steps and cells the number of cells along each of the lon/lat dimensions (None
+# for the full dimension).
+STORAGE_PROFILES = immutabledict(
+    # Reading (masked) time series of a few cells, like region_calculation does
+    timeseries=immutabledict(
+        field=immutabledict(time=None, cells=16, complevel=1, shuffle=True),
+        series=immutabledict(time=None, cells=16, complevel=1, shuffle=True),
+        map=immutabledict(time=None, cells=None, complevel=4, shuffle=True),
+    ),
+    # Reading full maps of single time steps, like plotting does
+    maps=immutabledict(
+        field=immutabledict(time=1, cells=None, complevel=1, shuffle=True),
+        series=immutabledict(time=1, cells=None, complevel=1, shuffle=True),
+        map=immutabledict(time=None, cells=None, complevel=4, shuffle=True),
+    ),
+    # Maps of the field, but time series of the derived (running mean, detrended) series
+    balanced=immutabledict(
+        field=immutabledict(time=1, cells=None, complevel=1, shuffle=True),
+        series=immutabledict(time=None, cells=16, complevel=1, shuffle=True),
+        map=immutabledict(time=None, cells=None, complevel=4, shuffle=True),
+    ),
+)
+
+
+def _variable_role(data_array: xr.DataArray) -> ty.Optional[str]:
+    """Get the role of data_array for STORAGE_PROFILES.
+
+    Returns:
+        ty.Optional[str]: "map" for fields without time (like the tipping criteria),
+            "series" for derived time series (detrended, running means), "field" for other
+            fields and None for variables that are not gridded (like time bounds).
+    """
+    lon_lat = config['analyze']['lon_lat_dim'].split(',')
+    if not any(d in data_array.dims for d in lon_lat):
+        return None
+    if 'time' not in data_array.dims:
+        return 'map'
+    name = str(data_array.name)
+    if '_run_mean_' in name or name.endswith('_detrend'):
+        return 'series'
+    return 'field'
+
+
+def _profile_encoding(data_array: xr.DataArray, profile: str) -> ty.Dict[str, ty.Any]:
+    if profile not in STORAGE_PROFILES:
+        raise ValueError(
+            f'profile should be one of {list(STORAGE_PROFILES)}, got {profile}',
+        )
+    role = _variable_role(data_array)
+    if role is None:
+        return dict(zlib=True, complevel=1)
+    setting = STORAGE_PROFILES[profile][role]
+    lon_lat = config['analyze']['lon_lat_dim'].split(',')
+    chunks = []
+    for dim, size in zip(data_array.dims, data_array.shape):
+        chunk = None
+        if dim == 'time':
+            chunk = setting['time']
+        elif dim in lon_lat:
+            chunk = setting['cells']
+        chunks.append(max(1, min(chunk or size, size)))
+    return dict(
+        zlib=True,
+        complevel=setting['complevel'],
+        shuffle=setting['shuffle'],
+        contiguous=False,
+        chunksizes=tuple(chunks),
+    )
+
+
+def save_nc(
+    ds: xr.Dataset,
+    path: str,
+    profile: ty.Optional[str] = None,
+    mode: str = 'w',
+) -> None:
+    """Write a compressed netCDF file, with the chunking and compression of
+    each variable set by its role (see STORAGE_PROFILES).
+
+    Args:
+        ds (xr.Dataset): dataset to store
+        path (str): destination
+        profile (str, optional): one of STORAGE_PROFILES ("timeseries", "maps" or
+            "balanced"). Defaults to None and is taken from the config.
+        mode (str, optional): "w" to (over)write path, "a" to add the variables of ds to the
+            file at path. Defaults to 'w'.
+    """
+    profile = profile or config['CMIP_files'].get('storage_profile', 'balanced')
     comp_kw = dict(
         format='NETCDF4',
         engine='netcdf4',
-        encoding={k: {'zlib': True, 'complevel': 1} for k in ds.data_vars},
+        encoding={k: _profile_encoding(v, profile) for k, v in ds.data_vars.items()},
     )
-    ds.to_netcdf(path, **comp_kw)
+    ds.to_netcdf(path, mode=mode, **comp_kw)
 
 
 def sanity_check(ds):
@@ -121,6 +218,7 @@ def sanity_check(ds):
         t_prev = t_cur
 
 
+@check_accepts(accepts=dict(engine=(None, 'cdo', 'numpy')))
 def pre_process(
     source: str,
     historical_path: ty.Optional[str] = None,
@@ -129,12 +227,15 @@ def pre_process(
     min_time: ty.Optional[ty.Tuple[int, int, int]] = None,
     save_as: ty.Optional[str] = None,
     clean_up: bool = True,
-    _ma_window: ty.Union[int, str, None] = None,
+    _ma_window: ty.Union[int, str, ty.Sequence[int], None] = None,
     variable_id: ty.Optional[str] = None,
     working_dir: ty.Optional[str] = None,
     _check_duplicate_years=True,
     do_detrend=True,
     do_running_mean=True,
+    engine: ty.Optional[str] = None,
+    time_chunk_size: ty.Optional[int] = None,
+    stage_cache: ty.Optional[str] = None,
 ) -> str:  # type: ignore
     """Apply several preprocessing steps to the file located at <source>:
 
@@ -155,8 +256,18 @@ def pre_process(
             load data. Defaults to None.
         save_as (str, optional): path where to store the pre-processed folder. Defaults to None.
         clean_up (bool, optional): delete intermediate files. Defaults to True.
-        _ma_window (int, optional): moving average window (assumed 10 years). Defaults to None.
+        _ma_window (int, optional): moving average window (assumed 10 years). Several windows
+            (like (10, 50)) are all stored as {variable_id}_run_mean_{window} (and detrended).
+            Defaults to None.
         variable_id (str, optional): Name of the variable of interest. Defaults to None.
+        engine (str, optional): Either "cdo" (write intermediate files using cdo) or "numpy"
+            (compute everything in memory and write the result once). Defaults to None and is
+            taken from config.
+        time_chunk_size (int, optional): For engine="numpy", regrid this many time steps at
+            once. Defaults to None and is taken from config (0 = all at once).
+        stage_cache (str, optional): For engine="numpy", store the intermediate stages in this
+            folder ("source" to store them next to the source) and reuse them for other
+            parameters. Defaults to None and is taken from config ("" = disabled).
 
     Raises:
         ValueError: If source and dest are the same, we'll run into problems
@@ -165,11 +276,6 @@ def pre_process(
         str: path of the dest file (same provided, if any)
     """
 
-    import cdo
-
-    _remove_bad_vars(source)
-    if historical_path is not None:
-        _remove_bad_vars(historical_path)
     variable_id = variable_id or _read_variable_id(source)
     use_max_time = max_time or (9999, 12, 30)  # unreasonably far away
     use_min_time = min_time or (0, 1, 1)  # unreasonably long ago
@@ -177,22 +283,42 @@ def pre_process(
     do_regrid = target_grid != False
     target_grid = target_grid or config['analyze']['regrid_to']
 
-    _ma_window = _ma_window or config['analyze']['moving_average_years']
-    _check_time_range(source, use_max_time, use_min_time, _ma_window)
+    ma_windows = _ma_windows(_ma_window or config['analyze']['moving_average_years'])
+    _check_time_range(source, use_max_time, use_min_time, max(ma_windows))
 
-    cdo_int = cdo.Cdo()
     head, _ = os.path.split(source)
     working_dir = working_dir or head
+    engine = engine or config['analyze']['pre_process_engine']
+    if engine == 'numpy':
+        return _pre_process_numpy(
+            source=source,
+            historical_path=historical_path,
+            target_grid=target_grid if do_regrid else False,
+            max_time=max_time,
+            min_time=min_time,
+            save_as=save_as or os.path.join(working_dir, 'result.nc'),
+            _ma_window=ma_windows,
+            variable_id=variable_id,
+            _check_duplicate_years=_check_duplicate_years,
+            do_detrend=do_detrend,
+            do_running_mean=do_running_mean,
+            time_chunk_size=time_chunk_size,
+            stage_cache=stage_cache,
+        )
+
+    import cdo
+
+    cdo_int = cdo.Cdo()
 
     # Several intermediate_files
     f_time = os.path.join(working_dir, 'time_sel.nc')
-    f_tmp = os.path.join(working_dir, 'tmp.nc')
     f_regrid = os.path.join(working_dir, 'regrid.nc')
     f_area = os.path.join(working_dir, 'area.nc')
     f_det = os.path.join(working_dir, 'detrend.nc')
-    f_rm = os.path.join(working_dir, f'rm_{_ma_window}.nc')
-    f_det_rm = os.path.join(working_dir, f'detrend_rm_{_ma_window}.nc')
-    files = [f_time, f_det, f_det_rm, f_rm, f_tmp, f_regrid, f_area]
+    f_rms = [os.path.join(working_dir, f'rm_{w}.nc') for w in ma_windows]
+    f_det_rms = [os.path.join(working_dir, f'detrend_rm_{w}.nc') for w in ma_windows]
+    f_tmps = [os.path.join(working_dir, f'tmp_{w}.nc') for w in ma_windows]
+    files = [f_time, f_det, *f_det_rms, *f_rms, *f_tmps, f_regrid, f_area]
 
     save_as = save_as or os.path.join(working_dir, 'result.nc')
 
@@ -205,63 +331,115 @@ def pre_process(
         if os.path.exists(p):  # pragma: no cover
             get_logger().warning(f'Removing {p}!')
             os.remove(p)
+    next_source = source
+    # Variables that should not be read from the source, these are skipped by chaining -delname
+    drop_vars = _bad_vars(source)
+    time_range = f'{_fmt_date(use_min_time)},{_fmt_date(use_max_time)}'
+    select_dates = None
     if historical_path:
+        # Merge and select the time range in one go, the merged record is never written
         _remap_and_merge(
             cdo_int,
             cdo,
-            historical_path,
-            source,
+            _cdo_drop_vars(historical_path, _bad_vars(historical_path)),
+            _cdo_drop_vars(source, drop_vars),
             target_grid,
-            working_dir,
-            f_tmp,
+            time_range,
+            f_time,
         )
-        source = f_tmp
-    if _check_duplicate_years:
-        _remove_duplicate_time_stamps(source)
-
-    next_source = source
-    if min_time is not None or max_time is not None:
-        time_range = f'{_fmt_date(use_min_time)},{_fmt_date(use_max_time)}'
-        cdo_int.seldate(time_range, input=next_source, output=f_time)  # type: ignore
         next_source = f_time
+        drop_vars = []
+        if _check_duplicate_years:
+            _remove_duplicate_time_stamps(next_source)
+    else:
+        if _check_duplicate_years:
+            _remove_duplicate_time_stamps(source)
+        if (min_time is not None or max_time is not None) and do_regrid:
+            # Push the time selection into the regridding, time_sel.nc is not written
+            select_dates = time_range
+        elif min_time is not None or max_time is not None:
+            cdo_int.seldate(
+                time_range,
+                input=_cdo_drop_vars(next_source, drop_vars),
+                output=f_time,
+            )  # type: ignore
+            next_source = f_time
+            drop_vars = []
 
     if do_regrid:
-        cdo_int.remapbil(target_grid, input=next_source, output=f_regrid)  # type: ignore
-        cdo_int.gridarea(input=f_regrid, output=f_area)  # type: ignore
-        input_files = [f_regrid, f_area]
+        regrid.cdo_remapbil(
+            cdo_int,
+            target_grid,  # type: ignore
+            input=next_source,
+            output=f_regrid,
+            variable_id=var,
+            select_dates=select_dates,
+            drop_vars=drop_vars,
+        )
+        input_files = [f_regrid]
     else:
         input_files = [f_regrid]
-        os.rename(next_source, f_regrid)
-    next_source = f_regrid
-
-    if do_detrend:
-        var_det = f'{var}_detrend'
-        cdo_int.detrend(input=next_source, output=f_tmp)  # type: ignore
-        cdo_int.chname(f'{var},{var_det}', input=f_tmp, output=f_det)  # type: ignore
-        os.remove(f_tmp)
-        input_files += [f_det]
-
-    if do_running_mean:
-        var_rm = f'{var}_run_mean_{_ma_window}'
-        cdo_int.runmean(_ma_window, input=f_regrid, output=f_tmp)  # type: ignore
-        _run_mean_patch(
-            f_start=f_regrid,
-            f_rm=f_tmp,
-            f_out=f_rm,
-            ma_window=_ma_window,
-            var_name=var,
-            var_rm_name=var_rm,
-        )
-        os.remove(f_tmp)
-        input_files += [f_rm]
-
-    if do_running_mean and do_detrend:
-        var_det_rm = f'{var_det}_run_mean_{_ma_window}'
-        cdo_int.detrend(input=f_rm, output=f_tmp)  # type: ignore
-        cdo_int.chname(f'{var_rm},{var_det_rm}', input=f_tmp, output=f_det_rm)  # type: ignore
-        input_files += [f_det_rm]
+        if drop_vars:
+            cdo_int.delname(','.join(drop_vars), input=next_source, output=f_regrid)  # type: ignore
+        else:
+            os.rename(next_source, f_regrid)
+
+    # The registry area is the exact area of the cells between their latitude bounds (as used by
+    # the numpy engine), cdo gridarea only agrees with it to ~1e-3. For these grids, gridarea is
+    # not run, and the cell_area is attached from the registry when the result is loaded.
+    use_registry = do_regrid and grid_registry.is_supported(target_grid)
+
+    # gridarea, detrend and runmean only read f_regrid, so they can run concurrently (each cdo
+    # call is a subprocess). The detrended running mean is done after the running mean.
+    var_det = f'{var}_detrend'
+    n_threads = max(1, int(config['analyze']['pre_process_threads']))
+    with ThreadPoolExecutor(max_workers=n_threads) as pool:
+        jobs = []
+        if do_regrid and not use_registry:
+            jobs.append(pool.submit(cdo_int.gridarea, input=f_regrid, output=f_area))
+            input_files += [f_area]
+        if do_detrend:
+            jobs.append(
+                pool.submit(_cdo_detrend, cdo_int, f_regrid, f_det, var, var_det),
+            )
+            input_files += [f_det]
+        for window, f_rm, f_det_rm, f_tmp_rm in zip(
+            ma_windows,
+            f_rms,
+            f_det_rms,
+            f_tmps,
+        ):
+            if not do_running_mean:
+                break
+            var_rm = f'{var}_run_mean_{window}'
+            var_det_rm = f'{var_det}_run_mean_{window}'
+            jobs.append(
+                pool.submit(
+                    _cdo_running_mean,
+                    cdo_int,
+                    f_regrid,
+                    f_tmp_rm,
+                    f_rm,
+                    window,
+                    var,
+                    var_rm,
+                    detrend_to=(f_det_rm, var_det_rm) if do_detrend else None,
+                ),
+            )
+            input_files += [f_rm]
+            if do_detrend:
+                input_files += [f_det_rm]
+        for job in jobs:
+            job.result()
     get_logger().info(f'Join {input_files} to {save_as}')
-    cdo_int.merge(input=' '.join(input_files), output=save_as)  # type: ignore
+    if use_registry:
+        cdo_int.setattribute(  # type: ignore
+            f'grid_registry={target_grid}',
+            input=f'-merge {" ".join(input_files)}',
+            output=save_as,
+        )
+    else:
+        cdo_int.merge(input=' '.join(input_files), output=save_as)  # type: ignore
 
     if clean_up:  # pragma: no cover
         for p in files:
@@ -270,6 +448,327 @@ def pre_process(
     return save_as
 
 
+def _cdo_detrend(cdo_int, f_in: str, f_out: str, var: str, var_det: str) -> None:
+    cdo_int.chname(f'{var},{var_det}', input=f'-detrend {f_in}', output=f_out)  # type: ignore
+
+
+def _cdo_running_mean(
+    cdo_int,
+    f_in: str,
+    f_tmp: str,
+    f_out: str,
+    ma_window: ty.Union[int, str],
+    var: str,
+    var_rm: str,
+    detrend_to: ty.Optional[ty.Tuple[str, str]] = None,
+) -> None:
+    """Calculate the running mean (patched to the length of f_in), and
+    optionally detrend it, writing to detrend_to=(path, variable_name)."""
+    cdo_int.runmean(ma_window, input=f_in, output=f_tmp)  # type: ignore
+    _run_mean_patch(
+        f_start=f_in,
+        f_rm=f_tmp,
+        f_out=f_out,
+        ma_window=ma_window,
+        var_name=var,
+        var_rm_name=var_rm,
+    )
+    os.remove(f_tmp)
+    if detrend_to is not None:
+        _cdo_detrend(cdo_int, f_out, detrend_to[0], var_rm, detrend_to[1])
+
+
+def _pre_process_numpy(
+    source: str,
+    historical_path: ty.Optional[str],
+    target_grid: ty.Union[str, bool],
+    max_time: ty.Optional[ty.Tuple[int, ...]],
+    min_time: ty.Optional[ty.Tuple[int, ...]],
+    save_as: str,
+    _ma_window: ty.Union[int, ty.Sequence[int]],
+    variable_id: str,
+    _check_duplicate_years: bool = True,
+    do_detrend: bool = True,
+    do_running_mean: bool = True,
+    time_chunk_size: ty.Optional[int] = None,
+    stage_cache: ty.Optional[str] = None,
+) -> str:
+    """In-memory equivalent of the cdo chain in pre_process.
+
+    Runs seldate, remapbil, gridarea, detrend, runmean, chname and merge on
+    the data without writing any intermediate files. Only the result is
+    written to save_as, unless a stage cache is used (see
+    analyze.pipeline), in which case the (expensive) stages are stored
+    and reused for other parameters.
+    """
+    if os.path.exists(save_as):  # pragma: no cover
+        get_logger().warning(f'Removing {save_as}!')
+        os.remove(save_as)
+    if time_chunk_size is None:
+        time_chunk_size = int(config['analyze']['pre_process_time_chunks']) or None
+    var = variable_id
+    ma_windows = _ma_windows(_ma_window)
+    stages = pipeline.StageCache(pipeline.stage_cache_folder(stage_cache, source))
+
+    merged = stages.run(
+        'merge',
+        lambda: _merge_stage(source, historical_path, _check_duplicate_years),
+        params=dict(
+            source=pipeline.file_identity(source),
+            historical=pipeline.file_identity(historical_path),
+            check_duplicates=_check_duplicate_years,
+        ),
+        persist=False,
+    )
+
+    def regrid_stage(parent: pipeline.StageResult) -> pipeline.StageResult:
+        return stages.run(
+            'regrid',
+            lambda: _regrid_stage(parent.data_set, var, target_grid, time_chunk_size),
+            params=dict(variable=var, target_grid=target_grid),
+            parents=[parent],
+            persist=bool(target_grid),
+        )
+
+    def time_slice_stage(parent: pipeline.StageResult) -> pipeline.StageResult:
+        return stages.run(
+            'time_slice',
+            lambda: _select_time_range(parent.data_set, min_time, max_time),
+            params=dict(min_time=min_time, max_time=max_time),
+            parents=[parent],
+            persist=False,
+        )
+
+    if stages.folder is None:
+        # Push the time selection down, the (lazy) source is only read for the requested range
+        sliced = regrid_stage(time_slice_stage(merged))
+    else:
+        # Regrid the full record, such that it can be reused for other time ranges
+        sliced = time_slice_stage(regrid_stage(merged))
+    parts = [sliced.data_set]
+    if do_detrend:
+        detrended = stages.run(
+            'detrend',
+            lambda: _detrend_stage(sliced.data_set, var, f'{var}_detrend'),
+            params=dict(variable=var),
+            parents=[sliced],
+        )
+        parts.append(detrended.data_set)
+    if do_running_mean:
+        var_rms = {w: f'{var}_run_mean_{w}' for w in ma_windows}
+        running_mean = stages.run(
+            'running_mean',
+            lambda: _running_mean_stage(sliced.data_set, var, var_rms),
+            params=dict(
+                variable=var,
+                window=ma_windows[0] if len(ma_windows) == 1 else list(ma_windows),
+            ),
+            parents=[sliced],
+        )
+        parts.append(running_mean.data_set)
+    for window in ma_windows if do_running_mean and do_detrend else ():
+        var_rm = f'{var}_run_mean_{window}'
+        var_det_rm = f'{var}_detrend_run_mean_{window}'
+        detrended_rm = stages.run(
+            'detrend',
+            lambda: _detrend_stage(running_mean.data_set, var_rm, var_det_rm),
+            params=dict(variable=var_rm),
+            parents=[running_mean],
+        )
+        parts.append(detrended_rm.data_set)
+
+    result = xr.merge(parts, compat='override', combine_attrs='override')
+    get_logger().info(f'Write {list(result.data_vars)} to {save_as}')
+    result.to_netcdf(save_as)
+    return save_as
+
+
+def _merge_stage(
+    source: str,
+    historical_path: ty.Optional[str],
+    _check_duplicate_years: bool,
+) -> xr.Dataset:
+    ds = load_glob(source, drop_variables=_bad_vars(source))
+    if historical_path:
+        ds = _concat_in_time(
+            load_glob(historical_path, drop_variables=_bad_vars(historical_path)),
+            ds,
+        )
+    if _check_duplicate_years:
+        ds = _drop_duplicate_time_stamps_in_memory(ds)
+    return ds
+
+
+def _regrid_stage(
+    ds: xr.Dataset,
+    var: str,
+    target_grid: ty.Union[str, bool],
+    time_chunk_size: ty.Optional[int],
+) -> xr.Dataset:
+    """Regrid var and add the cell_area (like cdo remapbil and gridarea).
+
+    Variables without spatial dimensions (such as time_bnds) are kept.
+    """
+    if not target_grid:
+        return ds
+    da = regrid.regrid_bilinear(ds[var], target_grid, time_chunk_size=time_chunk_size)
+    result = xr.Dataset(coords=da.coords, attrs=ds.attrs)
+    result[var] = da.astype(ds[var].dtype)
+    result['cell_area'] = (
+        grid_registry.get_grid(target_grid)
+        .area_data_array()
+        .assign_coords(lat=result['lat'], lon=result['lon'])
+    )
+    spatial_dims = set(ds[var].dims) - {'time'}
+    for name, other in ds.data_vars.items():
+        if name in result or 'time' not in other.dims or spatial_dims & set(other.dims):
+            continue
+        result[name] = other
+    return result
+
+
+def _detrend_stage(ds: xr.Dataset, var: str, rename_to: str) -> xr.Dataset:
+    da = ds[var]
+    values = _detrend_nan(
+        da.values.astype(np.float64),
+        _time_axis_in_days(da['time'].values),
+    )
+    return da.copy(data=values.astype(da.dtype)).rename(rename_to).to_dataset()
+
+
+def _running_mean_stage(
+    ds: xr.Dataset,
+    var: str,
+    rename_to: ty.Mapping[int, str],
+) -> xr.Dataset:
+    """Running means of var for each window, stored as rename_to[window]."""
+    da = ds[var]
+    means = _running_means_nan(da.values.astype(np.float64), tuple(rename_to))
+    return xr.Dataset(
+        {
+            name: da.copy(data=values.astype(da.dtype)).rename(name)
+            for name, values in zip(rename_to.values(), means)
+        },
+    )
+
+
+def _concat_in_time(ds_first: xr.Dataset, ds_second: xr.Dataset) -> xr.Dataset:
+    """Lazily concatenate two datasets in time (like cdo mergetime).
+
+    Overlap is resolved on the time index only, no data is read: time
+    stamps that occur in both datasets are taken from ds_first, which is
+    the same as merging the files and dropping the duplicates afterwards.
+    """
+    n_first = len(ds_first['time'])
+    times = np.concatenate([ds_first['time'].values, ds_second['time'].values])
+    order = np.argsort(times, kind='stable')
+    _, first_occurrence = np.unique(times[order], return_index=True)
+    keep = order[first_occurrence]
+    if (n_dropped := len(times) - len(keep)) > 0:
+        get_logger().info(f'Dropping {n_dropped} overlapping time stamps')
+    ds = xr.concat(
+        [
+            ds_first.isel(time=keep[keep < n_first]),
+            ds_second.isel(time=keep[keep >= n_first] - n_first),
+        ],
+        dim='time',
+        data_vars='minimal',
+        coords='minimal',
+        compat='override',
+    )
+    if not ds.indexes['time'].is_monotonic_increasing:
+        ds = ds.isel(time=np.argsort(ds['time'].values, kind='stable'))
+    return ds
+
+
+def _drop_duplicate_time_stamps_in_memory(ds: xr.Dataset) -> xr.Dataset:
+    """Similar to _remove_duplicate_time_stamps, but without touching any
+    file on disk."""
+    t_len = len(ds['time'])
+    if t_len <= 1:
+        raise ValueError(f'No time length in {ds.attrs.get("file", "dataset")}')
+    t_span = ds['time'].values[-1].year - ds['time'].values[0].year
+    if t_len > t_span + 1:
+        get_logger().warning(
+            f'Finding {t_len} timestamps in {t_span} years - removing duplicates',
+        )
+        ds = ds.drop_duplicates('time')
+        if (t_new_len := len(ds['time'])) > t_span + 1:
+            raise ValueError(f'{t_new_len} too long! Started with {t_len} and {t_span}')
+    return ds
+
+
+def _select_time_range(
+    ds: xr.Dataset,
+    min_time: ty.Optional[ty.Tuple[int, ...]],
+    max_time: ty.Optional[ty.Tuple[int, ...]],
+) -> xr.Dataset:
+    """Select time range similar to cdo seldate (both dates are inclusive,
+    the end date includes the full day)."""
+    times = ds['time'].values
+    mask = np.ones(len(times), dtype=np.bool_)
+    if min_time is not None:
+        mask &= times >= _native_date_fmt(times, tuple(min_time))
+    if max_time is not None:
+        mask &= times <= _native_date_fmt(times, (*max_time, 23, 59, 59))
+    if mask.all():
+        return ds
+    return ds.isel(time=np.argwhere(mask)[:, 0])
+
+
+def _time_axis_in_days(times: np.ndarray) -> np.ndarray:
+    """Time since the first time stamp in days."""
+    seconds = pd.to_timedelta(times - times[0]).total_seconds()
+    return np.asarray(seconds, dtype=np.float64) / 86400
+
+
+def _detrend_nan(values: np.ndarray, t: np.ndarray) -> np.ndarray:
+    """Remove the linear trend of each time series (first axis), ignoring
+    NaN values (like cdo detrend)."""
+    valid = ~np.isnan(values)
+    x = np.where(valid, values, 0).astype(np.float64)
+    t_b = np.where(valid, t.reshape(-1, *[1] * (values.ndim - 1)), 0)
+    n = valid.sum(axis=0)
+    s_t = t_b.sum(axis=0)
+    s_tt = (t_b**2).sum(axis=0)
+    s_x = x.sum(axis=0)
+    s_tx = (t_b * x).sum(axis=0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        b = (n * s_tx - s_t * s_x) / (n * s_tt - s_t**2)
+        a = (s_x - b * s_t) / n
+    return values - (a + b * t.reshape(-1, *[1] * (values.ndim - 1)))
+
+
+def _running_mean_nan(values: np.ndarray, window: int) -> np.ndarray:
+    """Running mean along the first axis, ignoring NaN values (like cdo
+    runmean), patched to the original length as in _run_mean_patch."""
+    return _running_means_nan(values, (window,))[0]
+
+
+def _running_means_nan(
+    values: np.ndarray,
+    windows: ty.Sequence[int],
+) -> ty.List[np.ndarray]:
+    """Like _running_mean_nan for each of the windows, all from the same
+    prefix sums (see tools.rolling_mean)."""
+    return list(rolling_mean(values, windows))
+
+
+def _ma_windows(
+    ma_window: ty.Union[int, str, ty.Sequence[int]],
+) -> ty.Tuple[int, ...]:
+    """Get the moving average window(s) as a tuple of ints, the first being
+    the main window (e.g. 10, "10 50" or (10, 50))."""
+    if isinstance(ma_window, str):
+        ma_window = ma_window.replace(',', ' ').split()
+    if isinstance(ma_window, (int, np.integer)):
+        ma_window = (ma_window,)
+    windows = tuple(int(w) for w in ma_window)
+    if not windows or len(set(windows)) != len(windows):
+        raise ValueError(f'Got no or duplicate windows {ma_window}')
+    return windows
+
+
 def _quick_drop_duplicates(ds, t_span, t_len, path):
     ds = ds.drop_duplicates('time')
     if (t_new_len := len(ds['time'])) > t_span + 1:
@@ -283,51 +782,83 @@ def _quick_drop_duplicates(ds, t_span, t_len, path):
         shutil.copy2(save_as, path)
 
 
-def _drop_duplicates_carefully(ds, t_span, t_len, path):
-    from tqdm import tqdm
-
+def _unique_time_indices(times: np.ndarray) -> np.ndarray:
+    """Indices of the first occurrence of each time stamp (in the original
+    order), like ds.drop_duplicates('time')."""
+    _, first_occurrence = np.unique(times, return_index=True)
+    return np.sort(first_occurrence)
+
+
+def _drop_duplicates_carefully(ds, t_span, t_len, path, keep=None):
+    """Stream the unique time stamps of ds into a single new file in large
+    time-chunks, such that memory usage is bounded, and replace path with
+    it."""
+    if keep is None:
+        keep = _unique_time_indices(ds['time'].values)
+    bytes_per_step = max(ds.nbytes / max(t_len, 1), 1)
+    chunk_mb = float(config['analyze']['duplicate_repair_chunk_mb'])
+    time_chunk = max(1, int(chunk_mb * 1e6 / bytes_per_step))
+    get_logger().warning(
+        f'Streaming {len(keep)}/{t_len} time stamps in chunks of {time_chunk}',
+    )
     # As we only do this for huge datasets, it might be that /tmp doesn't allow storing sufficient data.
     work_dir = os.path.split(path)[0]
     with tempfile.TemporaryDirectory(dir=work_dir) as temp_dir:
-        keep_years = np.argwhere(np.diff([t.year for t in ds['time'].values]) == 1)[
-            :,
-            0,
-        ]
-        keep_years = [0] + [int(i) + 1 for i in keep_years]
-        saves = []
-        for i in tqdm(keep_years):
-            save_as = os.path.join(temp_dir, f'temp_{i}.nc')
-            saves.append(save_as)
-            ds.isel(time=slice(i, i + 1)).load().to_netcdf(save_as)
-        # move the old file
         _tempf = os.path.join(temp_dir, 'temp_merge.nc')
-        get_logger().warning(f'Merging {saves} -> {_tempf}')
-        _merge_sources(saves, _tempf)
-        ds = load_glob(_tempf)
-        if (t_new_len := len(ds['time'])) > t_span + 1:
+        ds.isel(time=keep).chunk(dict(time=time_chunk)).to_netcdf(_tempf)
+        if (t_new_len := len(load_glob(_tempf)['time'])) > t_span + 1:
             raise ValueError(
                 f'{t_new_len} too long! Started with {t_len} and {t_span}',
             )
         get_logger().warning('Timestamp issue solved')
 
+        ds.close()
         os.rename(path, os.path.join(os.path.split(path)[0], 'faulty_merged.nc'))
         os.rename(_tempf, path)
     get_logger().warning(f'_remove_duplicate_time_stamps - > Fixed!')
 
 
-def _remove_duplicate_time_stamps(path):  # pragma: no cover
-    ds = load_glob(path)
-    t_len = len(ds['time'])
+def _remove_duplicate_time_stamps(
+    path: str,
+    dry_run: bool = False,
+) -> ty.Optional[ty.Dict[str, ty.Any]]:  # pragma: no cover
+    """Remove duplicate time stamps from the file at path (the faulty file is
+    kept as faulty_merged.nc).
+
+    Args:
+        path (str): file to repair
+        dry_run (bool, optional): Only report what would be dropped. Defaults to False.
+
+    Returns:
+        ty.Optional[ty.Dict[str, ty.Any]]: If dry_run, the number of time stamps, and which would
+            be dropped.
+    """
+    info = file_info(path)
+    times = info.times
+    t_len = info.n_time
     if t_len <= 1:
         raise ValueError(f'No time length in {path}')
-    if t_len > (t_span := (ds['time'].values[-1].year - ds['time'].values[0].year)) + 1:
+    t_span = info.year_span
+    keep = _unique_time_indices(times)
+    if dry_run:
+        drop = np.setdiff1d(np.arange(t_len), keep)
+        return dict(
+            n_time=t_len,
+            n_drop=len(drop),
+            drop_indices=drop.tolist(),
+            drop_times=[str(t) for t in times[drop]],
+            needs_repair=t_len > t_span + 1,
+        )
+    if t_len > t_span + 1:
         get_logger().warning(
             f'Finding {t_len} timestamps in {t_span} years - removing duplicates',
         )
-        if ds.nbytes / 1e6 < 1_000:
+        ds = load_glob(path)
+        if info.nbytes / 1e6 < 1_000:
             _quick_drop_duplicates(ds, t_span, t_len, path)
         else:
-            _drop_duplicates_carefully(ds, t_span, t_len, path)
+            _drop_duplicates_carefully(ds, t_span, t_len, path, keep=keep)
+    return None
 
 
 def _remap_and_merge(
@@ -336,79 +867,91 @@ def _remap_and_merge(
     historical_path: str,
     source: str,
     target_grid: ty.Union[bool, str],
-    working_dir: str,
-    f_tmp: str,
+    time_range: str,
+    output: str,
 ) -> None:  # pragma: no cover
-    """The function `_remap_and_merge` merges two input files,
-    `historical_path` and `source`, and if an exception occurs, it regrids the
-    files and tries again.
-
-    :param cdo_int: The `cdo_int` parameter is an instance of the `cdo` module, which is used for
-    executing CDO commands in Python
-    :param cdo: The `cdo` parameter is an instance of the `cdo.Cdo` class. It is used to interact with
-    the Climate Data Operators (CDO) library, which provides a collection of command-line tools for
-    working with climate and weather data
-    :param historical_path: The `historical_path` parameter is a string that represents the path to a
-    file containing historical data
-    :type historical_path: str
-    :param source: The `source` parameter is a string that represents the path to the source file that
-    needs to be merged with the `historical_path` file
-    :type source: str
-    :param target_grid: The `target_grid` parameter is a string that specifies the path to the target
-    grid file. It is used in the `remapbil` function to regrid the input data to the target grid before
-    merging
-    :type target_grid: str
-    :param working_dir: The `working_dir` parameter is a string that represents the directory where
-    temporary files will be stored during the execution of the `_remap_and_merge` function
-    :type working_dir: str
-    :param f_tmp: The `f_tmp` parameter is a string that represents the path to the output file where
-    the merged data will be saved
-    :type f_tmp: str
+    """Merge historical_path and source in time and select the time_range.
+
+    The merge is chained into the time selection (cdo -seldate -mergetime) such that the full
+    merged record is never written to disk. If the files cannot be merged (e.g. due to different
+    grids), both are regridded (again chained) before merging.
+
+    Args:
+        cdo_int: cdo.Cdo instance
+        cdo: the cdo module
+        historical_path (str): path of the historical file
+        source (str): path of the scenario file
+        target_grid (ty.Union[bool, str]): grid to regrid to if the files cannot be merged
+        time_range (str): date range "YYYY-MM-DD,YYYY-MM-DD" to select
+        output (str): where to write the result
     """
     try:
-        cdo_int.mergetime(input=[historical_path, source], output=f_tmp)
+        cdo_int.seldate(
+            time_range,
+            input=f'-mergetime {historical_path} {source}',
+            output=output,
+        )
     except cdo.CDOException as e:  # pragma: no cover
         get_logger().error(f"Ran into {e}, let's regrid first and retry")
         if target_grid == False:
             raise ValueError(
                 f'Cannot merge {historical_path} and {source} since target grid is False and we ran into {e}',
             ) from e
-        cdo_int.remapbil(
-            target_grid,
-            input=historical_path,
-            output=(_a := os.path.join(working_dir, '_a.nc')),
-        )
-        cdo_int.remapbil(
-            target_grid,
-            input=source,
-            output=(_b := os.path.join(working_dir, '_b.nc')),
+        remap = f'-remapbil,{target_grid}'
+        cdo_int.seldate(
+            time_range,
+            input=f'-mergetime {remap} {historical_path} {remap} {source}',
+            output=output,
         )
-        cdo_int.mergetime(input=[_a, _b], output=f_tmp)
 
 
-def _remove_bad_vars(path):
-    """The function `_remove_bad_vars` removes specified variables from a
-    dataset and replaces the original file with the modified dataset.
+def _bad_vars(path: str) -> ty.List[str]:
+    """Variables in the file at path that should not be read (see [analyze]
+    remove_vars in the config)."""
+    to_delete = config['analyze']['remove_vars'].split()
+    present = [var for var in to_delete if var in file_info(path).data_vars]
+    if present:
+        get_logger().info(f'Skipping {present} while reading {path}')
+    return present
+
+
+def _cdo_drop_vars(path: str, drop_vars: ty.Sequence[str]) -> str:
+    """Chain -delname to a cdo input, such that drop_vars are never read."""
+    if not drop_vars:
+        return path
+    return f'-delname,{",".join(drop_vars)} {path}'
+
 
-    :param path: The `path` parameter is a string that represents the file path to the dataset that
-    needs to be processed
+def _remove_bad_vars(path: str, save_as: ty.Optional[str] = None) -> ty.List[str]:
+    """Physically remove the variables in [analyze] remove_vars from the file
+    at path.
+
+    pre_process does not need this, as it never reads these variables.
+    The data is copied in time-chunks, so the full dataset is never
+    loaded into memory, and the new file is only moved in place once it
+    is complete.
+
+    Args:
+        path (str): file to remove the variables from
+        save_as (str, optional): write the result here instead of replacing path. Defaults to
+            None.
+
+    Returns:
+        ty.List[str]: the removed variables
     """
-    log = get_logger()
-    to_delete = config['analyze']['remove_vars'].split()
-    ds = load_glob(path)
-    drop_any = False
-    for var in to_delete:  # pragma: no cover
-        if var in ds.data_vars:
-            log.warning(f'{var} in dataset from {path}')
-            drop_any = True
-            ds = ds.load()
-            ds = ds.drop_vars(var)
-    if drop_any:  # pragma: no cover
-        log.error(f'Replacing {path} after dropping at least one of {to_delete}')
-        os.remove(path)
-        ds.to_netcdf(path)
-        if not os.path.exists(path):
-            raise RuntimeError(f'Data loss, somehow {path} got removed!')
+    present = _bad_vars(path)
+    if not present and save_as is None:
+        return present
+    ds = load_glob(path, drop_variables=present)
+    if 'time' in ds.dims:
+        bytes_per_step = max(ds.nbytes / max(ds.sizes['time'], 1), 1)
+        chunk_mb = float(config['analyze']['duplicate_repair_chunk_mb'])
+        ds = ds.chunk(dict(time=max(1, int(chunk_mb * 1e6 / bytes_per_step))))
+    save_as = save_as or path
+    get_logger().warning(f'Writing {path} without {present} to {save_as}')
+    atomic_publish(ds.to_netcdf, save_as, suffix='.nc')
+    ds.close()
+    return present
 
 
 def _check_time_range(path, max_time, min_time, ma_window):
@@ -426,8 +969,7 @@ def _check_time_range(path, max_time, min_time, ma_window):
     max_time]`) in order to proceed with the calculation of the moving average. If the number of time
     stamps within the time
     """
-    ds = load_glob(path)
-    times = ds['time'].values
+    times = file_info(path).times
     time_mask = times < _native_date_fmt(times, max_time)
     if min_time != (0, 1, 1):
         # CF time does not always support year 0
@@ -490,7 +1032,7 @@ def _read_variable_id(path):
     :return: the value of the 'variable_id' attribute from the file located at the given path.
     """
     try:
-        return load_glob(path).attrs['variable_id']
+        return file_info(path).attrs['variable_id']
     except KeyError as e:  # pragma: no cover
         message = f'When reading the variable_id from {path}, it appears no such information is available'
         raise KeyError(message) from e
@@ -1,5 +1,6 @@
 import optim_esm_tools as oet
 import numpy as np
+import pandas as pd
 
 import typing as ty
 
@@ -10,7 +11,7 @@ from optim_esm_tools.analyze.tools import (
     weighted_mean_array,
     _weighted_mean_array_numba,
     running_mean,
-    running_mean_array,
+    rolling_mean_summary,
 )
 import scipy
 
@@ -25,6 +26,10 @@ class RegionPropertyCalculator:
      - The region of interest (mask)
     """
 
+    # Running means (besides _rm_years) used by the metrics. If ds_global has these pre-processed
+    # (see read_ds(_ma_window=(10, 50))), they are read instead of recalculated.
+    _rm_alt_years: ty.Tuple[int, ...] = (50,)
+
     def __init__(
         self,
         ds_global: xr.Dataset,
@@ -61,14 +66,25 @@ class RegionPropertyCalculator:
         da_mask = self.mask_to_da(mask)
         self.da_mask: xr.DataArray = da_mask
         kw = dict(mask=da_mask, add_global_mask=False)
-        _common_keys = [
-            self.field_rm,
+        _coords = [
             "time",
-            "cell_area",
             *oet.config.config["analyze"]["lon_lat_dim"].split(","),
         ]
-        keep_keys_sc = [self.field, *_common_keys]
-        keep_keys_pi = [self.field_detrend_rm, f"{self.field}_detrend", *_common_keys]
+        keep_keys_sc = [*self.required_variables(self.field, _rm_years), *_coords]
+        keep_keys_pi = [
+            *self.required_variables(self.field, _rm_years, pi_control=True),
+            *_coords,
+        ]
+        # Optional, only if pre-processed
+        keep_keys_sc += [
+            k
+            for k in self.required_variables(
+                self.field,
+                _rm_years,
+                alt_running_means=True,
+            )
+            if k not in keep_keys_sc and k in ds_global
+        ]
 
         self.ds_local = ds_local or oet.analyze.xarray_tools.mask_to_reduced_dataset(
             self.ds_global,
@@ -85,6 +101,41 @@ class RegionPropertyCalculator:
         )
         self._cache: ty.Dict[str, ty.Any] = dict()
 
+    @classmethod
+    def required_variables(
+        cls,
+        variable: str,
+        running_mean: int,
+        pi_control: bool = False,
+        alt_running_means: bool = False,
+    ) -> ty.Tuple[str, ...]:
+        """Variables (besides the coordinates) read from ds_global, or from ds_pi if pi_control
+
+        If alt_running_means, include the (optional) pre-processed running means of _rm_alt_years.
+        These are not used for ds_pi, as the metrics use the running mean of the detrended field,
+        which is not the same as the detrended running mean.
+        """
+        running_mean_field = f"{variable}_run_mean_{running_mean}"
+        if pi_control:
+            return (
+                f"{variable}_detrend_run_mean_{running_mean}",
+                f"{variable}_detrend",
+                running_mean_field,
+                "cell_area",
+            )
+        alt_years = cls._rm_alt_years if alt_running_means else ()
+        return (
+            variable,
+            running_mean_field,
+            "cell_area",
+            *(f"{variable}_run_mean_{rm}" for rm in alt_years),
+        )
+
+    @functools.cached_property
+    def _grid(self) -> "oet.analyze.grid_registry.GridConstants":
+        """Constants (cell area, latitudes, zone masks) of the grid of ds_global"""
+        return oet.analyze.grid_registry.for_dataset(self.ds_global)
+
     @property
     def field_detrend_rm(self) -> str:
         return f"{self.field}_detrend_run_mean_{self._rm_years}"
@@ -134,6 +185,24 @@ class RegionPropertyCalculator:
             self._cache[k] = weighted_mean_array(_ds, field=field)
         return self._cache[k]
 
+    def running_mean_cached(
+        self,
+        field: str,
+        rm_years: int,
+        data_set: str = "ds_local",
+    ) -> np.ndarray:
+        """Running mean of the weighted mean of field. Read from {field}_run_mean_{rm_years} if it
+        was pre-processed, which is the same if there are no missing values"""
+        precomputed = f"{field}_run_mean_{rm_years}"
+        # For f"{self.field}_detrend", the pre-processed variable is the detrended running mean
+        if not field.endswith("_detrend") and _use_precomputed(
+            getattr(self, data_set),
+            precomputed,
+            rm_years,
+        ):
+            return self.weigthed_mean_cached(precomputed, data_set)
+        return running_mean(self.weigthed_mean_cached(field, data_set), rm_years)
+
     def _calc_max_end(self) -> float:
         """Calculte the difference between the end and the maximum calue in the default moving average filtered time series"""
         _m = self.weigthed_mean_cached(self.field_rm, "ds_local")
@@ -199,7 +268,7 @@ class RegionPropertyCalculator:
         ds_values = dict(pi=self.ds_pi, scenario=ds_global)[values_from]
         mask = self.mask
         log = oet.get_logger()
-        _, lat = np.meshgrid(ds_global.lon.values, ds_global.lat.values)
+        lat = self._grid.lat_2d
         if not isinstance(mask, np.ndarray):
             mask = mask.values
         assert np.all(
@@ -207,7 +276,7 @@ class RegionPropertyCalculator:
         ), "Lats should be in descending order"
 
         lats = lat[mask.astype(np.bool_)].flatten()
-        mask_trop_2d = (lat < _tropic_lat) & (lat > -_tropic_lat)
+        mask_trop_2d = self._grid.tropics_mask(_tropic_lat)
 
         if (
             np.sum([(lats > -_tropic_lat) & (lats < _tropic_lat)]) / len(lats)
@@ -321,13 +390,13 @@ class RegionPropertyCalculator:
     ) -> float:
         a = self.weigthed_mean_cached(self.field, data_set="ds_local")
         rm_years = rm_years or self._rm_years
-        a_rm = running_mean(a, rm_years)
-        return np.nanmax(np.abs(a_rm[n_years:] - a_rm[:-n_years]))
+        # Like running_mean, a NaN value ends the running mean
+        summary = rolling_mean_summary(a, rm_years, lags=n_years, skip_nan=False)
+        return summary["max_difference"][0]
 
     def _calc_max_end_rmx(self, rm_alt=50, apply_max=True) -> float:
         assert rm_alt % 2 == 0, rm_alt
-        _m = self.weigthed_mean_cached(self.field, "ds_local")
-        rm_x = running_mean(_m, rm_alt)
+        rm_x = self.running_mean_cached(self.field, rm_alt, "ds_local")
         end = rm_x[-rm_alt // 2]
 
         if not apply_max:
@@ -344,9 +413,9 @@ class RegionPropertyCalculator:
         vals_2d = ds_values["cell_area"].copy()
         vals_2d.attrs["units"] = "std"
 
-        rm_50_3d = running_mean_array(yearly_means, rm_alt)
-
-        vals_2d.data = np.nanstd(rm_50_3d, axis=0)
+        # Like running_mean_array, a NaN value ends the running mean
+        summary = rolling_mean_summary(yearly_means, rm_alt, skip_nan=False)
+        vals_2d.data = summary["std"][0]
         ds_values[set_field] = vals_2d
 
     def _sigma_trop_rmx(self, values_from: str = "scenario", rm_alt: int = 50) -> float:
@@ -365,8 +434,7 @@ class RegionPropertyCalculator:
         assert np.all(
             np.diff(self.ds_global.lat.values) < 0,
         ), "Lats should be in descending order"
-        _, lat = np.meshgrid(self.ds_global.lon.values, self.ds_global.lat.values)
-        lats = lat[self.mask.astype(np.bool_)].flatten()
+        lats = self._grid.lat_2d[self.mask.astype(np.bool_)].flatten()
         return lats
 
     def _get_named_zone(self, zone_name: str) -> np.ndarray:
@@ -388,7 +456,7 @@ class RegionPropertyCalculator:
         zone_bounds: np.ndarray,
         reflect: bool = False,
     ) -> np.ndarray:
-        _, lat = np.meshgrid(self.ds_global.lon.values, self.ds_global.lat.values)
+        lat = self._grid.lat_2d
         if reflect:
             zone_bounds = np.concatenate([-zone_bounds, zone_bounds])
         assert np.all(
@@ -418,11 +486,22 @@ class RegionPropertyCalculator:
         field: ty.Optional[str] = None,
     ):
         mask = self._get_named_zone(zone_name)
-        data = self.ds_global[field or self.field].where(mask, drop=False).values
+        field = field or self.field
+        precomputed = f"{field}_run_mean_{rm}"
+        use_precomputed = rm is not None and _use_precomputed(
+            self.ds_global,
+            precomputed,
+            rm,
+        )
+        data = (
+            self.ds_global[precomputed if use_precomputed else field]
+            .where(mask, drop=False)
+            .values
+        )
         weights = self.ds_global["cell_area"].values
 
         trop_avg = _weighted_mean_array_numba(data, weights)
-        if rm is not None:
+        if rm is not None and not use_precomputed:
             trop_avg = running_mean(trop_avg, rm)
         offset = int(rm // 2 if rm else 0)
         if start_or_max == "start":
@@ -437,8 +516,7 @@ class RegionPropertyCalculator:
         raise NotImplementedError(f"Method {start_or_max} not available")
 
     def max_rmx(self, rm_alt=50, field=None, values_from="ds_local"):
-        _m = self.weigthed_mean_cached(field or self.field, values_from)
-        rm_x = running_mean(_m, rm_alt)
+        rm_x = self.running_mean_cached(field or self.field, rm_alt, values_from)
         return np.nanmax(rm_x)
 
     def calculate(self) -> ty.Dict[str, ty.Union[str, int, float, bool]]:  # type: ignore
@@ -511,6 +589,71 @@ def summarize_stats(
     ).calculate()
 
 
+def validate_precision(
+    ds_global: xr.Dataset,
+    ds_pi: xr.Dataset,
+    mask: ty.Union[np.ndarray, xr.DataArray],
+    field: ty.Optional[str] = None,
+    precision: str = "float32",
+    rtol: float = 1e-3,
+) -> pd.DataFrame:
+    """Compare the region metrics (see RegionPropertyCalculator.calculate) of
+    the datasets to those calculated after casting them to precision.
+
+    The datasets should be read at full precision (config['analyze']['precision'] = float64),
+    otherwise both results are calculated from the same values.
+
+    Args:
+        ds_global (xr.Dataset): dataset of interest
+        ds_pi (xr.Dataset): pi-control dataset corresponding to ds_global
+        mask (ty.Union[np.ndarray, xr.DataArray]): region of interest
+        field (ty.Optional[str], optional): variable_id. Defaults to None in which case we read it
+            from ds_global.
+        precision (str, optional): precision to validate. Defaults to "float32".
+        rtol (float, optional): relative tolerance for the metrics to be considered equal.
+            Defaults to 1e-3.
+
+    Returns:
+        pd.DataFrame: for each (numeric) metric the reference value, the value at precision, their
+            relative difference and whether they are equal within rtol
+    """
+    field = field or ds_global.variable_id
+    set_precision = oet.analyze.xarray_tools.set_precision
+    reference = summarize_stats(ds_global, ds_pi, mask, field)
+    lowered = summarize_stats(
+        set_precision(ds_global, precision),
+        set_precision(ds_pi, precision),
+        mask,
+        field,
+    )
+    rows = []
+    for metric, expected in reference.items():
+        if isinstance(expected, (str, bool, np.bool_)):
+            continue
+        value = lowered[metric]
+        rows.append(
+            dict(
+                metric=metric,
+                reference=float(expected),
+                value=float(value),
+                relative_difference=float(
+                    np.divide(abs(value - expected), abs(expected))
+                    if expected
+                    else abs(value - expected)
+                ),
+                equal=bool(np.isclose(value, expected, rtol=rtol, equal_nan=True)),
+            ),
+        )
+    return pd.DataFrame(rows).set_index("metric")
+
+
+def _use_precomputed(data_set: xr.Dataset, name: str, window: int) -> bool:
+    """Can the running mean over window be read from the pre-processed variable name? These are
+    stored at the center of the window (index + window // 2, like cdo runmean), while running_mean
+    stores at index + window - window // 2. Both only agree for even windows."""
+    return name in data_set and int(window) % 2 == 0
+
+
 def _max_and_second_jump(
     values,
     n_years_difference: int = 10,
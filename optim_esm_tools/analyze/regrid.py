@@ -0,0 +1,492 @@
+"""Regridding and grid-area tools that mirror "cdo remapbil" and "cdo gridarea"
+for use without cdo (see pre_process with engine='numpy')."""
+
+import hashlib
+import os
+import typing as ty
+
+import numpy as np
+import xarray as xr
+
+from optim_esm_tools.config import config
+from optim_esm_tools.config import get_logger
+from optim_esm_tools.utils import atomic_publish
+
+# Same default as cdo (PlanetRadius = 6371000 m)
+_EARTH_RADIUS_M = 6_371_000.0
+
+_LAT_ATTRS = dict(
+    standard_name='latitude',
+    long_name='latitude',
+    units='degrees_north',
+    axis='Y',
+)
+_LON_ATTRS = dict(
+    standard_name='longitude',
+    long_name='longitude',
+    units='degrees_east',
+    axis='X',
+)
+
+
+def target_grid_coords(target_grid: str) -> ty.Tuple[np.ndarray, np.ndarray]:
+    """Get the latitude and longitude vectors of a cdo-style grid
+    specification.
+
+    Args:
+        target_grid (str): Grid specification, e.g. n90 (Gaussian grid with 90 latitudes between
+            pole and equator) or r360x180 (regular lon/lat grid).
+
+    Returns:
+        ty.Tuple[np.ndarray, np.ndarray]: latitudes (north to south) and longitudes in degrees
+    """
+    kind, spec = target_grid[0].lower(), target_grid[1:]
+    if kind == 'n' and spec.isdigit():
+        n_lat = 2 * int(spec)
+        lat, _ = _gaussian_latitudes(n_lat)
+        lon = np.arange(2 * n_lat) * 360 / (2 * n_lat)
+        return lat, lon
+    if kind == 'r' and 'x' in spec:
+        n_lon, n_lat = (int(s) for s in spec.split('x'))
+        d_lat = 180 / n_lat
+        lat = (90 - d_lat / 2) - np.arange(n_lat) * d_lat
+        lon = np.arange(n_lon) * 360 / n_lon
+        return lat, lon
+    raise NotImplementedError(f'Grid {target_grid} is not supported without cdo')
+
+
+def _gaussian_latitudes(n_lat: int) -> ty.Tuple[np.ndarray, np.ndarray]:
+    """Gaussian latitudes (in degrees, north to south) and their weights (sum
+    to 2)."""
+    nodes, weights = np.polynomial.legendre.leggauss(n_lat)
+    return np.rad2deg(np.arcsin(nodes))[::-1], weights[::-1]
+
+
+def _lat_bounds_sin(target_grid: str, lat: np.ndarray) -> np.ndarray:
+    """Sine of the latitude bounds (north to south) of a target grid.
+
+    For Gaussian grids, the bounds are chosen such that each latitude
+    band covers the fraction of the sphere given by its Gaussian weight.
+    """
+    if target_grid[0].lower() == 'n':
+        _, weights = _gaussian_latitudes(len(lat))
+        return np.clip(1 - np.concatenate([[0], np.cumsum(weights)]), -1, 1)
+    mid = (lat[1:] + lat[:-1]) / 2
+    return np.sin(np.deg2rad(np.concatenate([[90], mid, [-90]])))
+
+
+def grid_area(
+    target_grid: str,
+    radius: float = _EARTH_RADIUS_M,
+) -> np.ndarray:
+    """Calculate the area (m^2) of each cell of target_grid, similar to "cdo
+    gridarea".
+
+    Args:
+        target_grid (str): Grid specification (like n90).
+        radius (float, optional): radius of the planet. Defaults to 6371000 m.
+
+    Returns:
+        np.ndarray: 2d array of shape (lat, lon)
+    """
+    lat, lon = target_grid_coords(target_grid)
+    sin_bounds = _lat_bounds_sin(target_grid, lat)
+    band = sin_bounds[:-1] - sin_bounds[1:]
+    d_lon = np.deg2rad(360 / len(lon))
+    return radius**2 * d_lon * np.repeat(band[:, None], len(lon), axis=1)
+
+
+def _axis_weights(
+    source: np.ndarray,
+    target: np.ndarray,
+    periodic: bool = False,
+) -> ty.Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """For each target value, get the indices of the two neighbouring source
+    values and the linear weight of the second one.
+
+    Source values must be sorted ascending. Targets outside the source
+    range are clamped to the nearest edge (unless periodic).
+    """
+    n = len(source)
+    if periodic:
+        extended = np.concatenate([[source[-1] - 360], source, [source[0] + 360]])
+        target = np.mod(target - extended[0], 360) + extended[0]
+        idx = np.clip(np.searchsorted(extended, target, side='right'), 1, n + 1)
+        left, right = extended[idx - 1], extended[idx]
+        frac = (target - left) / (right - left)
+        return np.mod(idx - 2, n), np.mod(idx - 1, n), frac
+
+    idx = np.searchsorted(source, target, side='right')
+    i0 = np.clip(idx - 1, 0, n - 1)
+    i1 = np.clip(idx, 0, n - 1)
+    span = source[i1] - source[i0]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        frac = np.where(span > 0, (target - source[i0]) / span, 0.0)
+    return i0, i1, np.clip(frac, 0, 1)
+
+
+def bilinear_weights(
+    source_lat: np.ndarray,
+    source_lon: np.ndarray,
+    target_lat: np.ndarray,
+    target_lon: np.ndarray,
+):
+    """Build a sparse (n_target, n_source) matrix for bilinear interpolation
+    from a rectilinear source grid to a rectilinear target grid, similar to
+    "cdo remapbil".
+
+    Both grids are flattened in (lat, lon) order. Longitudes are treated as periodic if the source
+    grid covers the full globe.
+
+    Returns:
+        scipy.sparse.csr_matrix: interpolation weights
+    """
+    from scipy import sparse
+
+    source_lat = np.asarray(source_lat, dtype=np.float64)
+    source_lon = np.mod(np.asarray(source_lon, dtype=np.float64), 360)
+    lat_order = np.argsort(source_lat)
+    lon_order = np.argsort(source_lon)
+    lat_sorted = source_lat[lat_order]
+    lon_sorted = source_lon[lon_order]
+
+    d_lon = np.median(np.diff(lon_sorted)) if len(lon_sorted) > 1 else 360
+    periodic = (lon_sorted[-1] - lon_sorted[0] + d_lon) >= 360 - 1e-6 * d_lon
+
+    y0, y1, fy = _axis_weights(lat_sorted, np.asarray(target_lat, dtype=np.float64))
+    x0, x1, fx = _axis_weights(
+        lon_sorted,
+        np.mod(np.asarray(target_lon, dtype=np.float64), 360),
+        periodic=periodic,
+    )
+    y0, y1 = lat_order[y0], lat_order[y1]
+    x0, x1 = lon_order[x0], lon_order[x1]
+
+    n_lon_src = len(source_lon)
+    n_lat_t, n_lon_t = len(target_lat), len(target_lon)
+    row = np.arange(n_lat_t * n_lon_t).reshape(n_lat_t, n_lon_t)
+
+    rows, cols, vals = [], [], []
+    for y_idx, w_y in ((y0, 1 - fy), (y1, fy)):
+        for x_idx, w_x in ((x0, 1 - fx), (x1, fx)):
+            rows.append(row)
+            cols.append(y_idx[:, None] * n_lon_src + x_idx[None, :])
+            vals.append(w_y[:, None] * w_x[None, :])
+    weights = sparse.coo_matrix(
+        (
+            np.concatenate([v.ravel() for v in vals]),
+            (
+                np.concatenate([r.ravel() for r in rows]),
+                np.concatenate([c.ravel() for c in cols]),
+            ),
+        ),
+        shape=(n_lat_t * n_lon_t, len(source_lat) * n_lon_src),
+    ).tocsr()
+    weights.eliminate_zeros()
+    return weights
+
+
+def apply_weights(weights, data: np.ndarray, n_lat: int, n_lon: int) -> np.ndarray:
+    """Regrid data of shape (time, lat, lon) using sparse weights.
+
+    A target cell is NaN if any source cell with a non-zero weight is NaN (like cdo does for
+    missing values).
+    """
+    n_time = data.shape[0]
+    flat = data.reshape(n_time, -1).T.astype(np.float64)
+    is_nan = np.isnan(flat)
+    result = weights @ np.where(is_nan, 0, flat)
+    result[(weights @ is_nan.astype(np.float64)) > 0] = np.nan
+    return result.T.reshape(n_time, n_lat, n_lon)
+
+
+def _lat_lon_names(data_array: xr.DataArray) -> ty.Tuple[str, str]:
+    lon_name, lat_name = config['analyze']['lon_lat_dim'].split(',')
+    for lat_alt, lon_alt in [(lat_name, lon_name), ('latitude', 'longitude')]:
+        if lat_alt in data_array.dims and lon_alt in data_array.dims:
+            return lat_alt, lon_alt
+    raise NotImplementedError(
+        f'Only rectilinear grids are supported without cdo, got {data_array.dims}',
+    )
+
+
+def regrid_bilinear(
+    data_array: xr.DataArray,
+    target_grid: str,
+    time_chunk_size: ty.Optional[int] = None,
+    weights=None,
+) -> xr.DataArray:
+    """Bilinear regridding of a (time, lat, lon) DataArray to target_grid.
+
+    Args:
+        data_array (xr.DataArray): data to regrid (may be lazy)
+        target_grid (str): Grid specification (like n90).
+        time_chunk_size (int, optional): only load this many time steps at once. Defaults to
+            None (load all at once).
+        weights (optional): precomputed weights from bilinear_weights. Defaults to None, in
+            which case they are taken from the weight cache (see cached_bilinear_weights).
+
+    Returns:
+        xr.DataArray: regridded data with float64 values
+    """
+    lat_name, lon_name = _lat_lon_names(data_array)
+    data_array = data_array.transpose('time', lat_name, lon_name)
+    target_lat, target_lon = target_grid_coords(target_grid)
+    if weights is None:
+        weights = cached_bilinear_weights(
+            data_array[lat_name].values,
+            data_array[lon_name].values,
+            target_grid,
+        )
+    n_time = len(data_array['time'])
+    step = time_chunk_size or n_time
+    result = np.empty((n_time, len(target_lat), len(target_lon)), dtype=np.float64)
+    for start in range(0, n_time, max(step, 1)):
+        chunk = data_array.isel(time=slice(start, start + step)).values
+        result[start : start + step] = apply_weights(
+            weights,
+            chunk,
+            len(target_lat),
+            len(target_lon),
+        )
+    return xr.DataArray(
+        result,
+        dims=('time', 'lat', 'lon'),
+        coords=dict(
+            time=data_array['time'],
+            lat=xr.DataArray(target_lat, dims='lat', attrs=_LAT_ATTRS),
+            lon=xr.DataArray(target_lon, dims='lon', attrs=_LON_ATTRS),
+        ),
+        attrs=data_array.attrs,
+        name=data_array.name,
+    )
+
+
+# Weights that are already loaded in this process, see cached_bilinear_weights
+_WEIGHTS_IN_MEMORY: ty.Dict[ty.Tuple[str, str], ty.Any] = {}
+
+
+def grid_fingerprint(*arrays: ty.Optional[np.ndarray]) -> str:
+    """Get a short hash that identifies a grid from its coordinate arrays
+    (and optionally a mask)."""
+    sha = hashlib.sha1()
+    for array in arrays:
+        if array is None:
+            continue
+        array = np.ascontiguousarray(array)
+        sha.update(f'{array.shape}{array.dtype.kind}'.encode())
+        sha.update(
+            array.astype(
+                np.float64 if array.dtype.kind == 'f' else array.dtype
+            ).tobytes()
+        )
+    return sha.hexdigest()[:16]
+
+
+def weight_cache_dir() -> ty.Optional[str]:
+    """Folder where regridding weights are stored, None if disabled in the
+    config ([analyze] regrid_weight_cache)."""
+    folder = config['analyze'].get('regrid_weight_cache', '').strip()
+    if not folder:
+        return None
+    folder = os.path.expanduser(os.path.expandvars(folder))
+    os.makedirs(folder, exist_ok=True)
+    return folder
+
+
+def cached_bilinear_weights(
+    source_lat: np.ndarray,
+    source_lon: np.ndarray,
+    target_grid: str,
+    cache_dir: ty.Optional[str] = None,
+):
+    """Get bilinear weights (see bilinear_weights) from the weight cache, or
+    compute and store them.
+
+    Weights are keyed by (fingerprint of the source grid, target_grid), such that all files on the
+    same native grid reuse the same weights.
+
+    Args:
+        source_lat (np.ndarray): latitudes of the source grid
+        source_lon (np.ndarray): longitudes of the source grid
+        target_grid (str): Grid specification (like n90).
+        cache_dir (str, optional): where to store the weights. Defaults to None, and is taken from
+            the config. If there is no folder configured, only keep the weights in memory.
+
+    Returns:
+        scipy.sparse.csr_matrix: interpolation weights
+    """
+    from scipy import sparse
+
+    key = (grid_fingerprint(source_lat, source_lon), target_grid)
+    if key in _WEIGHTS_IN_MEMORY:
+        return _WEIGHTS_IN_MEMORY[key]
+
+    cache_dir = cache_dir or weight_cache_dir()
+    path = (
+        os.path.join(cache_dir, f'bil_{key[0]}_{target_grid}.npz')
+        if cache_dir
+        else None
+    )
+    if path is not None and os.path.exists(path):
+        weights = sparse.load_npz(path)
+    else:
+        target_lat, target_lon = target_grid_coords(target_grid)
+        weights = bilinear_weights(source_lat, source_lon, target_lat, target_lon)
+        if path is not None:
+            get_logger().info(f'Store regridding weights at {path}')
+            atomic_publish(lambda p: sparse.save_npz(p, weights), path, suffix='.npz')
+    _WEIGHTS_IN_MEMORY[key] = weights
+    return weights
+
+
+def grid_arrays(
+    ds: xr.Dataset,
+    variable_id: ty.Optional[str] = None,
+    name: str = 'dataset',
+) -> ty.Tuple[np.ndarray, ...]:
+    """Get the lat/lon coordinates (1d or 2d) of a dataset, and the missing
+    value mask of the first time step of variable_id (if given)."""
+    arrays = []
+    for names, standard_name in [
+        (('lat', 'latitude', 'nav_lat'), 'latitude'),
+        (('lon', 'longitude', 'nav_lon'), 'longitude'),
+    ]:
+        match = [
+            k
+            for k, v in ds.variables.items()
+            if k in names or v.attrs.get('standard_name') == standard_name
+        ]
+        if not match:
+            raise ValueError(f'No {standard_name} in {name}')  # pragma: no cover
+        arrays.append(ds[match[0]].values)
+    if variable_id is not None and variable_id in ds:
+        da = ds[variable_id]
+        arrays.append(
+            np.isnan(da.isel(time=0).values if 'time' in da.dims else da.values)
+        )
+    return tuple(arrays)
+
+
+def cdo_weights_file(
+    cdo_int,
+    source: str,
+    target_grid: str,
+    variable_id: ty.Optional[str] = None,
+    cache_dir: ty.Optional[str] = None,
+    select_dates: ty.Optional[str] = None,
+    cdo_input: ty.Optional[str] = None,
+) -> ty.Optional[str]:
+    """Get a cdo weights file (from "cdo genbil") for bilinear regridding of
+    source to target_grid.
+
+    Since cdo derives the source mask from the missing values, the fingerprint includes the
+    missing value mask of variable_id. Weights are only valid for a mask that does not change in
+    time, so there is no weight file if it does (like for siconc or sos).
+
+    Args:
+        cdo_int: cdo interface
+        source (str): path of the source file
+        target_grid (str): Grid specification (like n90).
+        variable_id (str, optional): variable that is regridded. Defaults to None.
+        cache_dir (str, optional): where to store the weights. Defaults to None, and is taken from
+            the config.
+        select_dates (str, optional): only the range "YYYY-MM-DD,YYYY-MM-DD" is regridded.
+            Defaults to None.
+        cdo_input (str, optional): cdo input (with chained operators) that is regridded, the
+            weights are generated from the same input. Defaults to None (source).
+
+    Returns:
+        str: path to the weight file, None if there is no weight cache configured or if the mask
+            changes in time.
+    """
+    cache_dir = cache_dir or weight_cache_dir()
+    if cache_dir is None:
+        return None
+    from optim_esm_tools.analyze.io import load_glob
+
+    ds = load_glob(source)
+    arrays = grid_arrays(ds, name=source)
+    if variable_id is not None and variable_id in ds:
+        arrays = (*arrays, _constant_missing_mask(ds[variable_id], select_dates))
+    ds.close()
+    if arrays[-1] is None:
+        get_logger().info(f'The mask of {source} changes in time, use remapbil')
+        return None
+    key = grid_fingerprint(*arrays)
+    path = os.path.join(cache_dir, f'cdo_bil_{key}_{target_grid}.nc')
+    if not os.path.exists(path):
+        cdo_input = cdo_input or source
+        if variable_id is not None:
+            # genbil uses the grid (and mask) of the first variable
+            cdo_input = f'-selname,{variable_id} {cdo_input}'
+        get_logger().info(f'Store cdo regridding weights at {path}')
+        atomic_publish(
+            lambda p: cdo_int.genbil(target_grid, input=cdo_input, output=p),
+            path,
+            suffix='.nc',
+        )
+    return path
+
+
+def _constant_missing_mask(
+    data_array: xr.DataArray,
+    select_dates: ty.Optional[str] = None,
+) -> ty.Optional[np.ndarray]:
+    """Get the missing value mask of data_array (in the range select_dates),
+    None if the mask changes in time."""
+    if 'time' not in data_array.dims:
+        return np.isnan(data_array.values)
+    if select_dates is not None:
+        from optim_esm_tools.analyze.pre_process import _select_time_range
+
+        min_time, max_time = (
+            tuple(int(x) for x in date.split('-')) for date in select_dates.split(',')
+        )
+        data_array = _select_time_range(
+            data_array.to_dataset(),
+            min_time,
+            max_time,
+        )[data_array.name]
+    is_nan = data_array.isnull()
+    any_nan = is_nan.any('time').values
+    if not np.array_equal(any_nan, is_nan.all('time').values):
+        return None
+    return any_nan
+
+
+def cdo_remapbil(
+    cdo_int,
+    target_grid: str,
+    input: str,
+    output: str,
+    variable_id: ty.Optional[str] = None,
+    select_dates: ty.Optional[str] = None,
+    drop_vars: ty.Sequence[str] = (),
+) -> None:
+    """Same as cdo_int.remapbil(target_grid, input=input, output=output), but
+    reuse cached weights (if a weight cache is configured and the missing
+    value mask does not change in time).
+
+    If select_dates ("YYYY-MM-DD,YYYY-MM-DD") is given, only this range is
+    read and regridded (chained cdo -seldate), without writing the
+    selection to disk first. Similarly, drop_vars are not read (chained
+    cdo -delname).
+    """
+    source = input
+    if drop_vars:
+        input = f'-delname,{",".join(drop_vars)} {input}'
+    if select_dates is not None:
+        input = f'-seldate,{select_dates} {input}'
+    weights = cdo_weights_file(
+        cdo_int,
+        source,
+        target_grid,
+        variable_id=variable_id,
+        select_dates=select_dates,
+        cdo_input=input,
+    )
+    if weights is None:
+        cdo_int.remapbil(target_grid, input=input, output=output)
+        return
+    cdo_int.remap(f'{target_grid},{weights}', input=input, output=output)
@@ -1,15 +1,23 @@
 import abc
+import hashlib
+import json
+import threading
 import typing as ty
 
 import numpy as np
 import xarray as xr
 from immutabledict import immutabledict
 
+from .globals import _MEMBER_DIM
 from .globals import _SECONDS_TO_YEAR
+from .tools import _max_change_sweep_numba
+from .tools import _running_mean_criteria_numba
+from .tools import _valid_times_numba
 from .tools import rank2d
+from .tools import rank_many
 from .xarray_tools import _native_date_fmt
-from .xarray_tools import _remove_any_none_times
 from .xarray_tools import apply_abs
+from optim_esm_tools.config import config
 from optim_esm_tools.utils import check_accepts
 from optim_esm_tools.utils import deprecated
 from optim_esm_tools.utils import timed
@@ -22,6 +30,13 @@ class _Condition(abc.ABC):
         unit='absolute',
         apply_abs=True,
     )
+    # Variables (formatted with variable and running_mean) read from the data_set by calculate
+    requires: ty.Tuple[str, ...] = ()
+    # Bump the version if the result of calculate changes, this invalidates the cached results of
+    # this condition and of the conditions that have it as a parent (see condition_fingerprint)
+    version: str = '1'
+    # Attributes (besides variable, running_mean, time_var and defaults) that change the result
+    settings: ty.Tuple[str, ...] = ()
 
     def __init__(
         self,
@@ -41,6 +56,31 @@ class _Condition(abc.ABC):
     def calculate(self, *arg, **kwarg):
         raise NotImplementedError  # pragma: no cover
 
+    @staticmethod
+    def parents() -> ty.Tuple[ty.Type['_Condition'], ...]:
+        """Conditions whose results are needed to calculate this condition."""
+        return ()
+
+    def required_variables(self) -> ty.Tuple[str, ...]:
+        return tuple(
+            r.format(variable=self.variable, running_mean=self.running_mean)
+            for r in self.requires
+        )
+
+    def _criteria(
+        self,
+        data_set: xr.Dataset,
+        graph: ty.Optional['ConditionGraph'],
+        x_yr: int = 10,
+    ) -> ty.Optional[ty.Dict[str, xr.DataArray]]:
+        """Get the per-cell criteria of the (single) required variable
+        from the graph, such that conditions on the same variable share
+        them."""
+        if graph is None:
+            return None
+        (var_name,) = self.required_variables()
+        return graph.criteria(var_name, time_var=self.time_var, x_yr=x_yr)
+
     @property
     def long_description(self):
         raise NotImplementedError  # pragma: no cover
@@ -48,18 +88,24 @@ class _Condition(abc.ABC):
 
 class StartEndDifference(_Condition):
     short_description: str = 'start end difference'
+    requires = ('{variable}_run_mean_{running_mean}',)
 
     @property
     def long_description(self) -> str:
         return f'Difference of running mean ({self.running_mean} yr) between start and end of time series. Not detrended'
 
-    def calculate(self, data_set: xr.Dataset):
+    def calculate(
+        self,
+        data_set: xr.Dataset,
+        graph: ty.Optional['ConditionGraph'] = None,
+    ):
         return running_mean_diff(
             data_set,
             variable=self.variable,  # type: ignore
             time_var=self.time_var,  # type: ignore
             naming='{variable}_run_mean_{running_mean}',  # type: ignore
             running_mean=self.running_mean,  # type: ignore
+            criteria=self._criteria(data_set, graph),
             **self.defaults,
         )
 
@@ -75,13 +121,22 @@ class StdDetrended(_Condition):
     def use_variable(self) -> str:
         return '{variable}_detrend_run_mean_{running_mean}'
 
-    def calculate(self, data_set: xr.Dataset):
+    @property
+    def requires(self) -> ty.Tuple[str, ...]:  # type: ignore
+        return (self.use_variable,)
+
+    def calculate(
+        self,
+        data_set: xr.Dataset,
+        graph: ty.Optional['ConditionGraph'] = None,
+    ):
         return running_mean_std(
             data_set,
             variable=self.variable,  # type: ignore
             time_var=self.time_var,  # type: ignore
             naming=self.use_variable,  # type: ignore
             running_mean=self.running_mean,  # type: ignore
+            criteria=self._criteria(data_set, graph),
             **self.defaults,
         )
 
@@ -101,7 +156,15 @@ class MaxJump(_Condition):
     def use_variable(self) -> str:
         return '{variable}_run_mean_{running_mean}'
 
-    def calculate(self, data_set: xr.Dataset):
+    @property
+    def requires(self) -> ty.Tuple[str, ...]:  # type: ignore
+        return (self.use_variable,)
+
+    def calculate(
+        self,
+        data_set: xr.Dataset,
+        graph: ty.Optional['ConditionGraph'] = None,
+    ):
         return max_change_xyr(
             data_set,
             variable=self.variable,  # type: ignore
@@ -109,6 +172,7 @@ class MaxJump(_Condition):
             naming=self.use_variable,  # type: ignore
             x_yr=self.number_of_years,  # type: ignore
             running_mean=self.running_mean,  # type: ignore
+            criteria=self._criteria(data_set, graph, x_yr=self.number_of_years),
             **self.defaults,
         )
 
@@ -126,6 +190,44 @@ class MaxJumpYearly(MaxJump):
         return '{variable}'
 
 
+class MaxJumpSweep(MaxJump):
+    short_description: str = 'max jump sweep'
+
+    # The windows change the result, so they are part of the key (and fingerprint) of the result
+    settings = ('number_of_years',)
+
+    def __init__(
+        self,
+        *args,
+        number_of_years: ty.Optional[ty.Iterable[int]] = None,
+        **kwargs,
+    ):
+        super().__init__(*args, **kwargs)
+        if number_of_years is None:
+            number_of_years = config['analyze']['max_jump_sweep_years'].split()
+        self.number_of_years = tuple(int(x) for x in np.atleast_1d(number_of_years))
+
+    @property
+    def long_description(self) -> str:
+        years = ', '.join(str(x) for x in self.number_of_years)
+        return f'Max change in {years} yr (window) in the running mean ({self.running_mean} yr). Not detrended'
+
+    def calculate(
+        self,
+        data_set: xr.Dataset,
+        graph: ty.Optional['ConditionGraph'] = None,
+    ):
+        return max_change_sweep(
+            data_set,
+            variable=self.variable,  # type: ignore
+            x_yrs=self.number_of_years,
+            time_var=self.time_var,  # type: ignore
+            naming=self.use_variable,  # type: ignore
+            running_mean=self.running_mean,  # type: ignore
+            **self.defaults,
+        )
+
+
 class StdDetrendedYearly(StdDetrended):
     short_description: str = 'std detrended yearly'
 
@@ -140,18 +242,24 @@ class StdDetrendedYearly(StdDetrended):
 
 class MaxDerivitive(_Condition):
     short_description: str = 'max derivative'
+    requires = ('{variable}_run_mean_{running_mean}',)
 
     @property
     def long_description(self) -> str:
         return f'Max value of the first order derivative of the running mean ({self.running_mean} yr). Not deterended'
 
-    def calculate(self, data_set: xr.Dataset):
+    def calculate(
+        self,
+        data_set: xr.Dataset,
+        graph: ty.Optional['ConditionGraph'] = None,
+    ):
         return max_derivative(
             data_set,
             variable=self.variable,  # type: ignore
             time_var=self.time_var,  # type: ignore
             naming='{variable}_run_mean_{running_mean}',  # type: ignore
             running_mean=self.running_mean,  # type: ignore
+            criteria=self._criteria(data_set, graph),
             **self.defaults,
         )
 
@@ -183,21 +291,31 @@ class MaxJumpAndStd(_Condition):
             for p in self.parents()
         ]
 
-    def get_parent_results(self, data_set: xr.Dataset) -> ty.Dict[str, float]:
+    def get_parent_results(
+        self,
+        data_set: xr.Dataset,
+        graph: ty.Optional['ConditionGraph'] = None,
+    ) -> ty.Dict[str, float]:
         super_1, super_2 = self.get_parents_init()
-        da_1 = super_1.calculate(data_set)
-        da_2 = super_2.calculate(data_set)
+        if graph is None:
+            graph = ConditionGraph(data_set)
+        da_1 = graph.get(super_1)
+        da_2 = graph.get(super_2)
         assert super_1.short_description != super_2.short_description, (
             super_1.short_description,
             super_2.short_description,
         )
         return {super_1: da_1, super_2: da_2}
 
-    def calculate(self, data_set: xr.Dataset):
-        da_1, da_2 = self.get_parent_results(data_set).values()
+    def calculate(
+        self,
+        data_set: xr.Dataset,
+        graph: ty.Optional['ConditionGraph'] = None,
+    ):
+        da_1, da_2 = self.get_parent_results(data_set, graph=graph).values()
         combined_score = np.ones_like(da_1.values, dtype=np.float64)
         for da in [da_1, da_2]:
-            combined_score *= rank2d(da.values)
+            combined_score *= _rank_per_member(da)
         return xr.DataArray(
             combined_score,
             coords=da_1.coords,
@@ -220,13 +338,265 @@ class SNR(MaxJumpAndStd):
         p1, p2 = self.parents()
         return f'Signal to noise ratio of {p1.short_description}/{p2.short_description}'
 
-    def calculate(self, data_set: xr.Dataset):
-        da_1, da_2 = self.get_parent_results(data_set).values()
+    def calculate(
+        self,
+        data_set: xr.Dataset,
+        graph: ty.Optional['ConditionGraph'] = None,
+    ):
+        da_1, da_2 = self.get_parent_results(data_set, graph=graph).values()
         res = da_1 / da_2
         res.name = self.short_description
         return res
 
 
+class ConditionGraph:
+    """Evaluate conditions on a data_set, calculating each (unique) condition
+    only once.
+
+    Conditions with parents (like MaxJumpAndStd) take the results of
+    their parents from the graph, instead of calculating them again.
+    """
+
+    def __init__(self, data_set: xr.Dataset):
+        self.data_set = data_set
+        self._results: ty.Dict[tuple, xr.DataArray] = {}
+        self._criteria: ty.Dict[tuple, ty.Dict[str, xr.DataArray]] = {}
+        self._lazy_results: ty.Dict[tuple, xr.DataArray] = {}
+        # The lazy results may be computed from several (dask) threads
+        self._lock = threading.RLock()
+
+    @staticmethod
+    def key(condition: _Condition) -> tuple:
+        return (
+            type(condition).__name__,
+            condition.variable,
+            condition.running_mean,
+            condition.time_var,
+            tuple(sorted(condition.defaults.items())),
+            tuple((name, getattr(condition, name)) for name in condition.settings),
+        )
+
+    def get(self, condition: _Condition) -> xr.DataArray:
+        """Get the result of condition, calculate it if needed."""
+        key = self.key(condition)
+        with self._lock:
+            if key not in self._results:
+                self._results[key] = condition.calculate(self.data_set, graph=self)
+            return self._results[key]
+
+    def criteria(
+        self,
+        var_name: str,
+        time_var: str = 'time',
+        x_yr: int = 10,
+    ) -> ty.Dict[str, xr.DataArray]:
+        """Get the per-cell criteria of var_name (see
+        running_mean_criteria), calculate them if needed."""
+        key = (var_name, time_var, x_yr)
+        with self._lock:
+            if key not in self._criteria:
+                self._criteria[key] = running_mean_criteria(
+                    self.data_set[var_name],
+                    time_var=time_var,
+                    x_yr=x_yr,
+                )
+            return self._criteria[key]
+
+    def get_lazy(self, condition: _Condition) -> xr.DataArray:
+        """Get the result of condition as a dask-backed DataArray that is only
+        calculated once its values are accessed.
+
+        The name and dimensions of the result are obtained by calculating
+        the condition for a single grid cell (with valid data).
+        """
+        import dask
+        import dask.array
+
+        key = self.key(condition)
+        with self._lock:
+            if key in self._results:
+                return self._results[key]
+            if key in self._lazy_results:
+                return self._lazy_results[key]
+        probe = condition.calculate(self.data_set.isel(self._probe_cell(condition)))
+        # Dimensions that are not in the data_set (like the window of MaxJumpSweep) are not
+        # reduced by the probe
+        shape = tuple(self.data_set.sizes.get(d, probe.sizes[d]) for d in probe.dims)
+        data = dask.array.from_delayed(
+            dask.delayed(lambda: self.get(condition).values)(),
+            shape=shape,
+            dtype=probe.dtype,
+        )
+        result = xr.DataArray(
+            data,
+            dims=probe.dims,
+            coords={
+                d: self.data_set[d] if d in self.data_set.coords else probe[d]
+                for d in probe.dims
+                if d in self.data_set.coords or d in probe.coords
+            },
+            name=probe.name,
+            attrs=probe.attrs,
+        )
+        with self._lock:
+            return self._lazy_results.setdefault(key, result)
+
+    def _probe_cell(self, condition: _Condition) -> ty.Dict[str, slice]:
+        """Select the first grid cell where the variables that condition (and
+        its parents) read are not all NaN."""
+        lon_lat = [
+            d
+            for d in config['analyze']['lon_lat_dim'].split(',')
+            if d in self.data_set.dims
+        ]
+        valid = None
+        for name in _required_variables(condition):
+            data_array = self.data_set[name]
+            has_data = data_array.notnull().any(
+                [d for d in data_array.dims if d not in lon_lat],
+            )
+            valid = has_data if valid is None else valid & has_data
+        if valid is None or not valid.any():
+            # Nothing to choose from, the condition reports why it cannot be calculated
+            return {d: slice(0, 1) for d in lon_lat}
+        index = np.argwhere(valid.transpose(*lon_lat).values)[0]
+        return {d: slice(int(i), int(i) + 1) for d, i in zip(lon_lat, index)}
+
+
+def _required_variables(condition: _Condition) -> ty.List[str]:
+    """The variables read by condition and its parents."""
+    names = list(condition.required_variables())
+    if isinstance(condition, MaxJumpAndStd):
+        for parent in condition.get_parents_init():
+            names += _required_variables(parent)
+    return names or [condition.variable]
+
+
+def _condition_versions(cls: ty.Type[_Condition]) -> ty.Dict[str, str]:
+    versions = {cls.__name__: cls.version}
+    for parent in cls.parents():
+        versions.update(_condition_versions(parent))
+    return versions
+
+
+def condition_fingerprint(condition: _Condition) -> str:
+    """Identify the result of condition by its settings and the versions of
+    it and its parents, such that cached results can be reused until either
+    changes.
+
+    Args:
+        condition (_Condition): condition to identify
+
+    Returns:
+        str: hash of the settings and versions
+    """
+    doc = dict(
+        key=ConditionGraph.key(condition),
+        versions=_condition_versions(type(condition)),
+    )
+    as_str = json.dumps(doc, sort_keys=True, default=str)
+    return hashlib.sha1(as_str.encode()).hexdigest()[:16]
+
+
+def _rank_per_member(data_array: xr.DataArray) -> np.ndarray:
+    """Like rank2d, but rank each member (if any) separately."""
+    if _MEMBER_DIM not in data_array.dims:
+        return rank_many([data_array.values])[0]
+    ranks = rank_many(
+        [
+            data_array.isel({_MEMBER_DIM: i}).values
+            for i in range(data_array.sizes[_MEMBER_DIM])
+        ],
+    )
+    return np.moveaxis(ranks, 0, data_array.dims.index(_MEMBER_DIM))
+
+
+def _time_to_numeric(times: xr.DataArray) -> np.ndarray:
+    """Convert times to the numeric values that xr.DataArray.differentiate
+    uses (seconds for cftime objects, the native unit for datetime64)."""
+    values = times.values
+    if values.dtype.kind == 'M':
+        unit = np.datetime_data(values.dtype)[0]
+        return (values - values.min()) / np.timedelta64(1, unit)
+    if values.dtype.kind == 'O':
+        t_0 = min(values)
+        return np.array([(t - t_0).total_seconds() for t in values])
+    return values.astype(np.float64)
+
+
+def running_mean_criteria(
+    data_array: xr.DataArray,
+    time_var: str = 'time',
+    x_yr: int = 10,
+) -> ty.Dict[str, xr.DataArray]:
+    """Calculate all per-cell criteria of data_array in a single (parallel)
+    pass over the time series of each cell.
+
+    Time steps without any value (like the edges of a running mean) are ignored for the start,
+    end and derivative, like _remove_any_none_times does.
+
+    Args:
+        data_array (xr.DataArray): data with a time dimension
+        time_var (str, optional): name of the time dimension. Defaults to 'time'.
+        x_yr (int, optional): number of time steps for the max change. Defaults to 10.
+
+    Raises:
+        ValueError: if data_array only has NaN values
+
+    Returns:
+        ty.Dict[str, xr.DataArray]: maps of the start and end value, the start end difference,
+            std, mean, max change in x_yr, mean of all but the last x_yr time steps and the max
+            derivative (per year).
+    """
+    data_array = data_array.transpose(time_var, ...)
+    values = np.asarray(data_array.values)
+    shape = values.shape[1:]
+    len_y = shape[-1] if shape else 1
+    values_3d = values.reshape(len(values), -1, len_y)
+
+    valid_times = _valid_times_numba(values_3d)
+    if not np.any(valid_times):
+        raise ValueError(
+            f'This array only has NaN values, perhaps array too short ({len(valid_times)} < 10)?',
+        )
+    t_numeric = _time_to_numeric(data_array[time_var])
+    maps = _running_mean_criteria_numba(values_3d, valid_times, t_numeric, int(x_yr))
+
+    template = data_array.isel({time_var: 0}, drop=True)
+    template = template.drop_vars(
+        [c for c in template.coords if time_var in data_array[c].dims],
+    )
+    dtype = values.dtype if values.dtype.kind == 'f' else np.float64
+
+    def as_data_array(index: int, as_dtype=dtype) -> xr.DataArray:
+        return template.copy(
+            data=maps[index].reshape(shape).astype(as_dtype), deep=False
+        )
+
+    # Like data_array.isel(time=0), start and end keep their time stamp
+    valid_index = np.flatnonzero(valid_times)
+    start = as_data_array(0).assign_coords(
+        {time_var: data_array[time_var][valid_index[0]]},
+    )
+    end = as_data_array(1).assign_coords(
+        {time_var: data_array[time_var][valid_index[-1]]},
+    )
+    result = dict(
+        start=start,
+        end=end,
+        start_end_diff=end - start,
+        std=as_data_array(2),
+        mean=as_data_array(3),
+        max_change=as_data_array(4),
+        head_mean=as_data_array(5),
+        # Scale in float64 (the derivative is per second), but return the dtype of the input
+        max_derivative=(as_data_array(6, np.float64) * _SECONDS_TO_YEAR).astype(dtype),
+    )
+    for da in result.values():
+        da.attrs = {}
+    return result
+
+
 @timed
 @apply_abs()
 @check_accepts(accepts=dict(unit=('absolute', 'relative', 'std')))
@@ -239,6 +609,7 @@ def running_mean_diff(
     rename_to: str = 'long_name',
     unit: str = 'absolute',
     apply_abs: bool = True,
+    criteria: ty.Optional[ty.Mapping[str, xr.DataArray]] = None,
 ) -> xr.DataArray:  # type: ignore
     """Return difference in running mean of data set.
 
@@ -251,6 +622,8 @@ def running_mean_diff(
         rename_to (str, optional): . Defaults to 'long_name'.
         unit (str, optional): . Defaults to 'absolute'.
         apply_abs (bool, optional): . Defaults to True.
+        criteria (ty.Mapping[str, xr.DataArray], optional): output of running_mean_criteria for
+            the variable. Defaults to None (calculate them).
     Raises:
         ValueError: when no timestamps are not none?
 
@@ -263,12 +636,11 @@ def running_mean_diff(
     if not len(_time_values):
         raise ValueError(f'No values for {time_var} in data_set?')  # pragma: no cover
 
-    data_var = _remove_any_none_times(data_set[var_name], time_var)
+    data_var = data_set[var_name]
+    if criteria is None:
+        criteria = running_mean_criteria(data_var, time_var)
 
-    data_t_0 = data_var.isel(time=0)
-    data_t_1 = data_var.isel(time=-1)
-    result = data_t_1 - data_t_0
-    result = result.copy()
+    result = criteria['start_end_diff'].copy()
     var_unit = data_var.attrs.get('units', '{units}').replace('%', r'\%')
     name = data_var.attrs.get(rename_to, variable)
 
@@ -277,7 +649,7 @@ def running_mean_diff(
         return result
 
     if unit == 'relative':
-        result = 100 * result / data_t_0
+        result = 100 * result / criteria['start']
         result.name = fr't[-1] - t[0] / t[0] for {name} $\%$'
         return result
 
@@ -301,10 +673,12 @@ def running_mean_std(
     rename_to: str = 'long_name',
     apply_abs: bool = True,
     unit: str = 'absolute',
+    criteria: ty.Optional[ty.Mapping[str, xr.DataArray]] = None,
 ) -> xr.DataArray:  # type: ignore
     data_var = naming.format(variable=variable, running_mean=running_mean)
-    result = data_set[data_var].std(dim=time_var)
-    result = result.copy()
+    if criteria is None:
+        criteria = running_mean_criteria(data_set[data_var], time_var)
+    result = criteria['std'].copy()
     var_unit = data_set[data_var].attrs.get('units', '{units}').replace('%', r'\%')
     name = data_set[data_var].attrs.get(rename_to, variable)
 
@@ -313,7 +687,7 @@ def running_mean_std(
         return result
 
     if unit == 'relative':
-        result = 100 * result / data_set[data_var].mean(dim=time_var)
+        result = 100 * result / criteria['mean']
         result.name = fr'Relative Std. {name} [$\%$]'
         return result
 
@@ -336,15 +710,12 @@ def max_change_xyr(
     rename_to: str = 'long_name',
     apply_abs: bool = True,
     unit: str = 'absolute',
+    criteria: ty.Optional[ty.Mapping[str, xr.DataArray]] = None,
 ) -> xr.DataArray:  # type: ignore
     data_var = naming.format(variable=variable, running_mean=running_mean)
-    plus_x_yr = data_set.isel({time_var: slice(x_yr, None)})[data_var]
-    to_min_x_yr = data_set.isel({time_var: slice(None, -x_yr)})[data_var]
-
-    # Keep the metadata (and time stamps of the to_min_x_yr)
-    result = to_min_x_yr.copy(data=plus_x_yr.values - to_min_x_yr.values)
-    result.data = np.abs(result.values)
-    result = result.max(dim=time_var)
+    if criteria is None:
+        criteria = running_mean_criteria(data_set[data_var], time_var, x_yr=x_yr)
+    result = criteria['max_change'].copy()
     var_unit = data_set[data_var].attrs.get('units', '{units}').replace('%', r'\%')
     name = data_set[data_var].attrs.get(rename_to, variable)
 
@@ -353,7 +724,7 @@ def max_change_xyr(
         return result  # type: ignore
 
     if unit == 'relative':
-        result = 100 * result / to_min_x_yr.mean(dim=time_var)
+        result = 100 * result / criteria['head_mean']
         result.name = fr'{x_yr} yr diff. {name} [$\%$]'  # type: ignore
         return result  # type: ignore
 
@@ -363,6 +734,88 @@ def max_change_xyr(
         return result  # type: ignore
 
 
+@timed
+@apply_abs()
+@check_accepts(accepts=dict(unit=('absolute', 'relative', 'std')))
+def max_change_sweep(
+    data_set: xr.Dataset,
+    variable: str,
+    x_yrs: ty.Iterable[int] = (5, 10, 20),
+    time_var: str = 'time',
+    naming: str = '{variable}_run_mean_{running_mean}',
+    running_mean: int = 10,
+    rename_to: str = 'long_name',
+    apply_abs: bool = True,
+    unit: str = 'absolute',
+) -> xr.DataArray:  # type: ignore
+    """Calculate max_change_xyr for several x_yr at once, in a single pass
+    over the time series of each cell.
+
+    Args:
+        data_set (xr.Dataset): data set with the variable
+        variable (str): name of the variable
+        x_yrs (ty.Iterable[int], optional): number of time steps of each window. Defaults to
+            (5, 10, 20).
+        time_var (str, optional): name of the time dimension. Defaults to 'time'.
+        naming (str, optional): format of the variable to use. Defaults to
+            '{variable}_run_mean_{running_mean}'.
+        running_mean (int, optional): running mean to format naming with. Defaults to 10.
+        rename_to (str, optional): attribute to take the name of the variable from. Defaults to
+            'long_name'.
+        apply_abs (bool, optional): apply np.abs to the result. Defaults to True.
+        unit (str, optional): absolute, relative or std (normalized per window). Defaults to
+            'absolute'.
+
+    Returns:
+        xr.DataArray: max change with a "window" dimension, for each window equal to
+            max_change_xyr(..., x_yr=window).
+    """
+    x_yrs = np.atleast_1d(np.asarray(x_yrs, dtype=np.int64))
+    if not len(x_yrs) or np.any(x_yrs < 1):
+        raise ValueError(f'Windows should be at least one time step, got {x_yrs}')
+    data_var = naming.format(variable=variable, running_mean=running_mean)
+    data_array = data_set[data_var].transpose(time_var, ...)
+    values = np.asarray(data_array.values)
+    shape = values.shape[1:]
+    len_y = shape[-1] if shape else 1
+    maps = _max_change_sweep_numba(values.reshape(len(values), -1, len_y), x_yrs)
+
+    template = data_array.isel({time_var: 0}, drop=True)
+    template = template.drop_vars(
+        [c for c in template.coords if time_var in data_array[c].dims],
+    )
+    template.attrs = {}
+    window = xr.DataArray(x_yrs, dims='window', name='window')
+    dtype = values.dtype if values.dtype.kind == 'f' else np.float64
+
+    def as_data_array(index: int) -> xr.DataArray:
+        return xr.concat(
+            [
+                template.copy(data=m.reshape(shape).astype(dtype), deep=False)
+                for m in maps[index]
+            ],
+            dim=window,
+        )
+
+    result = as_data_array(0)
+    var_unit = data_set[data_var].attrs.get('units', '{units}').replace('%', r'\%')
+    name = data_set[data_var].attrs.get(rename_to, variable)
+
+    if unit == 'absolute':
+        result.name = f'Window yr diff. {name} [{var_unit}]'
+        return result
+
+    if unit == 'relative':
+        result = 100 * result / as_data_array(1)
+        result.name = fr'Window yr diff. {name} [$\%$]'
+        return result
+
+    if unit == 'std':
+        result = result / result.std(dim=[d for d in result.dims if d != 'window'])
+        result.name = fr'Window yr diff. {name} [$\sigma$]'
+        return result
+
+
 @timed
 @apply_abs()
 @check_accepts(accepts=dict(unit=('absolute', 'relative', 'std')))
@@ -375,13 +828,14 @@ def max_derivative(
     rename_to: str = 'long_name',
     apply_abs: bool = True,
     unit: str = 'absolute',
+    criteria: ty.Optional[ty.Mapping[str, xr.DataArray]] = None,
 ) -> xr.Dataset:  # type: ignore
     var_name = naming.format(variable=variable, running_mean=running_mean)
 
-    data_array = _remove_any_none_times(data_set[var_name], time_var)
-    result = (
-        np.abs(data_array.differentiate(time_var)).max(dim=time_var) * _SECONDS_TO_YEAR
-    )
+    data_array = data_set[var_name]
+    if criteria is None:
+        criteria = running_mean_criteria(data_array, time_var)
+    result = criteria['max_derivative'].copy()
 
     var_unit = data_array.attrs.get('units', '{units}').replace('%', r'\%')
     name = data_array.attrs.get(rename_to, variable)
@@ -391,7 +845,7 @@ def max_derivative(
         return result
 
     if unit == 'relative':
-        result = 100 * result / data_array.mean(dim=time_var)
+        result = 100 * result / criteria['mean']
         result.name = fr'Max $\partial/\partial t$ {name} [$\%$/yr]'
         return result
 
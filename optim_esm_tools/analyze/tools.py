@@ -1,5 +1,4 @@
 import numpy as np
-from scipy.interpolate import interp1d
 import statsmodels.api as sm
 import typing as ty
 import xarray as xr
@@ -7,37 +6,67 @@ import numba
 import json
 
 
-def _dinfo(a):
-    try:
-        return np.iinfo(a.dtype)
-    except ValueError:
-        return np.finfo(a.dtype)
+def rank2d(a: np.ndarray) -> np.ndarray:
+    """Get the percentile (as fraction) of each value in a, with respect to
+    all non-NaN values of a.
 
+    This is equivalent to (but much faster than)
+        from scipy.stats import percentileofscore
+        [[percentileofscore(a_flat, i, kind='mean') / 100 for i in aa] for aa in a]
+    so values that occur more than once get the mean of their percentiles.
 
-def rank2d(a):
-    nan_mask = np.isnan(a)
-    a_flat = a[~nan_mask].flatten().astype(np.float64)
-    dtype_info = _dinfo(a_flat)
+    Args:
+        a (np.ndarray): values to rank (NaN values are not ranked)
+
+    Returns:
+        np.ndarray: float32 ranks between 0 and 1 (NaN where a is NaN)
+    """
+    return rank_many([a])[0]
+
+
+def rank_many(arrays: ty.Sequence[np.ndarray]) -> np.ndarray:
+    """Rank several arrays of the same shape in one call, see rank2d.
+
+    Args:
+        arrays (ty.Sequence[np.ndarray]): arrays to rank, each with respect to its own values
+
+    Returns:
+        np.ndarray: float32 ranks with shape (len(arrays), *arrays[0].shape)
+    """
+    arrays = [np.asarray(a) for a in arrays]
+    shapes = {a.shape for a in arrays}
+    if len(shapes) != 1:
+        raise ValueError(f'All arrays should have the same shape, got {shapes}')
+    (shape,) = shapes
+    data = np.stack([a.reshape(-1) for a in arrays]).astype(np.float64)
     # Clip infinite from values - they will get ~0 or ~1 for -np.inf and np.inf respectively
-    a_flat = np.clip(a_flat, dtype_info.min, dtype_info.max)
-
-    # This is equivalent to (but much faster than)
-    # from scipy.stats import percentileofscore
-    # import optim_esm_tools as oet
-    # pcts = [[percentileofscore(a_flat, i, kind='mean') / 100 for i in aa]
-    #         for aa in oet.utils.tqdm(a)]
-    # return pcts
-    a_sorted, count = np.unique(a_flat, return_counts=True)
-    # One value can occur more than once, get the center x value for that case
-    cumsum_high = (np.cumsum(count) / len(a_flat)).astype(np.float64)
-    cumsum_low = np.zeros_like(cumsum_high)
-    cumsum_low[1:] = cumsum_high[:-1]
-    cumsum = (cumsum_high + cumsum_low) / 2
-    itp = interp1d(a_sorted, cumsum, bounds_error=True, kind='linear')
-
-    result = np.empty_like(a, dtype=np.float32)
-    result[:] = np.nan
-    result[~nan_mask] = itp(a_flat)
+    dtype_info = np.finfo(np.float64)
+    data = np.clip(data, dtype_info.min, dtype_info.max)
+    result = np.empty(data.shape, dtype=np.float32)
+    for row, values in enumerate(data):
+        result[row] = _rank_flat(values)
+    return result.reshape(len(arrays), *shape)
+
+
+def _rank_flat(values: np.ndarray) -> np.ndarray:
+    result = np.full(values.shape, np.nan, dtype=np.float32)
+    valid = ~np.isnan(values)
+    valid_values = values[valid]
+    n_valid = len(valid_values)
+    if not n_valid:
+        return result
+    # A single sort, values that occur more than once form a group of equal sorted values
+    order = np.argsort(valid_values)
+    sorted_values = valid_values[order]
+    new_group = np.empty(n_valid, dtype=np.bool_)
+    new_group[0] = True
+    np.not_equal(sorted_values[1:], sorted_values[:-1], out=new_group[1:])
+    starts = np.flatnonzero(new_group)
+    ends = np.append(starts[1:], n_valid)
+    # The mean of the fraction of values below and the fraction at or below each group
+    ranks = np.empty(n_valid, dtype=np.float32)
+    ranks[order] = ((starts + ends) / (2 * n_valid))[np.cumsum(new_group) - 1]
+    result[valid] = ranks
     return result
 
 
@@ -104,12 +133,51 @@ def _smooth_lowess(x: np.ndarray, y: np.ndarray, ret_slice: slice, **kw) -> np.n
     return smoothed.T[ret_slice].squeeze()
 
 
+def running_mean(a: np.ndarray, window: int, skip_nan: bool = False) -> np.ndarray:
+    """Running mean of a (1D), where the mean of a[k: k + window] is stored
+    at index k + window - window // 2.
+
+    Args:
+        a (np.ndarray): values
+        window (int): number of values per mean
+        skip_nan (bool, optional): skip NaN values (see rolling_mean). Defaults to False, where a
+            NaN value makes all following running means NaN.
+
+    Returns:
+        np.ndarray: running mean
+    """
+    if skip_nan:
+        return _skip_nan_running_mean(a, window)
+    return _running_mean_numba(a, window)
+
+
+def running_mean_array(
+    a: np.ndarray,
+    window: int,
+    skip_nan: bool = False,
+) -> np.ndarray:
+    """Running mean of a (time, x, y) along time, see running_mean."""
+    if skip_nan:
+        return _skip_nan_running_mean(a, window)
+    return _running_mean_array_numba(a, window)
+
+
+def _skip_nan_running_mean(a: np.ndarray, window: int) -> np.ndarray:
+    means = rolling_mean(a, window)[0]
+    # rolling_mean stores the means at k + window // 2, which is one step earlier for odd windows
+    res = np.full_like(means, np.nan)
+    shift = window % 2
+    res[shift:] = means[: len(means) - shift]
+    return res
+
+
 @numba.njit
-def running_mean(a: np.ndarray, window: int) -> np.ndarray:
+def _running_mean_numba(a: np.ndarray, window: int) -> np.ndarray:
     res = np.zeros_like(a)
     res[:] = np.nan
     half_win = window // 2
-    mean = 0
+    # Accumulate in float64, also for float32 input
+    mean = 0.0
     for i, v in enumerate(a):
         mean += v
         if i >= window:
@@ -120,13 +188,461 @@ def running_mean(a: np.ndarray, window: int) -> np.ndarray:
 
 
 @numba.njit
-def running_mean_array(a: np.ndarray, window: int) -> np.ndarray:
+def _running_mean_array_numba(a: np.ndarray, window: int) -> np.ndarray:
     _, len_x, len_y = a.shape
     res = np.zeros_like(a)
     res[:] = np.nan
     for i in range(len_x):
         for j in range(len_y):
-            res[:, i, j] = running_mean(a[:, i, j], window)
+            res[:, i, j] = _running_mean_numba(a[:, i, j], window)
+    return res
+
+
+def _as_windows(windows: ty.Union[int, ty.Sequence[int]]) -> np.ndarray:
+    windows = np.atleast_1d(np.asarray(windows, dtype=np.int64))
+    if not len(windows) or np.any(windows < 1):
+        raise ValueError(f'Windows should be positive, got {windows}')
+    return windows
+
+
+def _as_cells(values: np.ndarray) -> np.ndarray:
+    """View values (time, ...) as (time, cells), keeping float dtypes."""
+    values = np.asarray(values)
+    if values.dtype.kind != 'f':
+        values = values.astype(np.float64)
+    return values.reshape(len(values), -1)
+
+
+def rolling_mean(
+    values: np.ndarray,
+    windows: ty.Union[int, ty.Sequence[int]],
+    min_count: int = 1,
+    skip_nan: bool = True,
+) -> np.ndarray:
+    """Centered running mean along the first (time) axis for each of the
+    windows, calculated in one pass over the data.
+
+    The mean of values[k: k + window] is stored at index k + window // 2, the first and last time
+    steps (that do not have a full window) are NaN. The sums are calculated in float64.
+
+    Args:
+        values (np.ndarray): array (time, ...)
+        windows (ty.Union[int, ty.Sequence[int]]): one or more window lengths (time steps)
+        min_count (int, optional): minimal number of valid values in a window. Defaults to 1.
+        skip_nan (bool, optional): skip NaN values, the mean of a window is NaN if it has less
+            than min_count valid values. If False, all windows from the first NaN value onwards
+            are NaN (like running_mean). Defaults to True.
+
+    Returns:
+        np.ndarray: means with shape (len(windows), *values.shape), in the dtype of values
+            (float64 if values are not floats)
+    """
+    windows = _as_windows(windows)
+    res = _rolling_moment_numba(_as_cells(values), windows, int(min_count), skip_nan, 0)
+    return res.reshape(len(windows), *np.shape(values))
+
+
+def rolling_std(
+    values: np.ndarray,
+    windows: ty.Union[int, ty.Sequence[int]],
+    min_count: int = 2,
+    skip_nan: bool = True,
+) -> np.ndarray:
+    """Centered running standard deviation (ddof=0) along the first (time)
+    axis, see rolling_mean.
+
+    Returns:
+        np.ndarray: standard deviations with shape (len(windows), *values.shape)
+    """
+    windows = _as_windows(windows)
+    res = _rolling_moment_numba(_as_cells(values), windows, int(min_count), skip_nan, 1)
+    return res.reshape(len(windows), *np.shape(values))
+
+
+def rolling_mean_summary(
+    values: np.ndarray,
+    windows: ty.Union[int, ty.Sequence[int]],
+    lags: ty.Union[None, int, ty.Sequence[int]] = None,
+    min_count: int = 1,
+    skip_nan: bool = True,
+) -> ty.Dict[str, np.ndarray]:
+    """Summarize the running means (see rolling_mean) of each cell, without
+    storing the running means themselves.
+
+    Args:
+        values (np.ndarray): array (time, ...)
+        windows (ty.Union[int, ty.Sequence[int]]): one or more window lengths (time steps)
+        lags (ty.Union[None, int, ty.Sequence[int]], optional): number of time steps for the
+            max_difference, one for all or one per window. Defaults to None (the window).
+        min_count (int, optional): minimal number of valid values in a window. Defaults to 1.
+        skip_nan (bool, optional): skip NaN values, see rolling_mean. Defaults to True.
+
+    Returns:
+        ty.Dict[str, np.ndarray]: arrays with shape (len(windows), *values.shape[1:]) of
+            std: standard deviation (ddof=0) of the running mean over time
+            max_difference: max of abs(running_mean[t + lag] - running_mean[t])
+            max: maximum of the running mean
+            min: minimum of the running mean
+    """
+    windows = _as_windows(windows)
+    lags = windows if lags is None else np.asarray(lags, dtype=np.int64)
+    lags = np.broadcast_to(lags, windows.shape).copy()
+    res = _rolling_mean_summary_numba(
+        _as_cells(values),
+        windows,
+        lags,
+        int(min_count),
+        skip_nan,
+    )
+    shape = (len(windows), *np.shape(values)[1:])
+    return {
+        name: res[i].reshape(shape)
+        for i, name in enumerate(['std', 'max_difference', 'max', 'min'])
+    }
+
+
+@numba.njit
+def _prefix_sums(
+    series: np.ndarray,
+    shift: float,
+    count: np.ndarray,
+    total: np.ndarray,
+    total_sq: np.ndarray,
+) -> None:
+    """Cumulative count, sum and sum of squares of the valid values of series
+    minus shift, where count[k] covers series[:k].
+
+    Shifting by a typical value (like the first valid value) keeps the
+    sum of squares accurate.
+    """
+    for k in range(len(series)):
+        count[k + 1] = count[k]
+        total[k + 1] = total[k]
+        total_sq[k + 1] = total_sq[k]
+        if not np.isnan(series[k]):
+            delta = series[k] - shift
+            count[k + 1] += 1
+            total[k + 1] += delta
+            total_sq[k + 1] += delta * delta
+
+
+@numba.njit
+def _window_moment(
+    count: np.ndarray,
+    total: np.ndarray,
+    total_sq: np.ndarray,
+    shift: float,
+    window: int,
+    min_count: int,
+    end: int,
+    moment: int,
+    out: np.ndarray,
+) -> None:
+    """Mean (moment 0) or standard deviation (moment 1) of each window that
+    ends before end, stored at k + window // 2 in out."""
+    out[:] = np.nan
+    for k in range(end - window + 1):
+        n = count[k + window] - count[k]
+        if n < min_count or n == 0:
+            continue
+        mean = (total[k + window] - total[k]) / n
+        if moment == 0:
+            out[k + window // 2] = shift + mean
+        else:
+            var = (total_sq[k + window] - total_sq[k]) / n - mean * mean
+            out[k + window // 2] = np.sqrt(max(var, 0.0))
+
+
+@numba.njit
+def _first_valid(series: np.ndarray) -> float:
+    for value in series:
+        if not np.isnan(value):
+            return value
+    return 0.0
+
+
+@numba.njit
+def _valid_end(series: np.ndarray, skip_nan: bool) -> int:
+    """Windows should end before this index, the first NaN value unless
+    skip_nan."""
+    if not skip_nan:
+        for k in range(len(series)):
+            if np.isnan(series[k]):
+                return k
+    return len(series)
+
+
+@numba.njit(parallel=True)
+def _rolling_moment_numba(
+    data: np.ndarray,
+    windows: np.ndarray,
+    min_count: int,
+    skip_nan: bool,
+    moment: int,
+) -> np.ndarray:
+    """Running means (moment 0) or standard deviations (moment 1) of data
+    (time, cells), with shape (len(windows), time, cells) and the dtype of
+    data."""
+    len_t, n_cells = data.shape
+    res = np.empty((len(windows), len_t, n_cells), dtype=data.dtype)
+    for j in numba.prange(n_cells):
+        series = data[:, j].astype(np.float64)
+        count = np.zeros(len_t + 1)
+        total = np.zeros(len_t + 1)
+        total_sq = np.zeros(len_t + 1)
+        shift = _first_valid(series)
+        _prefix_sums(series, shift, count, total, total_sq)
+        end = _valid_end(series, skip_nan)
+        out = np.empty(len_t)
+        for w in range(len(windows)):
+            _window_moment(
+                count,
+                total,
+                total_sq,
+                shift,
+                windows[w],
+                min_count,
+                end,
+                moment,
+                out,
+            )
+            res[w, :, j] = out
+    return res
+
+
+@numba.njit(parallel=True)
+def _rolling_mean_summary_numba(
+    data: np.ndarray,
+    windows: np.ndarray,
+    lags: np.ndarray,
+    min_count: int,
+    skip_nan: bool,
+) -> np.ndarray:
+    """Std, max lagged difference, max and min of the running means of data
+    (time, cells), with shape (4, len(windows), cells)."""
+    len_t, n_cells = data.shape
+    res = np.full((4, len(windows), n_cells), np.nan)
+    for j in numba.prange(n_cells):
+        series = data[:, j].astype(np.float64)
+        count = np.zeros(len_t + 1)
+        total = np.zeros(len_t + 1)
+        total_sq = np.zeros(len_t + 1)
+        shift = _first_valid(series)
+        _prefix_sums(series, shift, count, total, total_sq)
+        end = _valid_end(series, skip_nan)
+        means = np.empty(len_t)
+        for w in range(len(windows)):
+            _window_moment(
+                count,
+                total,
+                total_sq,
+                shift,
+                windows[w],
+                min_count,
+                end,
+                0,
+                means,
+            )
+            # Welford's algorithm for the standard deviation over time
+            n = 0
+            mean = 0.0
+            m_2 = 0.0
+            max_diff = -1.0
+            for k in range(len_t):
+                value = means[k]
+                if np.isnan(value):
+                    continue
+                n += 1
+                delta = value - mean
+                mean += delta / n
+                m_2 += delta * (value - mean)
+                if n == 1 or value > res[2, w, j]:
+                    res[2, w, j] = value
+                if n == 1 or value < res[3, w, j]:
+                    res[3, w, j] = value
+                if k >= lags[w] and not np.isnan(means[k - lags[w]]):
+                    max_diff = max(max_diff, abs(value - means[k - lags[w]]))
+            if n:
+                res[0, w, j] = np.sqrt(m_2 / n)
+            # Absolute differences are >= 0, so a negative value marks no valid pair
+            if max_diff >= 0:
+                res[1, w, j] = max_diff
+    return res.astype(data.dtype)
+
+
+@numba.njit
+def _valid_times_numba(data: np.ndarray) -> np.ndarray:
+    """For each time step of data (time, x, y), does it have any non-NaN
+    value?"""
+    len_t, len_x, len_y = data.shape
+    res = np.zeros(len_t, dtype=np.bool_)
+    for t in range(len_t):
+        for i in range(len_x):
+            for j in range(len_y):
+                if not np.isnan(data[t, i, j]):
+                    res[t] = True
+                    break
+            if res[t]:
+                break
+    return res
+
+
+@numba.njit
+def _gradient_at(
+    data: np.ndarray,
+    t_numeric: np.ndarray,
+    kept: np.ndarray,
+    k: int,
+    i: int,
+    j: int,
+) -> float:
+    """Gradient at kept time step k, like np.gradient(edge_order=1) for non-
+    uniform spacing."""
+    n_kept = len(kept)
+    if k == 0:
+        t0, t1 = kept[0], kept[1]
+        return (data[t1, i, j] - data[t0, i, j]) / (t_numeric[t1] - t_numeric[t0])
+    if k == n_kept - 1:
+        t0, t1 = kept[k - 1], kept[k]
+        return (data[t1, i, j] - data[t0, i, j]) / (t_numeric[t1] - t_numeric[t0])
+    t0, t1, t2 = kept[k - 1], kept[k], kept[k + 1]
+    h_s = t_numeric[t1] - t_numeric[t0]
+    h_d = t_numeric[t2] - t_numeric[t1]
+    return (
+        -h_d / (h_s * (h_d + h_s)) * data[t0, i, j]
+        + (h_d - h_s) / (h_d * h_s) * data[t1, i, j]
+        + h_s / (h_d * (h_d + h_s)) * data[t2, i, j]
+    )
+
+
+@numba.njit(parallel=True)
+def _running_mean_criteria_numba(
+    data: np.ndarray,
+    valid_times: np.ndarray,
+    t_numeric: np.ndarray,
+    x_yr: int,
+) -> np.ndarray:
+    """Calculate the per-cell criteria of data (time, x, y) in a single pass
+    over the time axis.
+
+    Rows of x are processed in parallel, for each row only a few arrays of
+    length y are allocated, and data is read in memory order.
+
+    Args:
+        data (np.ndarray): data with time as the first axis
+        valid_times (np.ndarray): time steps that have any non-NaN value, only these are used for
+            the start-end difference and the derivative.
+        t_numeric (np.ndarray): numeric time of each time step
+        x_yr (int): number of time steps for the max change
+
+    Returns:
+        np.ndarray: array of shape (7, x, y) with the start value, end value, std (ddof=0) and mean
+            (both NaN-skipping), max abs change in x_yr time steps, mean of the first
+            len(time) - x_yr time steps and the max abs derivative (in units of t_numeric).
+    """
+    len_t, len_x, len_y = data.shape
+    res = np.full((7, len_x, len_y), np.nan)
+    kept = np.flatnonzero(valid_times)
+    n_kept = len(kept)
+    kept_index = np.full(len_t, -1)
+    for k in range(n_kept):
+        kept_index[kept[k]] = k
+    len_head = len_t - x_yr
+
+    for i in numba.prange(len_x):
+        count = np.zeros(len_y)
+        mean = np.zeros(len_y)
+        m_2 = np.zeros(len_y)
+        head_count = np.zeros(len_y)
+        head_sum = np.zeros(len_y)
+        # Absolute values are >= 0, so negative values mark cells without any valid value
+        max_change = np.full(len_y, -1.0)
+        max_derivative = np.full(len_y, -1.0)
+        for t in range(len_t):
+            k = kept_index[t]
+            for j in range(len_y):
+                v = data[t, i, j]
+                if not np.isnan(v):
+                    count[j] += 1
+                    delta = v - mean[j]
+                    mean[j] += delta / count[j]
+                    m_2[j] += delta * (v - mean[j])
+                    if t < len_head:
+                        head_count[j] += 1
+                        head_sum[j] += v
+                if t >= x_yr:
+                    # Comparisons with NaN are False, so these are skipped
+                    change = abs(v - data[t - x_yr, i, j])
+                    if change > max_change[j]:
+                        max_change[j] = change
+                # The derivative at a kept step is known once the next one is read
+                if k >= 1:
+                    derivative = abs(_gradient_at(data, t_numeric, kept, k - 1, i, j))
+                    if derivative > max_derivative[j]:
+                        max_derivative[j] = derivative
+                if k >= 1 and k == n_kept - 1:
+                    derivative = abs(_gradient_at(data, t_numeric, kept, k, i, j))
+                    if derivative > max_derivative[j]:
+                        max_derivative[j] = derivative
+
+        for j in range(len_y):
+            if n_kept:
+                res[0, i, j] = data[kept[0], i, j]
+                res[1, i, j] = data[kept[-1], i, j]
+            if count[j]:
+                res[2, i, j] = np.sqrt(m_2[j] / count[j])
+                res[3, i, j] = mean[j]
+            if max_change[j] >= 0:
+                res[4, i, j] = max_change[j]
+            if head_count[j]:
+                res[5, i, j] = head_sum[j] / head_count[j]
+            if max_derivative[j] >= 0:
+                res[6, i, j] = max_derivative[j]
+    return res
+
+
+@numba.njit(parallel=True)
+def _max_change_sweep_numba(data: np.ndarray, x_yrs: np.ndarray) -> np.ndarray:
+    """Calculate the max abs change in x_yr time steps of data (time, x, y)
+    for each of x_yrs in a single pass over the time axis.
+
+    Args:
+        data (np.ndarray): data with time as the first axis
+        x_yrs (np.ndarray): number of time steps (at least one) for each window
+
+    Returns:
+        np.ndarray: array of shape (2, len(x_yrs), x, y) with the max abs change and the mean of the
+            first len(time) - x_yr time steps (NaN-skipping) for each window.
+    """
+    len_t, len_x, len_y = data.shape
+    n_windows = len(x_yrs)
+    res = np.full((2, n_windows, len_x, len_y), np.nan)
+
+    for i in numba.prange(len_x):
+        count = np.zeros(len_y)
+        total = np.zeros(len_y)
+        # Absolute values are >= 0, so negative values mark cells without any valid value
+        max_change = np.full((n_windows, len_y), -1.0)
+        for t in range(len_t):
+            for j in range(len_y):
+                v = data[t, i, j]
+                for w in range(n_windows):
+                    x_yr = x_yrs[w]
+                    if t >= x_yr:
+                        # Comparisons with NaN are False, so these are skipped
+                        change = abs(v - data[t - x_yr, i, j])
+                        if change > max_change[w, j]:
+                            max_change[w, j] = change
+                    if t == len_t - x_yr and count[j]:
+                        res[1, w, i, j] = total[j] / count[j]
+                if not np.isnan(v):
+                    count[j] += 1
+                    total[j] += v
+
+        for w in range(n_windows):
+            for j in range(len_y):
+                if max_change[w, j] >= 0:
+                    res[0, w, i, j] = max_change[w, j]
     return res
 
 
@@ -292,7 +808,8 @@ def weighted_mean_array(
     has_time_dim = time_field in da_sel.dims
 
     data = da_sel.values
-    weights = _ds[area_field].values
+    # The products (and therefore the sums) are float64, also for float32 data
+    weights = _ds[area_field].values.astype(np.float64, copy=False)
     kw = dict(data=data, weights=weights, has_time_dim=has_time_dim)
     if method == "numba":
         res_arr = _weighted_mean_array_numba(**kw)  # type: ignore
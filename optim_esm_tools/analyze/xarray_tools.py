@@ -178,6 +178,7 @@ def mask_to_reduced_dataset(
     mask: ty.Union[xr.DataArray, np.ndarray],
     add_global_mask: bool = True,
     _fall_back_field: str = 'cell_area',
+    save_as: ty.Optional[str] = None,
     **kw,
 ) -> xr.Dataset:
     """Reduce data_set by dropping all data where mask is False. This greatly
@@ -189,6 +190,8 @@ def mask_to_reduced_dataset(
         mask (ty.Union[xr.DataArray, np.ndarray]): boolean array to mask
         add_global_mask (bool, optional): Add global mask with full dimensionality (see
             rename_mask_coords for more info). Defaults to True.
+        save_as (str, optional): store the result here, as a zarr store if it ends with ".zarr"
+            and as netCDF otherwise (see io.save_ds). Defaults to None.
 
     Raises:
         ValueError: If mask has a wrong shape
@@ -215,6 +218,10 @@ def mask_to_reduced_dataset(
     ds_masked = mask_xr_ds(data_set.copy(), mask, drop=True, **kw)
     if add_global_mask:
         ds_masked = add_mask_renamed(ds_masked, mask)
+    if save_as is not None:
+        from optim_esm_tools.analyze.io import save_ds
+
+        save_ds(ds_masked, save_as)
     return ds_masked
 
 
@@ -547,3 +554,34 @@ def set_time_int(ds: xr.Dataset) -> xr.Dataset:
         ), 'Data has one or more non-unique years!'
         ds['time'] = years
     return ds
+
+
+@check_accepts(accepts=dict(precision=(None, 'float32', 'float64')))
+def set_precision(
+    data_set: xr.Dataset,
+    precision: ty.Optional[str] = None,
+    keep: ty.Iterable[str] = ('cell_area',),
+) -> xr.Dataset:
+    """Cast the floating point data variables of data_set to precision.
+    Variables are never cast to a higher precision than they have.
+
+    Args:
+        data_set (xr.Dataset): dataset to cast
+        precision (str, optional): float32 or float64. Defaults to None and is taken from config.
+        keep (ty.Iterable[str], optional): variables to keep as they are. The cell_area is used
+            as weight in sums, so it is kept by default.
+
+    Returns:
+        xr.Dataset: dataset with the floating point variables at (at most) precision
+    """
+    dtype = np.dtype(precision or config['analyze'].get('precision', 'float64'))
+    cast = {
+        name: data_array.astype(dtype)
+        for name, data_array in data_set.data_vars.items()
+        if name not in keep
+        and data_array.dtype.kind == 'f'
+        and data_array.dtype.itemsize > dtype.itemsize
+    }
+    if not cast:
+        return data_set
+    return data_set.assign(cast)
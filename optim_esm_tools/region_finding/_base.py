@@ -123,6 +123,21 @@ class RegionExtractor:
             self._logger = oet.config.get_logger(f'{self.__class__.__name__}')
         return self._logger
 
+    @classmethod
+    def required_variables(
+        cls,
+        variable: str,
+        running_mean: int,
+    ) -> ty.Tuple[str, ...]:
+        """The variables (besides the coordinates) that get_masks reads from
+        the data_set.
+
+        :param variable: The variable_id of the data_set
+        :param running_mean: The moving average window of the data_set
+        :return: The results of the criteria and the cell_area
+        """
+        return (*(c.short_description for c in cls.criteria), 'cell_area')
+
     def get_masks(self) -> _mask_cluster_type:  # pragma: no cover
         raise NotImplementedError(
             f'{self.__class__.__name__} has no get_masks',
@@ -168,7 +183,7 @@ class RegionExtractor:
         except Exception as e:  # pragma: no cover
             raise ValueError(mask) from e
         self.check_shape(mask)
-        return self.data_set['cell_area'].values[mask]
+        return oet.analyze.grid_registry.cell_area(self.data_set)[mask]
 
     def check_shape(
         self,
@@ -7,6 +7,14 @@ import optim_esm_tools as oet
 
 
 class MaskAll(RegionExtractor):
+    @classmethod
+    def required_variables(
+        cls,
+        variable: str,
+        running_mean: int,
+    ) -> ty.Tuple[str, ...]:
+        return (variable, 'cell_area')
+
     @apply_options
     def get_masks(
         self,
@@ -14,6 +14,14 @@ class _NamedRegions(RegionExtractor):
 
     _default_regions: ty.Tuple[str, ...]
 
+    @classmethod
+    def required_variables(
+        cls,
+        variable: str,
+        running_mean: int,
+    ) -> ty.Tuple[str, ...]:
+        return (variable, 'cell_area')
+
     @apply_options
     def get_masks(
         self,
@@ -11,9 +11,9 @@ from ._base import _two_sigma_percent
 from ._base import apply_options
 from ._base import plt_show
 from ._base import RegionExtractor
-from optim_esm_tools.analyze import tipping_criteria
 from optim_esm_tools.analyze.clustering import build_cluster_mask
 from optim_esm_tools.analyze.clustering import build_weighted_cluster
+from optim_esm_tools.analyze.tools import rank_many
 from optim_esm_tools.analyze.xarray_tools import mask_xr_ds
 from optim_esm_tools.plotting.plot import _show
 from optim_esm_tools.plotting.plot import setup_map
@@ -200,12 +200,7 @@ class Percentiles(RegionExtractor):
         :type labels: ty.List[str]
         :return: a numpy array of type np.float64.
         """
-        sums = []
-        for lab in labels:
-            vals = self.data_set[lab].values
-            vals = tipping_criteria.rank2d(vals)
-            vals[np.isnan(vals)] = 0
-            sums.append(vals)
+        sums = [np.where(np.isnan(vals), 0, vals) for vals in self._ranks(labels)]
 
         tot_sum = np.zeros_like(sums[0], dtype=np.float64)
         for s in sums:
@@ -223,16 +218,35 @@ class Percentiles(RegionExtractor):
         :type labels: ty.List[str]
         :return: a NumPy array of type np.float64.
         """
-        ds = self.data_set.copy()
-        combined_score = np.ones_like(ds[labels[0]].values, dtype=np.float64)
-
-        for label in labels:
-            try:
-                combined_score *= tipping_criteria.rank2d(ds[label].values)
-            except ValueError:
-                raise ValueError(ds[label].values, label)
+        combined_score = np.ones_like(self.data_set[labels[0]].values, dtype=np.float64)
+        for rank in self._ranks(labels):
+            combined_score *= rank
         return combined_score
 
+    def _ranks(self, labels: ty.List[str]) -> ty.List[npt.NDArray[np.float32]]:
+        """Get the ranks (see tools.rank2d) of the labels in the data set.
+
+        The ranks are stored per (data set, label), such that iterating over thresholds (like
+        IterProductPercentiles) ranks each label only once. The labels that are not stored yet are
+        ranked in one call.
+
+        :param labels: A list of strings representing the labels of the data set
+        :type labels: ty.List[str]
+        :return: a list of read-only float32 arrays, one for each label.
+        """
+        cache = self.__dict__.setdefault('_rank_cache', {})
+        missing = [
+            lab
+            for lab in dict.fromkeys(labels)
+            if lab not in cache or cache[lab][0] is not self.data_set
+        ]
+        if missing:
+            ranks = rank_many([self.data_set[lab].values for lab in missing])
+            for lab, rank in zip(missing, ranks):
+                rank.flags.writeable = False
+                cache[lab] = (self.data_set, rank)
+        return [cache[lab][1] for lab in labels]
+
     def _product_rank_past_threshold(
         self,
         labels: ty.List[str],
@@ -1,11 +1,14 @@
+import contextlib
 import inspect
 import os
 import socket
 import sys
+import tempfile
 import time
 import typing as ty
 import warnings
 from collections import defaultdict
+from functools import lru_cache
 from functools import wraps
 from importlib import import_module
 from platform import python_version
@@ -346,3 +349,135 @@ def scientific_latex_notation(
 
         return res
     return value
+
+
+def atomic_publish(
+    write: ty.Callable[[str], None],
+    path: str,
+    suffix: str,
+    directory: bool = False,
+) -> None:
+    """Write to a temporary file using write(tmp_path) and move it to path,
+    such that parallel processes never read a partial file.
+
+    Args:
+        write (ty.Callable[[str], None]): function that writes to the path it is given
+        path (str): final destination
+        suffix (str): suffix of the temporary file (some writers infer the format from it)
+        directory (bool, optional): write creates a directory (like a zarr store) instead of a
+            file. An existing directory at path is only removed once the new one is complete.
+            Defaults to False.
+    """
+    head = os.path.split(path)[0]
+    if directory:
+        import shutil
+
+        tmp_path = tempfile.mkdtemp(dir=head, suffix=suffix)
+        old_path = f'{tmp_path}.old'
+        try:
+            write(tmp_path)
+            # mkdtemp creates the directory with 0o700, use the permissions of a normal directory
+            os.chmod(tmp_path, _umask_mode(0o777))
+            if os.path.exists(path):
+                # Directories cannot replace non-empty directories, so move the old one first
+                os.replace(path, old_path)
+            os.replace(tmp_path, path)
+        finally:
+            for leftover in tmp_path, old_path:
+                if os.path.exists(leftover):
+                    shutil.rmtree(leftover)
+        return
+    with tempfile.NamedTemporaryFile(dir=head, suffix=suffix, delete=False) as tmp:
+        tmp_path = tmp.name
+    try:
+        write(tmp_path)
+        # NamedTemporaryFile creates the file with 0o600, use the permissions of a normal file
+        os.chmod(tmp_path, _umask_mode(0o666))
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):  # pragma: no cover
+            os.remove(tmp_path)
+
+
+def _umask_mode(mode: int) -> int:
+    """Permissions of a file created with mode, given the umask."""
+    return mode & ~_umask()
+
+
+@lru_cache(maxsize=None)
+def _umask() -> int:
+    """Get the umask from the permissions of a probe file.
+
+    os.umask can only be read by setting it, which would change it for
+    all threads (and the subprocesses they start) in the meantime.
+    """
+    probe = os.path.join(
+        tempfile.gettempdir(),
+        f'.oet_umask_{os.getpid()}_{time.time_ns()}',
+    )
+    fd = os.open(probe, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o777)
+    try:
+        return 0o777 & ~os.stat(probe).st_mode
+    finally:
+        os.close(fd)
+        os.remove(probe)
+
+
+@contextlib.contextmanager
+def file_lock(path: str, enabled: bool = True) -> ty.Iterator[None]:
+    """Hold an exclusive lock (on the hidden file ".<name>.lock" next to path)
+    while in the context, such that only one process at a time works on path.
+    If the lock file cannot be created (e.g. in a read-only folder), continue
+    without the lock.
+
+    The lock file is removed when the lock is released. A process that was
+    waiting on the removed file notices this and locks the new file instead.
+
+    Args:
+        path (str): path of the file to lock
+        enabled (bool, optional): if False, don't lock. Defaults to True.
+    """
+    try:
+        import fcntl
+    except ImportError:  # pragma: no cover
+        fcntl = None  # type: ignore
+    if not enabled or fcntl is None:
+        yield
+        return
+    from optim_esm_tools.config import get_logger
+
+    head, tail = os.path.split(path)
+    lock_path = os.path.join(head, f'.{tail}.lock')
+    while True:
+        try:
+            lock_file = open(lock_path, 'a')
+        except OSError as e:
+            get_logger().warning(f'Cannot lock {path} ({e}), continuing without lock')
+            yield
+            return
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            get_logger().warning(f'Waiting for another process working on {path}')
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        if _same_file(lock_file, lock_path):
+            break
+        # The previous holder removed the lock file while we were waiting
+        lock_file.close()
+    with lock_file:
+        try:
+            yield
+        finally:
+            try:
+                os.remove(lock_path)
+            except OSError:  # pragma: no cover
+                pass
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def _same_file(file: ty.IO, path: str) -> bool:
+    """Is the open file still the one at path?"""
+    try:
+        return os.path.samestat(os.fstat(file.fileno()), os.stat(path))
+    except FileNotFoundError:
+        return False
@@ -0,0 +1,49 @@
+import os
+import tempfile
+import unittest
+
+import optim_esm_tools as oet
+from optim_esm_tools.analyze.batch import BatchJournal
+from optim_esm_tools.analyze.batch import read_ds_batch
+
+
+class TestBatch(unittest.TestCase):
+    def test_read_ds_batch(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            paths = []
+            for i in range(3):
+                path = os.path.join(temp_dir, f'folder_{i}')
+                os.makedirs(path)
+                ds = oet._test_utils.complete_ds(len_x=36, len_y=18, len_time=20)
+                if i < 2:
+                    ds.to_netcdf(os.path.join(path, 'merged.nc'))
+                paths.append(path)
+            journal = os.path.join(temp_dir, 'journal.jsonl')
+            kw = dict(
+                journal=journal,
+                n_workers=2,
+                max_temp_gb=1e-9,
+                read_ds_kw=dict(
+                    _skip_folder_info=True,
+                    variable_of_interest='var',
+                    max_time=None,
+                    pre_proc_kw=dict(engine='numpy'),
+                ),
+            )
+            result = read_ds_batch(paths, **kw)
+            assert sorted(result['done']) == paths[:2]
+            assert result['failed'] == paths[2:]
+            entries = BatchJournal(journal).entries()
+            assert entries[paths[2]]['status'] == 'failed'
+            assert 'FileNotFoundError' in entries[paths[2]]['message']
+            for path in paths[:2]:
+                assert any(
+                    f.endswith('.nc') and f != 'merged.nc' for f in os.listdir(path)
+                )
+
+            # Resume, only the failed path should be retried
+            result = read_ds_batch(paths, retry_failed=True, **kw)
+            assert sorted(result['skipped']) == paths[:2]
+            assert result['failed'] == paths[2:]
+            result = read_ds_batch(paths, **kw)
+            assert len(result['skipped']) == 3
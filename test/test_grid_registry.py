@@ -0,0 +1,53 @@
+import os
+import tempfile
+
+import numpy as np
+
+import optim_esm_tools as oet
+from optim_esm_tools.analyze import grid_registry
+
+
+def test_strip_and_attach():
+    grid = grid_registry.get_grid('n32')
+    assert grid_registry.get_grid('n32') is grid
+    ds = grid.area_data_array().to_dataset()
+    ds['var'] = ds['cell_area'] * 0 + 1
+
+    stripped = grid_registry.strip(ds, 'n32')
+    assert 'cell_area' not in stripped and 'cell_area' in ds
+    assert stripped.attrs['grid_registry'] == 'n32'
+    np.testing.assert_array_equal(grid_registry.cell_area(stripped), grid.cell_area)
+    attached = grid_registry.attach(stripped)
+    np.testing.assert_array_equal(attached['cell_area'], ds['cell_area'])
+
+    # Other grids or modified areas are kept
+    assert 'cell_area' in grid_registry.strip(ds, 'n90')
+    assert 'cell_area' in grid_registry.strip(ds * 2, 'n32')
+    assert 'cell_area' in grid_registry.strip(ds, False)
+
+
+def test_zone_mask():
+    grid = grid_registry.get_grid('n32')
+    mask = grid.tropics_mask(23.5)
+    assert mask is grid.tropics_mask(23.5)
+    assert mask.shape == grid.cell_area.shape
+    assert np.all(np.abs(grid.lat_2d[mask]) < 23.5)
+    assert np.all(np.abs(grid.lat_2d[~mask]) > 23.5)
+
+
+def test_read_ds_cache_references_registry():
+    with tempfile.TemporaryDirectory() as temp_dir:
+        ds = oet._test_utils.complete_ds(len_x=36, len_y=18, len_time=20)
+        ds.to_netcdf(os.path.join(temp_dir, 'merged.nc'))
+        kw = dict(
+            base=temp_dir,
+            variable_of_interest='var',
+            max_time=None,
+            _skip_folder_info=True,
+            pre_proc_kw=dict(engine='numpy'),
+        )
+        fresh = oet.read_ds(**kw)
+        cache_file = fresh.attrs['file']
+        assert 'cell_area' not in oet.load_glob(cache_file)
+        cached = oet.read_ds(**kw)
+        np.testing.assert_array_equal(cached['cell_area'], fresh['cell_area'])
@@ -0,0 +1,470 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+import pytest
+
+import optim_esm_tools as oet
+from optim_esm_tools.analyze import regrid
+
+requires_cdo = pytest.mark.skipif(
+    shutil.which('cdo') is None, reason='cdo not installed'
+)
+
+
+def _write_test_ds(path, len_time=30, start_year=2000, seed=0, **kw):
+    kw.setdefault('len_x', 36)
+    kw.setdefault('len_y', 18)
+    kw.setdefault('add_nans', False)
+    ds = oet._test_utils.complete_ds(start_year=start_year, len_time=len_time, **kw)
+    rng = np.random.default_rng(seed)
+    trend = np.arange(len_time)[:, None, None] * 0.1
+    ds['var'].data = ds['var'].values + trend + rng.normal(size=ds['var'].shape)
+    ds.to_netcdf(path)
+    return ds
+
+
+def test_grid_area_covers_sphere():
+    for grid in ['n90', 'n32', 'r360x180']:
+        area = regrid.grid_area(grid)
+        assert np.isclose(area.sum(), 4 * np.pi * regrid._EARTH_RADIUS_M**2)
+
+
+def test_bilinear_linear_field():
+    """Bilinear interpolation of a field that is linear in latitude is exact."""
+    source_lat = np.linspace(-85, 85, 35)
+    source_lon = np.linspace(0, 360, 72, endpoint=False)
+    target_lat, target_lon = regrid.target_grid_coords('n32')
+    weights = regrid.bilinear_weights(source_lat, source_lon, target_lat, target_lon)
+    field = np.repeat(2 * source_lat[:, None], len(source_lon), axis=1)[None]
+    result = regrid.apply_weights(weights, field, len(target_lat), len(target_lon))[0]
+    inside = np.abs(target_lat) < 85
+    expected = np.repeat(2 * target_lat[:, None], len(target_lon), axis=1)
+    np.testing.assert_allclose(result[inside], expected[inside])
+
+
+def test_bilinear_propagates_nans():
+    source_lat = np.linspace(-90, 90, 19)
+    source_lon = np.linspace(0, 360, 36, endpoint=False)
+    target_lat, target_lon = regrid.target_grid_coords('n32')
+    weights = regrid.bilinear_weights(source_lat, source_lon, target_lat, target_lon)
+    field = np.ones((1, len(source_lat), len(source_lon)))
+    field[0, 9, 0] = np.nan
+    result = regrid.apply_weights(weights, field, len(target_lat), len(target_lon))[0]
+    assert np.isnan(result).any()
+    np.testing.assert_allclose(result[~np.isnan(result)], 1)
+
+
+def test_weight_cache():
+    source_lat = np.linspace(-90, 90, 19)
+    source_lon = np.linspace(0, 360, 36, endpoint=False)
+    with tempfile.TemporaryDirectory() as temp_dir:
+        weights = regrid.cached_bilinear_weights(
+            source_lat,
+            source_lon,
+            'n32',
+            cache_dir=temp_dir,
+        )
+        stored = os.listdir(temp_dir)
+        assert len(stored) == 1 and stored[0].endswith('_n32.npz')
+        regrid._WEIGHTS_IN_MEMORY.clear()
+        from_disk = regrid.cached_bilinear_weights(
+            source_lat,
+            source_lon,
+            'n32',
+            cache_dir=temp_dir,
+        )
+        assert (weights != from_disk).nnz == 0
+        fingerprint = regrid.grid_fingerprint(source_lat, source_lon)
+        assert fingerprint != regrid.grid_fingerprint(source_lat, source_lon + 1)
+
+
+def test_cdo_weights_need_constant_mask():
+    from unittest import mock
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        source = os.path.join(temp_dir, 'source.nc')
+        ds = _write_test_ds(source, len_time=20)
+        ds['var'][:, 0, 0] = np.nan
+        ds.to_netcdf(source, mode='w')
+        kw = dict(
+            target_grid='n32',
+            input=source,
+            output=os.path.join(temp_dir, 'out.nc'),
+            variable_id='var',
+        )
+        with mock.patch.dict(
+            oet.config.config['analyze'],
+            dict(regrid_weight_cache=temp_dir),
+        ):
+            cdo_int = mock.MagicMock()
+            regrid.cdo_remapbil(cdo_int, **kw)
+            genbil_input = cdo_int.genbil.call_args.kwargs['input']
+            assert genbil_input == f'-selname,var {source}'
+            assert cdo_int.remap.called and not cdo_int.remapbil.called
+
+            # A mask that changes in time (like sea ice) falls back to remapbil
+            ds['var'][5:, 1, 1] = np.nan
+            ds.to_netcdf(source, mode='w')
+            cdo_int = mock.MagicMock()
+            regrid.cdo_remapbil(cdo_int, **kw)
+            assert cdo_int.remapbil.called and not cdo_int.genbil.called
+
+            # Unless the mask is constant in the selected time range
+            cdo_int = mock.MagicMock()
+            regrid.cdo_remapbil(cdo_int, select_dates='2005-01-01,2019-12-31', **kw)
+            assert cdo_int.remap.called and not cdo_int.remapbil.called
+            assert cdo_int.genbil.call_args.kwargs['input'].startswith(
+                '-selname,var -seldate,2005-01-01,2019-12-31',
+            )
+
+
+@requires_cdo
+def test_cdo_threads_give_same_result():
+    from unittest import mock
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        source = os.path.join(temp_dir, 'source.nc')
+        _write_test_ds(source, len_time=60)
+        results = {}
+        for n_threads in [1, 3]:
+            working_dir = os.path.join(temp_dir, str(n_threads))
+            os.mkdir(working_dir)
+            with mock.patch.dict(
+                oet.config.config['analyze'],
+                dict(pre_process_threads=str(n_threads)),
+            ):
+                results[n_threads] = oet.load_glob(
+                    oet.analyze.pre_process.pre_process(
+                        source,
+                        engine='cdo',
+                        working_dir=working_dir,
+                        max_time=None,
+                        _ma_window=(10, 50),
+                    ),
+                ).load()
+        assert set(results[1].data_vars) == set(results[3].data_vars)
+        for k in results[1].data_vars:
+            np.testing.assert_array_equal(results[1][k], results[3][k])
+
+
+@requires_cdo
+def test_cdo_cache_uses_grid_registry():
+    with tempfile.TemporaryDirectory() as temp_dir:
+        _write_test_ds(os.path.join(temp_dir, 'source.nc'))
+        ds = oet.read_ds(
+            temp_dir,
+            _file_name='source.nc',
+            _skip_folder_info=True,
+            max_time=None,
+            pre_proc_kw=dict(engine='cdo'),
+        )
+        grid = oet.analyze.grid_registry.get_grid(
+            oet.config.config['analyze']['regrid_to']
+        )
+        np.testing.assert_array_equal(ds['cell_area'], grid.cell_area)
+        cached = oet.analyze.io.load_glob(ds.attrs['file'])
+        assert 'cell_area' not in cached
+        assert cached.attrs['grid_registry'] == grid.name
+
+
+def test_running_mean_matches_tools():
+    values = np.random.default_rng(1).normal(size=(40, 3, 4))
+    res = oet.analyze.pre_process._running_mean_nan(values, 10)
+    np.testing.assert_allclose(
+        res,
+        oet.analyze.tools.running_mean_array(values, 10),
+        equal_nan=True,
+    )
+
+
+def test_running_means_share_cumulative_sum():
+    values = np.random.default_rng(1).normal(size=(60, 3, 4))
+    values[7, 1, 1] = np.nan
+    windows = oet.analyze.pre_process._ma_windows('10 50')
+    assert windows == (10, 50)
+    for window, res in zip(
+        windows,
+        oet.analyze.pre_process._running_means_nan(values, windows),
+    ):
+        np.testing.assert_array_equal(
+            res,
+            oet.analyze.pre_process._running_mean_nan(values, window),
+        )
+    for bad in [(), (10, 10)]:
+        with pytest.raises(ValueError):
+            oet.analyze.pre_process._ma_windows(bad)
+
+
+def test_detrend_removes_trend():
+    t = np.arange(50, dtype=np.float64)
+    values = (3 + 0.5 * t)[:, None] * np.ones((1, 4))
+    values[3, 0] = np.nan
+    res = oet.analyze.pre_process._detrend_nan(values, t)
+    np.testing.assert_allclose(res[~np.isnan(res)], 0, atol=1e-10)
+    assert np.isnan(res[3, 0])
+
+
+class TestNumpyEngine(unittest.TestCase):
+    def test_numpy_engine(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            source = os.path.join(temp_dir, 'source.nc')
+            _write_test_ds(source)
+            res_file = oet.analyze.pre_process.pre_process(
+                source,
+                engine='numpy',
+                working_dir=temp_dir,
+                max_time=(2020, 12, 30),
+            )
+            assert sorted(os.listdir(temp_dir)) == ['result.nc', 'source.nc']
+            ds = oet.load_glob(res_file)
+            assert ds['time'].values[-1].year == 2020
+            assert ds['lat'].shape == (180,)
+            for k in [
+                'var',
+                'cell_area',
+                'var_detrend',
+                'var_run_mean_10',
+                'var_detrend_run_mean_10',
+            ]:
+                assert k in ds, k
+
+    def test_numpy_engine_multiple_windows(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            source = os.path.join(temp_dir, 'source.nc')
+            _write_test_ds(source, len_time=60)
+            ds = oet.read_ds(
+                temp_dir,
+                _file_name='source.nc',
+                _skip_folder_info=True,
+                _ma_window=(10, 50),
+                max_time=None,
+                pre_proc_kw=dict(engine='numpy'),
+            )
+            assert ds.attrs['running_mean_period'] == 10
+            assert ds.attrs['file'].endswith('_ma10_50_optimesm.nc')
+            for window in [10, 50]:
+                np.testing.assert_allclose(
+                    ds[f'var_run_mean_{window}'],
+                    oet.analyze.pre_process._running_mean_nan(
+                        ds['var'].values,
+                        window,
+                    ),
+                    rtol=1e-6,
+                )
+                assert f'var_detrend_run_mean_{window}' in ds
+
+    def test_numpy_engine_with_history(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            paths = [os.path.join(temp_dir, f'{x}.nc') for x in ['ssp', 'historical']]
+            _write_test_ds(paths[0], start_year=2015, len_time=20)
+            _write_test_ds(paths[1], start_year=1995, len_time=20, seed=1)
+            ds = oet.read_ds(
+                temp_dir,
+                add_history=True,
+                _file_name='ssp.nc',
+                _skip_folder_info=True,
+                _historical_path=paths[1],
+                _cache=False,
+                pre_proc_kw=dict(engine='numpy'),
+            )
+            assert len(ds['time']) == 40
+            assert ds['time'].values[0].year == 1995
+
+    @requires_cdo
+    def test_numpy_engine_matches_cdo(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            source = os.path.join(temp_dir, 'source.nc')
+            _write_test_ds(source)
+            results = {}
+            for engine in ['cdo', 'numpy']:
+                results[engine] = oet.analyze.pre_process.get_preprocessed_ds(
+                    source,
+                    engine=engine,
+                    max_time=None,
+                )
+            ds_cdo, ds_np = results['cdo'], results['numpy']
+            assert set(ds_cdo.data_vars) <= set(ds_np.data_vars)
+            np.testing.assert_allclose(ds_cdo['lat'], ds_np['lat'], atol=1e-6)
+            np.testing.assert_allclose(
+                ds_cdo['cell_area'],
+                ds_np['cell_area'],
+                rtol=1e-3,
+            )
+            inside = np.abs(ds_np['lat'].values) < 80
+            for k in [
+                'var',
+                'var_detrend',
+                'var_run_mean_10',
+                'var_detrend_run_mean_10',
+            ]:
+                np.testing.assert_allclose(
+                    ds_cdo[k].values[:, inside],
+                    ds_np[k].values[:, inside],
+                    rtol=1e-4,
+                    atol=1e-4,
+                    equal_nan=True,
+                )
+
+    def test_stage_cache_reuses_regrid(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            source = os.path.join(temp_dir, 'source.nc')
+            stage_dir = os.path.join(temp_dir, 'stages')
+            _write_test_ds(source)
+            kw = dict(engine='numpy', working_dir=temp_dir, stage_cache=stage_dir)
+            first = oet.analyze.pre_process.pre_process(source, **kw)
+            ds_first = oet.load_glob(first).load()
+            os.remove(first)
+            stored = sorted(os.listdir(stage_dir))
+            assert [f.split('_')[0] for f in stored] == [
+                'detrend',
+                'detrend',
+                'regrid',
+                'running',
+            ], stored
+            second = oet.analyze.pre_process.pre_process(source, _ma_window=5, **kw)
+            stored_second = os.listdir(stage_dir)
+            assert len([f for f in stored_second if f.startswith('regrid')]) == 1
+            assert len(stored_second) == len(stored) + 2
+            ds_second = oet.load_glob(second)
+            np.testing.assert_array_equal(
+                ds_first['var_detrend'], ds_second['var_detrend']
+            )
+            assert 'var_run_mean_5' in ds_second
+
+
+def test_concat_in_time_resolves_overlap():
+    first = oet._test_utils.complete_ds(len_x=4, len_y=3, len_time=20, start_year=1995)
+    second = oet._test_utils.complete_ds(len_x=4, len_y=3, len_time=20, start_year=2010)
+    second['var'].data = second['var'].values + 100
+    ds = oet.analyze.pre_process._concat_in_time(first, second)
+    years = [t.year for t in ds['time'].values]
+    assert years == list(range(1995, 2030))
+    # Overlapping years are taken from the first dataset
+    np.testing.assert_array_equal(ds['var'].isel(time=15), first['var'].isel(time=15))
+    np.testing.assert_array_equal(ds['var'].isel(time=-1), second['var'].isel(time=-1))
+
+
+def test_time_pushdown_matches_full_regrid():
+    """Selecting the time range before or after regridding gives the same result."""
+    with tempfile.TemporaryDirectory() as temp_dir:
+        source = os.path.join(temp_dir, 'source.nc')
+        _write_test_ds(source)
+        results = []
+        for stage_cache in ['', os.path.join(temp_dir, 'stages')]:
+            res_file = oet.analyze.pre_process.pre_process(
+                source,
+                engine='numpy',
+                working_dir=temp_dir,
+                min_time=(2005, 1, 1),
+                max_time=(2020, 12, 30),
+                stage_cache=stage_cache,
+                save_as=os.path.join(temp_dir, f'result_{len(results)}.nc'),
+            )
+            results.append(oet.load_glob(res_file).load())
+        assert len(results[0]['time']) == 16
+        for k in results[0].data_vars:
+            np.testing.assert_array_equal(results[0][k], results[1][k])
+
+
+def test_streaming_duplicate_repair():
+    ds = oet._test_utils.complete_ds(len_x=4, len_y=3, len_time=10)
+    ds = ds.isel(time=[0, 1, 2, 2, 3, 4, 5, 5, 5, 6, 7, 8, 9])
+    with tempfile.TemporaryDirectory() as temp_dir:
+        path = os.path.join(temp_dir, 'merged.nc')
+        ds.to_netcdf(path)
+        report = oet.analyze.pre_process._remove_duplicate_time_stamps(
+            path,
+            dry_run=True,
+        )
+        assert report['n_drop'] == 3 and report['drop_indices'] == [3, 7, 8]
+        assert report['needs_repair']
+        assert len(os.listdir(temp_dir)) == 1
+
+        opened = oet.load_glob(path)
+        oet.analyze.pre_process._drop_duplicates_carefully(opened, 9, 13, path)
+        assert sorted(os.listdir(temp_dir)) == ['faulty_merged.nc', 'merged.nc']
+        repaired = oet.load_glob(path)
+        assert len(repaired['time']) == 10
+        np.testing.assert_array_equal(
+            repaired['var'].values,
+            ds.drop_duplicates('time')['var'].values,
+        )
+
+
+def test_file_info_is_cached_per_mtime():
+    with tempfile.TemporaryDirectory() as temp_dir:
+        path = os.path.join(temp_dir, 'source.nc')
+        ds = _write_test_ds(path, len_time=12)
+        info = oet.analyze.io.file_info(path)
+        assert oet.analyze.io.file_info(path) is info
+        assert info.n_time == 12 and info.year_span == 11
+        assert info.dims['time'] == 12 and 'var' in info.data_vars
+        assert info.calendar == ds['time'].values[0].calendar
+        assert info.grid_fingerprint is not None
+        assert oet.analyze.pre_process._read_variable_id(path) == 'var'
+
+        ds.isel(time=slice(0, 5)).to_netcdf(path, mode='w')
+        os.utime(path, ns=(info.mtime_ns + 10**9, info.mtime_ns + 10**9))
+        new_info = oet.analyze.io.file_info(path)
+        assert new_info is not info and new_info.n_time == 5
+
+
+def test_bad_vars_are_not_read():
+    with tempfile.TemporaryDirectory() as temp_dir:
+        source = os.path.join(temp_dir, 'source.nc')
+        ds = oet._test_utils.complete_ds(len_x=36, len_y=18, len_time=20)
+        ds['GEOLAT'] = ds['var'].isel(time=0).copy()
+        ds.to_netcdf(source)
+        mtime = os.stat(source).st_mtime_ns
+        assert oet.analyze.pre_process._bad_vars(source) == ['GEOLAT']
+
+        res_file = oet.analyze.pre_process.pre_process(
+            source,
+            engine='numpy',
+            working_dir=temp_dir,
+            max_time=None,
+        )
+        assert os.stat(source).st_mtime_ns == mtime
+        assert 'GEOLAT' not in oet.load_glob(res_file)
+
+        stripped = os.path.join(temp_dir, 'stripped.nc')
+        removed = oet.analyze.pre_process._remove_bad_vars(source, save_as=stripped)
+        assert removed == ['GEOLAT']
+        assert 'GEOLAT' not in oet.load_glob(stripped)
+        assert 'GEOLAT' in oet.load_glob(source)
+
+
+def test_storage_profiles():
+    import xarray as xr
+
+    ds = oet._test_utils.complete_ds(len_x=20, len_y=10, len_time=30)
+    ds['var_run_mean_10'] = ds['var'].rolling(time=10).mean()
+    ds['max jump'] = ds['var'].max('time')
+    with tempfile.TemporaryDirectory() as temp_dir:
+        for profile, settings in oet.analyze.pre_process.STORAGE_PROFILES.items():
+            path = os.path.join(temp_dir, f'{profile}.nc')
+            oet.analyze.pre_process.save_nc(ds, path, profile=profile)
+            with xr.open_dataset(path, use_cftime=True) as stored:
+                for name, role in [
+                    ('var', 'field'),
+                    ('var_run_mean_10', 'series'),
+                    ('max jump', 'map'),
+                ]:
+                    data_array = stored[name]
+                    assert oet.analyze.pre_process._variable_role(data_array) == role
+                    chunks = dict(
+                        zip(data_array.dims, data_array.encoding['chunksizes']),
+                    )
+                    assert chunks['lat'] == min(settings[role]['cells'] or 10, 10)
+                    if 'time' in chunks:
+                        assert chunks['time'] == (settings[role]['time'] or 30)
+                    np.testing.assert_array_equal(data_array.values, ds[name].values)
+        with pytest.raises(ValueError):
+            oet.analyze.pre_process.save_nc(ds, path, profile='no_such_profile')
+
+    benchmark = oet.analyze.io.benchmark_storage_profiles(ds, repeat=1)
+    assert len(benchmark) == 4 * len(oet.analyze.pre_process.STORAGE_PROFILES)
+    assert (benchmark['seconds'] > 0).all()
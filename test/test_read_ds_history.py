@@ -1,6 +1,9 @@
 import os
 import tempfile
 from unittest import TestCase
+from unittest import mock
+
+import numpy as np
 
 import optim_esm_tools as oet
 
@@ -47,3 +50,347 @@ class TestReadDs(TestCase):
             )
             assert len(ds_with_hist['time']) == len_time * 2
             assert ds_with_hist['time'].values[0].year == start_year - len_time
+
+    def test_read_ds_variables(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            ds = oet._test_utils.complete_ds(len_x=10, len_y=8, len_time=20)
+            ds.to_netcdf(os.path.join(temp_dir, 'merged.nc'))
+            variables = oet.analyze.cmip_handler.required_variables(
+                [
+                    oet.analyze.tipping_criteria.MaxJump,
+                    oet.region_finding.Percentiles,
+                    oet.analyze.region_calculation.RegionPropertyCalculator,
+                ],
+                variable='var',
+            )
+            assert variables == (
+                'max jump',
+                'std detrended',
+                'cell_area',
+                'var',
+                'var_run_mean_10',
+            )
+            kw = dict(
+                base=temp_dir,
+                variable_of_interest='var',
+                max_time=None,
+                _skip_folder_info=True,
+                pre_proc_kw=dict(engine='numpy'),
+            )
+            for _ in range(2):
+                # First from the computation, then from the cache
+                projected = oet.read_ds(variables=variables, **kw)
+                assert set(projected.data_vars) == set(variables)
+                assert 'time' in projected.coords
+            full = oet.read_ds(**kw)
+            assert set(full.data_vars) > set(variables)
+            with self.assertRaises(ValueError):
+                oet.read_ds(variables=['no_such_variable'], **kw)
+
+    def test_read_many(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            bases = []
+            for variable_id, start_year, len_time in [
+                ('tas', 2000, 20),
+                ('tos', 2005, 25),
+            ]:
+                base = os.path.join(temp_dir, variable_id)
+                os.makedirs(base)
+                ds = oet._test_utils.complete_ds(
+                    len_x=10,
+                    len_y=8,
+                    len_time=len_time,
+                    start_year=start_year,
+                ).rename(var=variable_id)
+                ds.attrs.update(variable_id=variable_id)
+                ds.to_netcdf(os.path.join(base, 'merged.nc'))
+                bases.append(base)
+            kw = dict(
+                max_time=None,
+                _skip_folder_info=True,
+                pre_proc_kw=dict(engine='numpy'),
+            )
+            separate = oet.analyze.cmip_handler.read_many(bases, merge=False, **kw)
+            assert list(separate) == ['tas', 'tos']
+            merged = oet.analyze.cmip_handler.read_many(bases, **kw)
+            assert merged.attrs['variables'] == ['tas', 'tos']
+            assert len(merged['time']) == 15
+            for variable_id, ds in separate.items():
+                assert f'{variable_id} max jump' in merged
+                assert f'{variable_id}_run_mean_10' in merged
+            with self.assertRaises(ValueError):
+                oet.analyze.cmip_handler.read_many(bases + bases[:1], **kw)
+
+    def test_read_many_shares_historical(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            bases = []
+            for variable_id in ['tas', 'tos']:
+                for activity_id, experiment_id, start_year in [
+                    ('ScenarioMIP', 'ssp585', 2015),
+                    ('CMIP', 'historical', 1995),
+                ]:
+                    base = os.path.join(
+                        temp_dir,
+                        activity_id,
+                        'Inst',
+                        'Source',
+                        experiment_id,
+                        'r1i1p1f1',
+                        'Amon',
+                        variable_id,
+                        'gn',
+                        'v20200101',
+                    )
+                    os.makedirs(base)
+                    ds = oet._test_utils.complete_ds(
+                        len_x=10,
+                        len_y=8,
+                        len_time=20,
+                        start_year=start_year,
+                    ).rename(var=variable_id)
+                    ds.attrs.update(
+                        source_id='Source',
+                        variable_id=variable_id,
+                        parent_activity_id='CMIP',
+                        parent_experiment_id='historical',
+                        parent_source_id='Source',
+                        parent_variant_label='r1i1p1f1',
+                    )
+                    ds.to_netcdf(os.path.join(base, 'merged.nc'))
+                    if experiment_id == 'ssp585':
+                        bases.append(base)
+            find_matches = oet.analyze.find_matches
+            with mock.patch.object(
+                find_matches,
+                'associate_parent',
+                wraps=find_matches.associate_parent,
+            ) as associate_parent:
+                separate = oet.analyze.cmip_handler.read_many(
+                    bases,
+                    merge=False,
+                    add_history=True,
+                    max_time=None,
+                    pre_proc_kw=dict(engine='numpy'),
+                )
+            # Only the historical of the first variable is searched for
+            assert associate_parent.call_count == 1
+            for variable_id, ds in separate.items():
+                assert len(ds['time']) == 40
+                assert f'/{variable_id}/' in ds.attrs['historical_file']
+                assert '/historical/' in ds.attrs['historical_file']
+
+    def test_read_ensemble(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            bases = []
+            for member, len_time in enumerate([20, 25]):
+                base = os.path.join(temp_dir, f'r{member}')
+                os.makedirs(base)
+                ds = oet._test_utils.complete_ds(
+                    len_x=10,
+                    len_y=8,
+                    len_time=len_time,
+                    start_year=2000,
+                )
+                ds.attrs.update(variable_id='var')
+                ds.to_netcdf(os.path.join(base, 'merged.nc'))
+                bases.append(base)
+            kw = dict(
+                max_time=None,
+                _skip_folder_info=True,
+                pre_proc_kw=dict(engine='numpy'),
+            )
+            ensemble = oet.analyze.cmip_handler.read_ensemble(bases, **kw)
+            assert ensemble.sizes['member'] == 2
+            assert len(ensemble['time']) == 20
+            assert ensemble['cell_area'].dims == ('lat', 'lon')
+            assert 'member' in ensemble['max jump'].dims
+            assert 'member' not in ensemble['max jump member mean'].dims
+            single = oet.read_ds(bases[0], **kw)
+            assert single['var'].shape == ensemble['var'].isel(member=0).shape
+            with self.assertRaises(ValueError):
+                oet.analyze.cmip_handler.read_ensemble(bases + bases[:1], **kw)
+
+    def test_cache_augmentation(self):
+        tc = oet.analyze.tipping_criteria
+        with tempfile.TemporaryDirectory() as temp_dir:
+            ds = oet._test_utils.complete_ds(len_x=10, len_y=8, len_time=20)
+            ds.to_netcdf(os.path.join(temp_dir, 'merged.nc'))
+            kw = dict(
+                base=temp_dir,
+                max_time=None,
+                _skip_folder_info=True,
+                pre_proc_kw=dict(engine='numpy'),
+            )
+            first = oet.read_ds(**kw)
+            manifest = oet.analyze.cmip_handler._read_manifest(first.attrs)
+            default_conditions = oet.analyze.cmip_handler._DEFAULT_CONDITIONS
+            assert set(manifest['conditions']) == {
+                c.short_description for c in default_conditions
+            }
+
+            def fail(*a, **k):
+                raise AssertionError('should have been cached')
+
+            # Only the bumped condition is calculated again, and afterwards it is cached too
+            with mock.patch.object(tc.StartEndDifference, 'version', '2'):
+                with mock.patch.object(tc.MaxJump, 'calculate', fail):
+                    augmented = oet.read_ds(**kw)
+                with mock.patch.object(tc.StartEndDifference, 'calculate', fail):
+                    cached = oet.read_ds(**kw)
+            for data_set in augmented, cached:
+                for name in first.data_vars:
+                    assert data_set[name].equals(first[name]), name
+
+            # Augmenting only adds the conditions to the cached file
+            with mock.patch.object(tc.StartEndDifference, 'version', '3'):
+                with mock.patch.object(
+                    oet.analyze.io,
+                    'save_ds',
+                    wraps=oet.analyze.io.save_ds,
+                ) as save_ds:
+                    oet.read_ds(**kw)
+            assert save_ds.call_args.kwargs['append']
+            stored = save_ds.call_args.args[0]
+            assert list(stored.data_vars) == [tc.StartEndDifference.short_description]
+
+            # A new version of cmip_handler recalculates the conditions, but not the
+            # pre-processing, and keeps the name of the cached file
+            with mock.patch.dict(
+                oet.config.config['versions'],
+                dict(cmip_handler='-1'),
+            ):
+                with mock.patch.object(oet.analyze.pre_process, '_detrend_stage', fail):
+                    bumped = oet.read_ds(**kw)
+                cached = oet.read_ds(**kw)
+            assert bumped.attrs['file'] == cached.attrs['file'] == first.attrs['file']
+            for name in first.data_vars:
+                assert bumped[name].equals(first[name]), name
+
+            # The windows of the (optional) MaxJumpSweep are part of its fingerprint
+            fingerprints = set()
+            for years in ['5 10', '5 10 20']:
+                with mock.patch.dict(
+                    oet.config.config['analyze'],
+                    dict(max_jump_sweep_years=years),
+                ):
+                    fingerprints.add(
+                        tc.condition_fingerprint(tc.MaxJumpSweep(variable='var')),
+                    )
+            assert len(fingerprints) == 2
+
+            # A changed pre-processing stage invalidates the cached file
+            with mock.patch.object(
+                oet.analyze.pipeline,
+                'STAGE_VERSIONS',
+                {**oet.analyze.pipeline.STAGE_VERSIONS, 'detrend': '-1'},
+            ):
+                with mock.patch.object(oet.analyze.pre_process, '_detrend_stage', fail):
+                    with self.assertRaises(AssertionError):
+                        oet.read_ds(**kw)
+
+    def test_cached_read_without_lock(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            ds = oet._test_utils.complete_ds(len_x=10, len_y=8, len_time=20)
+            ds.to_netcdf(os.path.join(temp_dir, 'merged.nc'))
+            kw = dict(
+                base=temp_dir,
+                max_time=None,
+                _skip_folder_info=True,
+                pre_proc_kw=dict(engine='numpy'),
+            )
+            first = oet.read_ds(**kw)
+
+            def fail(*a, **k):
+                raise PermissionError('cannot create the lock file')
+
+            # Users that cannot write to the folder can still read an up-to-date cache
+            with mock.patch.object(oet.utils, 'file_lock', fail):
+                cached = oet.read_ds(**kw)
+            for name in first.data_vars:
+                assert cached[name].equals(first[name]), name
+
+    def test_legacy_cache_name(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            ds = oet._test_utils.complete_ds(len_x=10, len_y=8, len_time=20)
+            ds.to_netcdf(os.path.join(temp_dir, 'merged.nc'))
+            # Caches used to be named after the version that wrote them
+            legacy = os.path.join(temp_dir, 'var_s_e_ma10_optimesm_v1.0.0.nc')
+            ds.to_netcdf(legacy)
+            log = oet.config.get_logger()
+            with mock.patch.object(log, 'warning', wraps=log.warning) as warning:
+                ds = oet.read_ds(
+                    temp_dir,
+                    max_time=None,
+                    _skip_folder_info=True,
+                    pre_proc_kw=dict(engine='numpy'),
+                )
+            assert ds.attrs['file'] == os.path.join(
+                temp_dir, 'var_s_e_ma10_optimesm.nc'
+            )
+            assert any(legacy in str(c) for c in warning.call_args_list)
+            assert os.path.exists(legacy)
+
+    def test_zarr_storage(self):
+        with tempfile.TemporaryDirectory() as temp_dir, mock.patch.dict(
+            oet.config.config['CMIP_files'],
+            dict(storage='zarr', zarr_cell_chunk='45'),
+        ):
+            ds = oet._test_utils.complete_ds(len_x=10, len_y=8, len_time=20)
+            ds.to_netcdf(os.path.join(temp_dir, 'merged.nc'))
+            kw = dict(
+                base=temp_dir,
+                max_time=None,
+                _skip_folder_info=True,
+                pre_proc_kw=dict(engine='numpy'),
+            )
+            computed = oet.read_ds(**kw)
+            assert computed.attrs['file'].endswith('.zarr')
+            cached = oet.read_ds(**kw)
+            assert cached['var'].chunks[cached['var'].dims.index('lon')][0] == 45
+            for name in computed.data_vars:
+                assert cached[name].equals(computed[name]), name
+
+            path = os.path.join(temp_dir, 'region.zarr')
+            mask = computed['cell_area'] > computed['cell_area'].median()
+            reduced = oet.analyze.xarray_tools.mask_to_reduced_dataset(
+                computed,
+                mask,
+                save_as=path,
+            )
+            # Writing again should replace the store
+            reduced = oet.analyze.xarray_tools.mask_to_reduced_dataset(
+                computed,
+                mask,
+                save_as=path,
+            )
+            assert oet.load_glob(path)['var'].equals(reduced['var'])
+
+    def test_float32(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            ds = oet._test_utils.complete_ds(len_x=10, len_y=8, len_time=20)
+            ds.to_netcdf(os.path.join(temp_dir, 'merged.nc'))
+            kw = dict(
+                base=temp_dir,
+                max_time=None,
+                _skip_folder_info=True,
+                pre_proc_kw=dict(engine='numpy'),
+            )
+            reference = oet.read_ds(**kw)
+            with mock.patch.dict(
+                oet.config.config['analyze'],
+                dict(precision='float32'),
+            ):
+                # The cached file of reference is at a different precision, so it is rebuilt
+                computed = oet.read_ds(**kw)
+                cached = oet.read_ds(**kw)
+            for data_set in computed, cached:
+                assert data_set['var'].dtype == 'float32'
+                assert data_set['max jump'].dtype == 'float32'
+                assert data_set['cell_area'].dtype == 'float64'
+                for name in ['var_run_mean_10', 'max jump', 'std detrended']:
+                    np.testing.assert_allclose(
+                        data_set[name],
+                        reference[name],
+                        rtol=1e-4,
+                        atol=1e-6,
+                    )
@@ -0,0 +1,71 @@
+import os
+import tempfile
+import unittest
+
+import numpy as np
+
+import optim_esm_tools as oet
+from optim_esm_tools.analyze import region_calculation
+
+
+def _read_test_ds(temp_dir, seed, trend, len_time=120):
+    ds = oet._test_utils.complete_ds(
+        len_x=20,
+        len_y=10,
+        len_time=len_time,
+        add_nans=False,
+    )
+    rng = np.random.default_rng(seed)
+    ds['var'].data = (
+        ds['var'].values
+        + trend * np.arange(len_time)[:, None, None]
+        + rng.normal(size=ds['var'].shape)
+    )
+    ds.to_netcdf(os.path.join(temp_dir, 'merged.nc'))
+    return oet.read_ds(
+        temp_dir,
+        variable_of_interest='var',
+        max_time=None,
+        _skip_folder_info=True,
+        _ma_window=(10, 11, 50),
+        pre_proc_kw=dict(engine='numpy', target_grid='n32'),
+    ).load()
+
+
+class TestRegionPropertyCalculator(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            cls.ds = _read_test_ds(temp_dir, seed=0, trend=0.1)
+        with tempfile.TemporaryDirectory() as temp_dir:
+            cls.ds_pi = _read_test_ds(temp_dir, seed=1, trend=0)
+        cls.mask = np.zeros(cls.ds['cell_area'].shape, dtype=np.bool_)
+        cls.mask[20:30, 40:60] = True
+
+    def calculator(self, ds_global):
+        return region_calculation.RegionPropertyCalculator(
+            ds_global=ds_global,
+            ds_pi=self.ds_pi,
+            mask=self.mask,
+            field='var',
+        )
+
+    def test_precomputed_running_mean(self):
+        precomputed = self.calculator(self.ds).calculate()
+        calculated = self.calculator(self.ds.drop_vars('var_run_mean_50')).calculate()
+        assert precomputed.keys() == calculated.keys()
+        for k, v in precomputed.items():
+            if isinstance(v, str):
+                assert v == calculated[k]
+                continue
+            np.testing.assert_allclose(v, calculated[k], rtol=1e-6, err_msg=k)
+
+    def test_odd_window_matches_running_mean(self):
+        calculator = self.calculator(self.ds)
+        np.testing.assert_array_equal(
+            calculator.running_mean_cached('var', 11, 'ds_global'),
+            oet.analyze.tools.running_mean(
+                calculator.weigthed_mean_cached('var', 'ds_global'),
+                11,
+            ),
+        )
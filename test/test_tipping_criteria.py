@@ -0,0 +1,168 @@
+import os
+import tempfile
+import unittest
+
+import numpy as np
+
+import optim_esm_tools as oet
+from optim_esm_tools.analyze import tipping_criteria
+
+
+class TestConditionGraph(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            source = os.path.join(temp_dir, 'source.nc')
+            ds = oet._test_utils.complete_ds(len_x=20, len_y=10, len_time=40)
+            ds.to_netcdf(source)
+            cls.ds = oet.analyze.pre_process.get_preprocessed_ds(
+                source,
+                engine='numpy',
+                target_grid=False,
+                max_time=None,
+            )
+
+    def test_parents_are_calculated_once(self):
+        calls = []
+
+        class CountingMaxJump(tipping_criteria.MaxJump):
+            def calculate(self, data_set, graph=None):
+                calls.append(self)
+                return super().calculate(data_set, graph=graph)
+
+        class Combined(tipping_criteria.MaxJumpAndStd):
+            @staticmethod
+            def parents():
+                return CountingMaxJump, tipping_criteria.StdDetrended
+
+        class Ratio(tipping_criteria.SNR):
+            @staticmethod
+            def parents():
+                return CountingMaxJump, tipping_criteria.StdDetrended
+
+        graph = tipping_criteria.ConditionGraph(self.ds)
+        for cls in [CountingMaxJump, Combined, Ratio]:
+            graph.get(cls(variable='var'))
+        assert len(calls) == 1
+
+        direct = Ratio(variable='var').calculate(self.ds)
+        np.testing.assert_array_equal(graph.get(Ratio(variable='var')), direct)
+        assert Combined(variable='var').required_variables() == ()
+        assert CountingMaxJump(variable='var').required_variables() == (
+            'var_run_mean_10',
+        )
+
+    def test_lazy_matches_eager(self):
+        conditions = (
+            tipping_criteria.StdDetrended,
+            tipping_criteria.MaxJump,
+            tipping_criteria.SNR,
+        )
+        kw = dict(calculate_conditions=conditions, variable_of_interest='var')
+        ds = self.ds.copy(deep=True)
+        # The first cell has no data, which the lazy results are not probed on
+        for name, data_array in ds.data_vars.items():
+            if {'lat', 'lon'} <= set(data_array.dims):
+                ds[name][dict(lat=0, lon=0)] = np.nan
+        eager = oet.analyze.cmip_handler.add_conditions_to_ds(
+            ds.copy(),
+            lazy=False,
+            **kw,
+        )
+        lazy = oet.analyze.cmip_handler.add_conditions_to_ds(ds.copy(), lazy=True, **kw)
+        for cls in conditions:
+            key = cls.short_description
+            assert lazy[key].chunks is not None
+            assert lazy[key].attrs == eager[key].attrs
+            np.testing.assert_allclose(lazy[key].values, eager[key].values)
+
+        graph = tipping_criteria.ConditionGraph(ds)
+        condition = tipping_criteria.MaxJump(variable='var')
+        assert graph.get_lazy(condition) is graph.get_lazy(condition)
+
+    def test_criteria_match_xarray(self):
+        data_array = self.ds['var_run_mean_10'].copy()
+        rng = np.random.default_rng(0)
+        data_array.values = data_array.values + rng.normal(size=data_array.shape)
+        data_array[15, 2, 3] = np.nan
+        criteria = tipping_criteria.running_mean_criteria(data_array, x_yr=5)
+
+        valid = data_array.dropna('time', how='all')
+        np.testing.assert_allclose(
+            criteria['start_end_diff'],
+            valid.isel(time=-1) - valid.isel(time=0),
+        )
+        np.testing.assert_allclose(criteria['std'], data_array.std('time'))
+        change = np.abs(data_array.values[5:] - data_array.values[:-5])
+        np.testing.assert_allclose(criteria['max_change'], np.nanmax(change, axis=0))
+        derivative = np.abs(valid.differentiate('time')).max('time')
+        np.testing.assert_allclose(
+            criteria['max_derivative'],
+            derivative * oet.analyze.globals._SECONDS_TO_YEAR,
+        )
+        assert criteria['std'].dims == data_array.std('time').dims
+        criteria_32 = tipping_criteria.running_mean_criteria(
+            data_array.astype(np.float32),
+            x_yr=5,
+        )
+        for name, values in criteria_32.items():
+            assert values.dtype == np.float32, name
+
+        graph = tipping_criteria.ConditionGraph(self.ds)
+        graph.get(tipping_criteria.StartEndDifference(variable='var'))
+        graph.get(tipping_criteria.MaxDerivitive(variable='var'))
+        graph.get(tipping_criteria.MaxJump(variable='var'))
+        assert list(graph._criteria) == [('var_run_mean_10', 'time', 10)]
+
+    def test_max_change_sweep(self):
+        for unit in ['absolute', 'relative', 'std']:
+            sweep = tipping_criteria.max_change_sweep(
+                self.ds,
+                variable='var',
+                x_yrs=[1, 5, 10],
+                unit=unit,
+            )
+            assert sweep.dims[0] == 'window'
+            for x_yr in [1, 5, 10]:
+                single = tipping_criteria.max_change_xyr(
+                    self.ds,
+                    variable='var',
+                    x_yr=x_yr,
+                    unit=unit,
+                )
+                np.testing.assert_allclose(sweep.sel(window=x_yr), single)
+
+        conditions = (tipping_criteria.MaxJump, tipping_criteria.MaxJumpSweep)
+        kw = dict(calculate_conditions=conditions, variable_of_interest='var')
+        eager = oet.analyze.cmip_handler.add_conditions_to_ds(self.ds.copy(), **kw)
+        lazy = oet.analyze.cmip_handler.add_conditions_to_ds(
+            self.ds.copy(),
+            lazy=True,
+            **kw,
+        )
+        key = tipping_criteria.MaxJumpSweep.short_description
+        np.testing.assert_allclose(lazy[key].values, eager[key].values)
+        np.testing.assert_allclose(
+            eager[key].sel(window=10),
+            eager[tipping_criteria.MaxJump.short_description],
+        )
+
+        # The windows can be set instead of read from the config
+        custom = oet.analyze.cmip_handler.add_conditions_to_ds(
+            self.ds.copy(),
+            calculate_conditions=(tipping_criteria.MaxJumpSweep,),
+            variable_of_interest='var',
+            condition_kwargs=dict(number_of_years=(2, 10)),
+        )
+        assert list(custom[key]['window'].values) == [2, 10]
+        np.testing.assert_allclose(
+            custom[key].sel(window=10),
+            eager[key].sel(window=10),
+        )
+        keys = {
+            tipping_criteria.ConditionGraph.key(
+                tipping_criteria.MaxJumpSweep(variable='var', **kw),
+            )
+            for kw in [{}, dict(number_of_years=(2, 10))]
+        }
+        assert len(keys) == 2
@@ -1,3 +1,5 @@
+import warnings
+
 import numpy as np
 from hypothesis import given
 from hypothesis import settings
@@ -30,3 +32,117 @@ def _rank2d(a):
     rnk = oet.analyze.tools.rank2d(a)
 
     assert np.all(np.isclose(pcts, rnk, equal_nan=True))
+
+
+def test_rank_many():
+    rng = np.random.default_rng(0)
+    arrays = [rng.normal(size=(10, 8)), rng.integers(0, 3, size=(10, 8)).astype(float)]
+    arrays[0][0, 0] = np.nan
+    arrays[1][1, :] = np.inf
+    ranks = oet.analyze.tools.rank_many(arrays)
+    assert ranks.shape == (2, 10, 8)
+    assert ranks.dtype == np.float32
+    for a, rank in zip(arrays, ranks):
+        np.testing.assert_array_equal(rank, oet.analyze.tools.rank2d(a))
+    assert np.isnan(ranks[0, 0, 0])
+    assert np.all(np.isnan(oet.analyze.tools.rank2d(np.full((2, 2), np.nan))))
+
+
+def test_rolling_windows():
+    tools = oet.analyze.tools
+    rng = np.random.default_rng(0)
+    values = rng.normal(size=(60, 3, 4))
+    values[5:9, 0, 0] = np.nan
+    values[:, 1, 1] = np.nan
+    windows = (10, 7)
+    means = tools.rolling_mean(values, windows)
+    stds = tools.rolling_std(values, windows)
+    summary = tools.rolling_mean_summary(values, windows, lags=5)
+    assert means.shape == stds.shape == (2, 60, 3, 4)
+    series = values.reshape(60, -1)
+    for i, window in enumerate(windows):
+        expected = np.full_like(series, np.nan)
+        expected_std = np.full_like(series, np.nan)
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning)
+            for k in range(60 - window + 1):
+                chunk = series[k : k + window]
+                n_valid = np.sum(~np.isnan(chunk), axis=0)
+                expected[k + window // 2] = np.nanmean(chunk, axis=0)
+                expected_std[k + window // 2] = np.where(
+                    n_valid >= 2,
+                    np.nanstd(chunk, axis=0),
+                    np.nan,
+                )
+            expected = expected.reshape(values.shape)
+            np.testing.assert_allclose(means[i], expected, equal_nan=True)
+            np.testing.assert_allclose(
+                stds[i],
+                expected_std.reshape(values.shape),
+                equal_nan=True,
+                atol=1e-12,
+            )
+            for name, function in [
+                ('std', np.nanstd),
+                ('max', np.nanmax),
+                ('min', np.nanmin),
+            ]:
+                np.testing.assert_allclose(
+                    summary[name][i],
+                    function(expected, axis=0),
+                    equal_nan=True,
+                )
+            np.testing.assert_allclose(
+                summary['max_difference'][i],
+                np.nanmax(np.abs(expected[5:] - expected[:-5]), axis=0),
+                equal_nan=True,
+            )
+    assert np.all(np.isnan(means[:, :, 1, 1]))
+
+
+def test_running_mean_keeps_nan_and_centering():
+    tools = oet.analyze.tools
+    rng = np.random.default_rng(0)
+    values = rng.normal(size=(60, 3, 4))
+    values[20, 0, 0] = np.nan
+    for window in [5, 10, 11]:
+        expected = np.full_like(values, np.nan)
+        for k in range(60 - window + 1):
+            # A NaN value makes all following running means NaN
+            expected[k + window - window // 2] = np.where(
+                np.any(np.isnan(values[: k + window]), axis=0),
+                np.nan,
+                values[k : k + window].mean(axis=0),
+            )
+        res = tools.running_mean_array(values, window)
+        np.testing.assert_allclose(res, expected, equal_nan=True)
+        np.testing.assert_allclose(
+            tools.running_mean(values[:, 0, 0], window),
+            expected[:, 0, 0],
+            equal_nan=True,
+        )
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning)
+            summary = tools.rolling_mean_summary(values, window, skip_nan=False)
+            np.testing.assert_allclose(
+                summary['std'][0],
+                np.nanstd(res, axis=0),
+                equal_nan=True,
+            )
+        shift = window % 2
+        np.testing.assert_allclose(
+            tools.rolling_mean(values, window, skip_nan=False)[0, : 60 - shift],
+            res[shift:],
+            equal_nan=True,
+        )
+
+        # Skipping NaN values keeps the centering of running_mean
+        skipped = tools.running_mean_array(values, window, skip_nan=True)
+        np.testing.assert_allclose(skipped[:, 1:], res[:, 1:], equal_nan=True)
+        assert not np.isnan(skipped[40, 0, 0])
+
+    values_32 = values.astype(np.float32)
+    assert tools.rolling_mean(values_32, 10).dtype == np.float32
+    assert tools.running_mean(values_32[:, 0, 2], 10, skip_nan=True).dtype == np.float32
+    for res in tools.rolling_mean_summary(values_32, 10).values():
+        assert res.dtype == np.float32
@@ -59,3 +59,56 @@ class TestDepricated(unittest.TestCase):
 
         with self.assertWarns(DeprecationWarning):
             bla(1)
+
+
+def test_file_lock():
+    import os
+    import threading
+    import time
+
+    events = []
+    with tempfile.TemporaryDirectory() as temp_dir:
+        path = os.path.join(temp_dir, 'result.nc')
+
+        def hold():
+            with oet.utils.file_lock(path):
+                events.append('first acquired')
+                time.sleep(0.5)
+                events.append('first released')
+
+        thread = threading.Thread(target=hold)
+        thread.start()
+        while not events:
+            time.sleep(0.01)
+        with oet.utils.file_lock(path):
+            events.append('second acquired')
+        thread.join()
+        # The lock files are cleaned up
+        assert os.listdir(temp_dir) == []
+        with oet.utils.file_lock(path, enabled=False):
+            pass
+        # If the lock file cannot be created, continue without the lock
+        with oet.utils.file_lock(os.path.join(temp_dir, 'no_such_folder', 'result.nc')):
+            events.append('unlocked')
+    assert events == ['first acquired', 'first released', 'second acquired', 'unlocked']
+
+
+def test_atomic_publish_permissions():
+    import os
+
+    umask = os.umask(0o022)
+    oet.utils._umask.cache_clear()
+    try:
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path = os.path.join(temp_dir, 'result.nc')
+            oet.utils.atomic_publish(lambda p: open(p, 'w').close(), path, '.nc')
+            assert os.stat(path).st_mode & 0o777 == 0o644
+
+            store = os.path.join(temp_dir, 'result.zarr')
+            oet.utils.atomic_publish(lambda p: None, store, '.zarr', directory=True)
+            assert os.stat(store).st_mode & 0o777 == 0o755
+        # Reading the umask does not change it
+        assert os.umask(0o022) == 0o022
+    finally:
+        os.umask(umask)
+        oet.utils._umask.cache_clear()
@@ -248,3 +248,17 @@ def test_set_time_int():
     ds2 = oet._test_utils.complete_ds(len_x=2, len_y=2, len_time=2)
     ds3 = oet.analyze.xarray_tools.set_time_int(ds2)
     assert isinstance(ds3['time'].values[0], np.integer)
+
+
+def test_set_precision():
+    ds = oet._test_utils.complete_ds(len_x=5, len_y=4, len_time=10)
+    ds['var_32'] = ds['var'].astype(np.float32)
+    ds['cell_area'] = ds['var'].isel(time=0, drop=True).fillna(0) + 1
+    lowered = oet.analyze.xarray_tools.set_precision(ds, 'float32')
+    assert lowered['var'].dtype == np.float32
+    assert lowered['cell_area'].dtype == ds['cell_area'].dtype
+    assert ds['var'].dtype == np.float64
+    # Never cast to a higher precision
+    raised = oet.analyze.xarray_tools.set_precision(lowered, 'float64')
+    assert raised['var_32'].dtype == np.float32
+    np.testing.assert_allclose(lowered['var'], ds['var'], rtol=1e-6)